@@ -12,18 +12,24 @@
 
 # --- 1. ИМПОРТЫ ---
 
+import logging
 import random
 from datetime import datetime, timedelta
 
 # Импорты для тайп-хинтинга
-from typing import Tuple
+from typing import Any, Dict, Tuple
 
 # Импорты Telegram
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import ContextTypes
+from telegram.ext import Application, ContextTypes
 
 # Импорты из нашего проекта
 from game_base import Game, UserDataManager
+from message_edits import message_editor
+from timing_wheel import TimerHandle, timers
+from update_processor import user_lock
+
+logger = logging.getLogger(__name__)
 
 
 # --- 2. КЛАСС ИГРЫ ---
@@ -32,8 +38,10 @@ class AcademicRaceGame(Game):
     """
     Класс, реализующий логику игры "Гонки академиков".
     """
-    # Атрибут базового класса: эта игра не требует предварительной ставки.
+    # Атрибуты базового класса: эта игра не требует предварительной ставки
+    # и сама отвечает на колбэк кнопки "Начать!".
     requires_bet = False
+    answers_callback = True
     
     # Константа, определяющая все ключи, которые эта игра хранит в context.user_data.
     # Используется для надёжной очистки состояния после завершения игры.
@@ -43,6 +51,7 @@ class AcademicRaceGame(Game):
         'race_deadline',
         'race_reward',
         'race_message_id',
+        'race_chat_id',
         'race_timeout_count'
     ]
 
@@ -55,6 +64,13 @@ class AcademicRaceGame(Game):
         self.initial_reward = 100
         self.time_limit_seconds = 10
         self.max_timeouts = 3
+        # ID пользователя -> таймер текущего раунда (отмена по дескриптору за O(1))
+        self._timers: Dict[int, TimerHandle] = {}
+        # Стартовая клавиатура не зависит от пользователя - собираем один раз
+        self._start_keyboard = InlineKeyboardMarkup([
+            [InlineKeyboardButton("🏁 Начать!", callback_data=f'game:play:{self.id}')],
+            [InlineKeyboardButton("⬅️ Вернуться в Игровой Клуб", callback_data='nav:games')]
+        ])
 
     # --- 3. МЕТОДЫ ГЕНЕРАЦИИ ИНТЕРФЕЙСА ---
 
@@ -110,11 +126,7 @@ class AcademicRaceGame(Game):
         Возвращает клавиатуру для старта игры.
         Реализует абстрактный метод из базового класса Game.
         """
-        keyboard = [
-            [InlineKeyboardButton("🏁 Начать!", callback_data=f'game:play:{self.id}')],
-            [InlineKeyboardButton("⬅️ Вернуться в Игровой Клуб", callback_data='nav:games')]
-        ]
-        return InlineKeyboardMarkup(keyboard)
+        return self._start_keyboard
 
     # --- 4. ОСНОВНАЯ ИГРОВАЯ ЛОГИКА ---
 
@@ -139,7 +151,9 @@ class AcademicRaceGame(Game):
         )
         
         # Запускаем первый раунд
-        await self._start_or_continue_round(context, query.message.chat_id, text, query.message.message_id)
+        await self._start_or_continue_round(
+            context, query.message.chat_id, query.from_user.id, text, query.message.message_id
+        )
 
     async def handle_answer(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """
@@ -159,7 +173,7 @@ class AcademicRaceGame(Game):
         try:
             user_answer = int(update.message.text.strip())
         except (ValueError, TypeError):
-            self._cleanup_race_state(context)
+            self._cleanup_race_state(context, user_id)
             await update.message.reply_text(
                 f"❌ *Неверный формат!* Ответ должен быть целым числом. Правильный ответ был: **{correct_answer}**. Гонка окончена.",
                 reply_markup=self.get_replay_keyboard(), parse_mode='Markdown'
@@ -170,7 +184,11 @@ class AcademicRaceGame(Game):
         if user_answer == correct_answer:
             # Правильный ответ!
             context.user_data['race_timeout_count'] = 0 # Сбрасываем счётчик бездействия
-            self.user_manager.update_user_balance(user_id, current_reward)
+            # Ключ - ID сообщения с ответом: повторная доставка того же апдейта не начислит награду дважды
+            await self.user_manager.transact(
+                user_id, credit=current_reward, idempotency_key=f"msg:{update.effective_chat.id}:{update.message.message_id}",
+                reason=self.id
+            )
             
             # Увеличиваем награду и готовим текст для следующего раунда
             new_reward = int(current_reward * 3.14)
@@ -180,10 +198,10 @@ class AcademicRaceGame(Game):
                 f"🎓 *Следующий раунд!*\nНовая награда: *{new_reward:,}* дукатов!\n\n"
                 f"У вас есть *{self.time_limit_seconds} секунд*:"
             )
-            await self._start_or_continue_round(context, update.effective_chat.id, text)
+            await self._start_or_continue_round(context, update.effective_chat.id, user_id, text)
         else:
             # Неправильный ответ!
-            self._cleanup_race_state(context)
+            self._cleanup_race_state(context, user_id)
             await update.message.reply_text(
                 f"❌ *Неправильно!* Верный ответ был: **{correct_answer}**. Гонка окончена.",
                 reply_markup=self.get_replay_keyboard(), parse_mode='Markdown'
@@ -191,13 +209,25 @@ class AcademicRaceGame(Game):
 
     # --- 5. ЛОГИКА ТАЙМЕРА И УПРАВЛЕНИЯ СОСТОЯНИЕМ ---
 
-    async def timeout_new_problem(self, context: ContextTypes.DEFAULT_TYPE) -> None:
+    async def _on_timeout(self, application: Application, chat_id: int, user_id: int, message_id: int) -> None:
+        """Срабатывание таймера раунда: вне апдейта, поэтому контекст собирается здесь."""
+        # В очереди с апдейтами пользователя, чтобы не пересечься с обработкой его ответа
+        async with user_lock(application, user_id):
+            handle = self._timers.get(user_id)
+            if handle is not None and handle.active:
+                # Пока ждали замка, ответ пользователя начал новый раунд со своим таймером
+                return
+            self._timers.pop(user_id, None)
+            context = application.context_types.context(application, chat_id=chat_id, user_id=user_id)
+            await self.timeout_new_problem(context, chat_id, user_id, message_id)
+            # user_data изменён вне обработки апдейта - отмечаем его для сохранения (см. persistence.py)
+            application.mark_data_for_update_persistence(user_ids=user_id)
+
+    async def timeout_new_problem(self, context: ContextTypes.DEFAULT_TYPE, chat_id: int, user_id: int, message_id: int) -> None:
         """
         Вызывается по таймеру, если пользователь не ответил вовремя.
         Увеличивает счётчик бездействия и либо перезапускает гонку, либо завершает её.
         """
-        job_data = context.job.data
-        chat_id = job_data['chat_id']
 
         # Проверяем, актуальна ли еще игра (пользователь мог уже проиграть)
         if context.user_data.get('game_state') != f'awaiting_answer:{self.id}':
@@ -207,14 +237,14 @@ class AcademicRaceGame(Game):
         
         # Проверяем, не достигнут ли лимит бездействия
         if context.user_data['race_timeout_count'] >= self.max_timeouts:
-            await context.bot.edit_message_text(
-                chat_id=chat_id,
-                message_id=job_data['message_id'],
+            await message_editor.edit(
+                context.bot, chat_id, message_id,
                 text="🏁 *Гонка остановлена из-за неактивности.*\n\nВы можете начать заново в любой момент.",
                 reply_markup=self.get_replay_keyboard(),
-                parse_mode='Markdown'
+                parse_mode='Markdown',
+                debounce=False
             )
-            self._cleanup_race_state(context)
+            self._cleanup_race_state(context, user_id)
             return
 
         # Если лимит не достигнут, начинаем гонку заново с начальной наградой
@@ -224,23 +254,21 @@ class AcademicRaceGame(Game):
             f"🎓 *Гонка академиков!*\nНаграда: *{self.initial_reward:,}* дукатов!\n\n"
             f"У вас есть *{self.time_limit_seconds} секунд*:"
         )
-        await self._start_or_continue_round(context, chat_id, text)
+        await self._start_or_continue_round(context, chat_id, user_id, text)
 
-    def _cleanup_race_state(self, context: ContextTypes.DEFAULT_TYPE) -> None:
+    def _cleanup_race_state(self, context: ContextTypes.DEFAULT_TYPE, user_id: int) -> None:
         """
         Полностью очищает состояние гонки: удаляет все ключи из user_data и отменяет таймер.
         """
         # Отменяем запланированный таймер
-        job_name = f'race_timeout_{context._chat_id}_{context._user_id}'
-        current_jobs = context.job_queue.get_jobs_by_name(job_name)
-        for job in current_jobs:
-            job.schedule_removal()
-            
+        self._cancel_timeout(user_id)
+
         # Удаляем все связанные с гонкой данные пользователя
         for key in self._RACE_STATE_KEYS:
             context.user_data.pop(key, None)
             
-    async def _start_or_continue_round(self, context: ContextTypes.DEFAULT_TYPE, chat_id: int, text: str, message_id: int = None) -> None:
+    async def _start_or_continue_round(self, context: ContextTypes.DEFAULT_TYPE, chat_id: int, user_id: int, text: str,
+                                       message_id: int = None) -> None:
         """
         Приватный helper-метод для запуска нового раунда.
         Инкапсулирует общую логику: генерация задачи, обновление user_data,
@@ -263,26 +291,43 @@ class AcademicRaceGame(Game):
         
         # Редактируем сообщение, добавляя к нему новую задачу
         full_text = f"{text}\n\n{problem}\n\nОтправьте ответ следующим сообщением."
-        msg = await context.bot.edit_message_text(
-            chat_id=chat_id,
-            message_id=message_id,
-            text=full_text,
-            parse_mode='Markdown'
-        )
-        # Сохраняем ID сообщения на случай, если оно изменилось
-        context.user_data['race_message_id'] = msg.message_id
-        
+        # Без отложенной отправки: таймер раунда запускается сразу после правки
+        await message_editor.edit(context.bot, chat_id, message_id, text=full_text, parse_mode='Markdown', debounce=False)
+        context.user_data['race_message_id'] = message_id
+        context.user_data['race_chat_id'] = chat_id
+
         # Планируем задачу на случай, если пользователь не ответит вовремя
-        job_name = f'race_timeout_{chat_id}_{context._user_id}'
-        # Сначала удаляем старый таймер, чтобы избежать дублирования
-        for job in context.job_queue.get_jobs_by_name(job_name):
-            job.schedule_removal()
-        # Создаем новый таймер
-        context.job_queue.run_once(
-            self.timeout_new_problem,
-            self.time_limit_seconds,
-            chat_id=chat_id,
-            user_id=context._user_id,
-            name=job_name,
-            data={'chat_id': chat_id, 'message_id': msg.message_id}
-        )
\ No newline at end of file
+        self._arm_timeout(context.application, chat_id, user_id, message_id, self.time_limit_seconds)
+
+    def _arm_timeout(self, application: Application, chat_id: int, user_id: int, message_id: int, delay: float) -> None:
+        """Запускает таймер раунда, заменяя предыдущий таймер этого пользователя."""
+        # Сначала отменяем старый таймер, чтобы избежать дублирования
+        self._cancel_timeout(user_id)
+        self._timers[user_id] = timers.call_later(delay, self._on_timeout, application, chat_id, user_id, message_id)
+
+    def _cancel_timeout(self, user_id: int) -> None:
+        handle = self._timers.pop(user_id, None)
+        if handle is not None:
+            handle.cancel()
+
+    async def abandon(self, user_id: int, user_data: Dict[str, Any]) -> None:
+        """Состояние неактивного пользователя удаляется - таймер его гонки больше не нужен."""
+        self._cancel_timeout(user_id)
+
+    def resume(self, application: Application, user_id: int, user_data: Dict[str, Any]) -> None:
+        """
+        После перезапуска бота заново запускает таймер идущего раунда: таймеры
+        не сохраняются, а состояние гонки восстанавливается из user_data.
+        Если срок раунда уже истёк, таймер срабатывает сразу.
+        """
+        if user_data.get('game_state') != f'awaiting_answer:{self.id}':
+            return
+        chat_id, message_id = user_data.get('race_chat_id'), user_data.get('race_message_id')
+        deadline = user_data.get('race_deadline')
+        if chat_id is None or message_id is None or deadline is None:
+            # Состояние без данных для таймера продолжить нельзя
+            for key in self._RACE_STATE_KEYS:
+                user_data.pop(key, None)
+            return
+        delay = max(0.0, (deadline - datetime.now()).total_seconds())
+        self._arm_timeout(application, chat_id, user_id, message_id, delay)
\ No newline at end of file
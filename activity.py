@@ -0,0 +1,51 @@
+# Файл: activity.py
+"""
+Буфер активности пользователей (interaction_count / last_seen).
+
+Активность - это телеметрия, а не деньги: её не нужно применять к записи
+пользователя на каждом апдейте. Буфер на горячем пути только увеличивает счётчик
+и запоминает монотонное время, а UserDataManager периодически забирает
+накопленное одной пачкой (см. UserDataManager.flush_activity).
+"""
+
+# --- 1. ИМПОРТЫ ---
+
+import time
+
+# Импорты для тайп-хинтинга
+from typing import Dict, Tuple
+
+
+# --- 2. КЛАСС БУФЕРА ---
+
+class ActivityBuffer:
+    """
+    Копит взаимодействия пользователей между сбросами.
+    """
+    def __init__(self):
+        self._counts: Dict[int, int] = {}
+        # Время последнего взаимодействия по time.monotonic(): дешевле, чем datetime,
+        # и не зависит от перевода системных часов.
+        self._last_seen: Dict[int, float] = {}
+
+    def hit(self, user_id: int) -> None:
+        """Регистрирует одно взаимодействие пользователя. Горячий путь: только счётчик и время."""
+        self._counts[user_id] = self._counts.get(user_id, 0) + 1
+        self._last_seen[user_id] = time.monotonic()
+
+    def drain(self) -> Tuple[Dict[int, int], Dict[int, int]]:
+        """
+        Забирает всё накопленное и очищает буфер.
+
+        Returns:
+            Tuple[Dict[int, int], Dict[int, int]]: Число взаимодействий и время последнего
+            взаимодействия (epoch-секунды) для каждого пользователя.
+        """
+        counts, self._counts = self._counts, {}
+        last_seen, self._last_seen = self._last_seen, {}
+        # Переводим монотонное время в настенное одним сдвигом на всю пачку
+        offset = time.time() - time.monotonic()
+        return counts, {user_id: int(ts + offset) for user_id, ts in last_seen.items()}
+
+    def __len__(self) -> int:
+        return len(self._counts)
@@ -1,9 +1,15 @@
 # Файл: blackjack_game.py
 
 import random
+
+# Импорты для тайп-хинтинга
+from typing import Tuple
+
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes
-from game_base import Game # Импортируем только базовый класс
+from game_base import Game, InsufficientFundsError
+from keyboards import KeyboardRows
+from message_edits import message_editor
 
 # --- Вспомогательные элементы для Блэкджека ---
 SUITS = {"hearts": "♥️", "diamonds": "♦️", "clubs": "♣️", "spades": "♠️"}
@@ -48,6 +54,9 @@ class BlackjackGame(Game):
     """
     Класс для игры в Блэкджек.
     """
+    # Атрибут базового класса: на колбэки play() отвечает сам (в т.ч. алертами)
+    answers_callback = True
+
     def get_rules_text(self, balance: int, bet: int) -> str:
         bet_text = f"Текущая ставка: *{bet:,}* дукатов." if bet > 0 else "Отправьте в чат сумму, которую хотите поставить."
         return (
@@ -60,35 +69,38 @@ class BlackjackGame(Game):
             "- Дилер обязан брать до 16 включительно и на 'мягкие 17', а останавливаться на 'жестких 17' и выше."
         )
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Клавиатуры хода игрока: с кнопкой "Удвоить" и без неё
+        hit_stand = [
+            InlineKeyboardButton("➕ Взять ещё", callback_data=f'game:play:{self.id}:hit'),
+            InlineKeyboardButton("✋ Хватит", callback_data=f'game:play:{self.id}:stand')
+        ]
+        double = InlineKeyboardButton("💰 Удвоить", callback_data=f'game:play:{self.id}:double')
+        self._turn_keyboard = InlineKeyboardMarkup([hit_stand])
+        self._turn_keyboard_with_double = InlineKeyboardMarkup([hit_stand + [double]])
+
+    def build_control_rows(self) -> KeyboardRows:
+        return [
+            # Эта кнопка инициирует `play` с action='start'
+            [InlineKeyboardButton("🃏 Раздать карты", callback_data=f'game:play:{self.id}:start')],
+            [InlineKeyboardButton("⬅️ Вернуться в Игровой Клуб", callback_data='nav:games')]
+        ]
+
     def get_game_keyboard(self, context: ContextTypes.DEFAULT_TYPE) -> InlineKeyboardMarkup:
         """Возвращает клавиатуру для текущего состояния игры."""
         state = context.user_data.get('blackjack_state')
 
         # Если игра не началась (только сделали ставку), показываем кнопку "Раздать"
         if not state:
-            current_bet = context.user_data.get('current_bet', 0)
-            bet_text = f"Ставка: {current_bet:,}" if current_bet > 0 else "Сделайте ставку!"
-            keyboard = [
-                [InlineKeyboardButton(bet_text, callback_data='do_nothing')],
-                # Эта кнопка инициирует `play` с action='start'
-                [InlineKeyboardButton("🃏 Раздать карты", callback_data=f'game:play:{self.id}:start')],
-                [InlineKeyboardButton("⬅️ Вернуться в Игровой Клуб", callback_data='nav:games')]
-            ]
-            return InlineKeyboardMarkup(keyboard)
+            return self.get_bet_keyboard(context.user_data.get('current_bet', 0))
 
         # Если игра завершена, показываем клавиатуру для повторной игры
         if state.get('game_over', True):
             return self.get_replay_keyboard() 
         
         # Клавиатура во время хода игрока
-        buttons = [
-            InlineKeyboardButton("➕ Взять ещё", callback_data=f'game:play:{self.id}:hit'),
-            InlineKeyboardButton("✋ Хватит", callback_data=f'game:play:{self.id}:stand')
-        ]
-        if state.get('can_double'):
-            buttons.append(InlineKeyboardButton("💰 Удвоить", callback_data=f'game:play:{self.id}:double'))
-        
-        return InlineKeyboardMarkup([buttons])
+        return self._turn_keyboard_with_double if state.get('can_double') else self._turn_keyboard
 
     async def _start_new_hand(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Начинает новый раунд блэкджека после того, как ставка сделана."""
@@ -116,9 +128,10 @@ class BlackjackGame(Game):
             context.user_data.pop('blackjack_state', None)
             # 4. Устанавливаем состояние ожидания новой ставки для роутера сообщений
             context.user_data['game_state'] = f'awaiting_bet:{self.id}'
+            await query.answer()
 
             # 5. Редактируем сообщение, чтобы вернуть пользователя к этапу ввода ставки
-            await query.edit_message_text(
+            await message_editor.edit_query(query, 
                 text=error_text,
                 parse_mode='Markdown',
                 reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Вернуться в Игровой Клуб", callback_data='nav:games')]])
@@ -126,18 +139,33 @@ class BlackjackGame(Game):
             return
         # --- КОНЕЦ ИЗМЕНЕНИЙ ---
 
+        # Повторное нажатие "Раздать" на том же сообщении не должно начинать вторую раздачу
+        if self.is_round_settled(query, context):
+            await query.answer("Раздача уже идёт.")
+            return
+
+        # Ставка списывается только в момент раздачи, атомарно с проверкой баланса
+        try:
+            transaction = await self.user_manager.transact(user_id, debit=bet, idempotency_key=f"cb:{query.id}", reason=self.id)
+        except InsufficientFundsError as e:
+            await query.answer(f"Недостаточно средств. Ваш баланс: {e.balance:,}", show_alert=True)
+            return
+        if transaction.duplicate:
+            return
+        self.mark_round_settled(query, context)
+        await query.answer()
+        balance_after_bet = transaction.balance
+
         deck = _create_deck()
         player_hand = [deck.pop(), deck.pop()]
         dealer_hand = [deck.pop(), deck.pop()]
 
-        # Ставка списывается только в момент раздачи
-        self.user_manager.update_user_balance(user_id, -bet)
-        balance_after_bet = self.user_manager.get_user_balance(user_id)
-
         context.user_data['blackjack_state'] = {
             'deck': deck, 'player_hand': player_hand, 'dealer_hand': dealer_hand,
             'bet': bet, 'game_over': False, 'doubled': False,
-            'can_double': balance_after_bet >= bet
+            'can_double': balance_after_bet >= bet,
+            # Ключ раздачи для идемпотентного расчёта брошенной руки (см. abandon)
+            'hand_id': query.id
         }
         
         player_value, _ = _get_hand_properties(player_hand)
@@ -160,16 +188,45 @@ class BlackjackGame(Game):
             f"Ваша ставка: *{state['bet']:,}* дукатов.\n"
             f"Ваш баланс: *{current_balance:,}* дукатов."
         )
-        await query.edit_message_text(text, reply_markup=self.get_game_keyboard(context), parse_mode='Markdown')
+        await message_editor.edit_query(query, text, reply_markup=self.get_game_keyboard(context), parse_mode='Markdown')
 
-    async def _dealer_turn(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Логика хода дилера."""
-        state = context.user_data['blackjack_state']
+    @staticmethod
+    def _draw_dealer_cards(state: dict) -> None:
+        """Дилер добирает карты по правилам стола."""
         while True:
             dealer_value, is_soft = _get_hand_properties(state['dealer_hand'])
             if dealer_value > 17 or (dealer_value == 17 and not is_soft):
                 break
             state['dealer_hand'].append(state['deck'].pop())
+
+    @staticmethod
+    def _resolve_hand(state: dict) -> Tuple[str, int]:
+        """Итог раздачи: строка с результатом и выплата (вместе с возвратом ставки)."""
+        player_value, _ = _get_hand_properties(state['player_hand'])
+        dealer_value, _ = _get_hand_properties(state['dealer_hand'])
+        player_busted = player_value > 21
+        dealer_busted = dealer_value > 21
+        player_has_blackjack = player_value == 21 and len(state['player_hand']) == 2 and not state['doubled']
+        dealer_has_blackjack = dealer_value == 21 and len(state['dealer_hand']) == 2
+        bet = state['bet']
+
+        if player_busted:
+            return "😥 *Перебор!* Вы проиграли.", 0
+        if player_has_blackjack and not dealer_has_blackjack:
+            return "🤑 *БЛЭКДЖЕК!* Выигрыш 3 к 2!", bet + int(bet * 1.5) # Возврат ставки + выигрыш 1.5x
+        if dealer_busted:
+            return "🎉 *Победа!* У дилера перебор.", bet * 2 # Возврат ставки + выигрыш 1x
+        if dealer_has_blackjack and not player_has_blackjack:
+            return "😥 *Поражение!* У дилера блэкджек.", 0
+        if player_value > dealer_value:
+            return "🎉 *Победа!* Ваши очки выше.", bet * 2
+        if player_value < dealer_value:
+            return "😥 *Поражение!* Очки дилера выше.", 0
+        return "😐 *Ничья (Push)!* Ставка возвращена.", bet
+
+    async def _dealer_turn(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Логика хода дилера."""
+        self._draw_dealer_cards(context.user_data['blackjack_state'])
         await self._end_game(update, context)
 
     async def _end_game(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -180,58 +237,42 @@ class BlackjackGame(Game):
         if not state or state.get('game_over'): return
 
         state['game_over'] = True
-        
-        player_value, _ = _get_hand_properties(state['player_hand'])
-        dealer_value, _ = _get_hand_properties(state['dealer_hand'])
-        player_busted = player_value > 21
-        dealer_busted = dealer_value > 21
-        player_has_blackjack = player_value == 21 and len(state['player_hand']) == 2 and not state['doubled']
-        dealer_has_blackjack = dealer_value == 21 and len(state['dealer_hand']) == 2
 
-        result_text = f"Ваша рука: {_render_hand(state['player_hand'])}\nРука дилера: {_render_hand(state['dealer_hand'])}\n\n"
-        
-        payout = 0
-        bet = state['bet']
-        
-        if player_busted:
-            result_text += "😥 *Перебор!* Вы проиграли."
-            payout = 0
-        elif player_has_blackjack and not dealer_has_blackjack:
-            result_text += "🤑 *БЛЭКДЖЕК!* Выигрыш 3 к 2!"
-            payout = bet + int(bet * 1.5) # Возврат ставки + выигрыш 1.5x
-        elif dealer_busted:
-            result_text += "🎉 *Победа!* У дилера перебор."
-            payout = bet * 2 # Возврат ставки + выигрыш 1x
-        elif dealer_has_blackjack and not player_has_blackjack:
-             result_text += "😥 *Поражение!* У дилера блэкджек."
-             payout = 0
-        elif player_value > dealer_value:
-            result_text += "🎉 *Победа!* Ваши очки выше."
-            payout = bet * 2
-        elif player_value < dealer_value:
-            result_text += "😥 *Поражение!* Очки дилера выше."
-            payout = 0
-        else: # Ничья
-            result_text += "😐 *Ничья (Push)!* Ставка возвращена."
-            payout = bet
-
-        if payout > 0:
-            self.user_manager.update_user_balance(user_id, payout)
-            
-        final_balance = self.user_manager.get_user_balance(user_id)
+        result_line, payout = self._resolve_hand(state)
+        result_text = (
+            f"Ваша рука: {_render_hand(state['player_hand'])}\nРука дилера: {_render_hand(state['dealer_hand'])}\n\n"
+            f"{result_line}"
+        )
+
+        transaction = await self.user_manager.transact(user_id, credit=payout, idempotency_key=f"cb:{query.id}:payout", reason=self.id)
+        final_balance = transaction.balance
         result_text += f"\n\nВаш итоговый баланс: *{final_balance:,}* дукатов."
         
         # Очищаем состояние для следующей игры
         context.user_data.pop('blackjack_state', None)
         context.user_data.pop('current_bet', None)
 
-        await query.edit_message_text(result_text, reply_markup=self.get_replay_keyboard(), parse_mode='Markdown')
+        await message_editor.edit_query(query, result_text, reply_markup=self.get_replay_keyboard(), parse_mode='Markdown')
+
+    async def abandon(self, user_id: int, user_data: dict) -> None:
+        """Брошенная раздача доигрывается как "Хватит": дилер добирает карты, выплата зачисляется."""
+        state = user_data.get('blackjack_state')
+        if not state or state.get('game_over'):
+            return
+        state['game_over'] = True
+        self._draw_dealer_cards(state)
+        _, payout = self._resolve_hand(state)
+        hand_id = state.get('hand_id')
+        await self.user_manager.transact(
+            user_id, credit=payout, idempotency_key=f"bj:{hand_id}:abandon" if hand_id else None, reason=self.id
+        )
+        user_data.pop('blackjack_state', None)
 
     async def play(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Центральный обработчик действий игрока для уже идущей игры."""
         query = update.callback_query
         user_id = query.from_user.id
-        action = query.data.split(':')[-1]
+        action = context.args[-1]
         
         if action == 'start':
             await self._start_new_hand(update, context)
@@ -242,7 +283,11 @@ class BlackjackGame(Game):
             await query.answer("Эта игра уже завершена. Начните новую.", show_alert=True)
             return
 
+        can_double = state.get('can_double', False)
         state['can_double'] = False
+        if action != 'double':
+            # Удвоение отвечает своим алертом, остальные действия - сразу, до отрисовки стола
+            await query.answer()
 
         if action == 'hit':
             state['player_hand'].append(state['deck'].pop())
@@ -256,13 +301,17 @@ class BlackjackGame(Game):
 
         elif action == 'double':
             original_bet = state['bet']
-            balance = self.user_manager.get_user_balance(user_id)
-            if balance < original_bet:
+            # Удвоить можно один раз и только первым действием (повторное нажатие игнорируется)
+            if state['doubled'] or not can_double:
+                await query.answer("Удвоение уже недоступно.")
+                return
+            try:
+                await self.user_manager.transact(user_id, debit=original_bet, idempotency_key=f"cb:{query.id}", reason=self.id)
+            except InsufficientFundsError:
                  await query.answer(f"Не хватает {original_bet:,} для удвоения!", show_alert=True)
                  state['can_double'] = True
                  return
             
-            self.user_manager.update_user_balance(user_id, -original_bet)
             state['bet'] *= 2
             state['doubled'] = True
             state['player_hand'].append(state['deck'].pop())
@@ -0,0 +1,606 @@
+# Файл: broadcast.py
+"""
+Движок массовых рассылок (/say).
+
+Рассылка идёт в фоновой задаче, поэтому обработчик команды админа сразу освобождается.
+- Одновременно в полёте не больше `concurrency` запросов (семафор).
+- Общий темп ограничен token bucket под глобальный лимит Telegram (~30 сообщений/с),
+  а каждому чату - не чаще одного сообщения в `per_chat_interval` секунд.
+- На RetryAfter вся рассылка замирает на указанное Telegram время, и сообщение
+  отправляется повторно; временные сетевые ошибки повторяются с нарастающей паузой.
+- Задания и статус каждого получателя хранятся в локальной базе SQLite (BroadcastStore):
+  после перезапуска незавершённые рассылки продолжаются с места остановки, а ID
+  отправленных сообщений позволяют потом отредактировать или удалить рассылку целиком.
+- Ошибки доставки классифицируются: пользователи, заблокировавшие бота или удалённые,
+  помечаются недоступными и не попадают в следующие рассылки, пока снова не напишут боту.
+"""
+
+# --- 1. ИМПОРТЫ ---
+
+import asyncio
+import logging
+import sqlite3
+import threading
+import time
+from datetime import timedelta
+
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError
+
+# Импорты для тайп-хинтинга
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+
+# --- 2. НАСТРОЙКИ И КОНСТАНТЫ ---
+
+logger = logging.getLogger(__name__)
+
+# Немного ниже официального лимита в 30 сообщений в секунду
+DEFAULT_GLOBAL_RATE = 25.0
+DEFAULT_CONCURRENCY = 20
+DEFAULT_PER_CHAT_INTERVAL = 1.0
+# Сколько раз повторять одно сообщение при RetryAfter/сетевых ошибках
+MAX_SEND_ATTEMPTS = 5
+# Когда словарь ограничителей по чатам разрастается, из него выбрасываются простаивающие
+CHAT_BUCKETS_SWEEP_SIZE = 10000
+# Как часто результаты доставки сбрасываются в базу. Это окно, в котором после падения
+# сообщение может уйти получателю повторно.
+RESULTS_FLUSH_INTERVAL = 1.0
+
+# Виды заданий: новая рассылка, правка и удаление уже отправленных сообщений
+KIND_SEND = 'send'
+KIND_EDIT = 'edit'
+KIND_DELETE = 'delete'
+
+# Статусы заданий и получателей
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+DELIVERY_PENDING = 'pending'
+DELIVERY_SENT = 'sent'
+DELIVERY_FAILED = 'failed'
+
+# Причины, по которым получатель считается недоступным
+UNREACHABLE_BLOCKED = 'blocked'
+UNREACHABLE_CHAT_NOT_FOUND = 'chat_not_found'
+
+
+def classify_delivery_error(error: TelegramError) -> Optional[str]:
+    """
+    Определяет, означает ли ошибка, что чат недоступен насовсем.
+
+    Returns:
+        Optional[str]: Причина недоступности или None, если ошибка разовая
+        (сообщение слишком длинное, сообщение уже удалено и т.п.).
+    """
+    if isinstance(error, Forbidden):
+        # Бот заблокирован, пользователь удалён или бот исключён из чата
+        return UNREACHABLE_BLOCKED
+    if isinstance(error, BadRequest) and "chat not found" in str(error).lower():
+        return UNREACHABLE_CHAT_NOT_FOUND
+    return None
+
+
+# --- 3. ОГРАНИЧИТЕЛЬ СКОРОСТИ ---
+
+class TokenBucket:
+    """
+    Token bucket для asyncio: не больше `rate` операций в секунду с запасом `capacity`.
+    Все ожидающие корутины обслуживаются по очереди благодаря замку.
+    """
+    def __init__(self, rate: float, capacity: float = 1.0):
+        self._rate = rate
+        self._capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        # До этого момента (по time.monotonic) токены не выдаются - см. pause
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self._capacity, self._tokens + (now - self._updated) * self._rate)
+        self._updated = now
+
+    async def acquire(self) -> None:
+        """Ждёт, пока появится свободный токен, и забирает его."""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._refill(now)
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self._rate)
+
+    def pause(self, seconds: float) -> None:
+        """Запрещает выдачу токенов на `seconds` секунд (используется при RetryAfter)."""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
+
+    def is_idle(self) -> bool:
+        """Токены полностью восстановились - ограничитель можно выбросить без потери точности."""
+        self._refill(time.monotonic())
+        return self._tokens >= self._capacity and not self._lock.locked()
+
+
+# --- 4. ОЧЕРЕДЬ РАССЫЛОК НА ДИСКЕ ---
+
+class BroadcastStore:
+    """
+    Очередь рассылок в локальном SQLite (режим WAL): задание и строка на каждого
+    получателя со статусом доставки и ID отправленного сообщения.
+    Методы синхронные и потокобезопасные; движок вызывает их через asyncio.to_thread.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS broadcasts ("
+            " job_id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " kind TEXT NOT NULL,"
+            " text TEXT,"
+            " source_job_id INTEGER,"
+            " status TEXT NOT NULL,"
+            " created_at INTEGER NOT NULL,"
+            " status_chat_id INTEGER,"
+            " status_message_id INTEGER"
+            ")"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS deliveries ("
+            " job_id INTEGER NOT NULL,"
+            " chat_id INTEGER NOT NULL,"
+            " status TEXT NOT NULL,"
+            " message_id INTEGER,"
+            " error TEXT,"
+            " PRIMARY KEY (job_id, chat_id)"
+            ") WITHOUT ROWID"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS unreachable ("
+            " chat_id INTEGER PRIMARY KEY,"
+            " reason TEXT NOT NULL,"
+            " since INTEGER NOT NULL"
+            ")"
+        )
+        self._conn.commit()
+
+    def create_job(self, kind: str, text: Optional[str], recipients: Iterable[Tuple[int, Optional[int]]],
+                   status_chat_id: Optional[int] = None, status_message_id: Optional[int] = None,
+                   source_job_id: Optional[int] = None) -> int:
+        """
+        Создаёт задание и строки получателей одной транзакцией.
+
+        Args:
+            recipients (Iterable[Tuple[int, Optional[int]]]): Пары (ID чата, ID сообщения);
+                ID сообщения задан для правки/удаления уже отправленной рассылки.
+
+        Returns:
+            int: ID задания.
+        """
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                "INSERT INTO broadcasts (kind, text, source_job_id, status, created_at, status_chat_id, status_message_id)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (kind, text, source_job_id, JOB_RUNNING, int(time.time()), status_chat_id, status_message_id)
+            )
+            job_id = cursor.lastrowid
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO deliveries (job_id, chat_id, status, message_id) VALUES (?, ?, ?, ?)",
+                ((job_id, chat_id, DELIVERY_PENDING, message_id) for chat_id, message_id in recipients)
+            )
+        return job_id
+
+    def get_job(self, job_id: int) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT job_id, kind, text, source_job_id, status, created_at, status_chat_id, status_message_id"
+                " FROM broadcasts WHERE job_id = ?", (job_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        keys = ('job_id', 'kind', 'text', 'source_job_id', 'status', 'created_at', 'status_chat_id', 'status_message_id')
+        return dict(zip(keys, row))
+
+    def unfinished_jobs(self) -> List[int]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT job_id FROM broadcasts WHERE status = ? ORDER BY job_id", (JOB_RUNNING,)
+            ).fetchall()
+        return [job_id for (job_id,) in rows]
+
+    def pending(self, job_id: int) -> List[Tuple[int, Optional[int]]]:
+        """Получатели, которым сообщение ещё не доставлено: пары (ID чата, ID сообщения)."""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT chat_id, message_id FROM deliveries WHERE job_id = ? AND status = ?",
+                (job_id, DELIVERY_PENDING)
+            ).fetchall()
+
+    def delivered(self, job_id: int) -> List[Tuple[int, int]]:
+        """Получатели с доставленным сообщением: пары (ID чата, ID сообщения)."""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT chat_id, message_id FROM deliveries"
+                " WHERE job_id = ? AND status = ? AND message_id IS NOT NULL",
+                (job_id, DELIVERY_SENT)
+            ).fetchall()
+
+    def counts(self, job_id: int) -> Dict[str, int]:
+        """Число получателей задания по статусам доставки."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT status, COUNT(*) FROM deliveries WHERE job_id = ? GROUP BY status", (job_id,)
+            ).fetchall()
+        return dict(rows)
+
+    def record_results(self, job_id: int, results: List[Tuple[int, str, Optional[int], Optional[str]]],
+                       unreachable: Optional[Dict[int, str]] = None) -> None:
+        """
+        Сохраняет пачку результатов доставки: (ID чата, статус, ID сообщения, ошибка),
+        и в той же транзакции - чаты, оказавшиеся недоступными (ID чата -> причина).
+        """
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "UPDATE deliveries SET status = ?, message_id = COALESCE(?, message_id), error = ?"
+                " WHERE job_id = ? AND chat_id = ?",
+                ((status, message_id, error, job_id, chat_id) for chat_id, status, message_id, error in results)
+            )
+            if unreachable:
+                now = int(time.time())
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO unreachable (chat_id, reason, since) VALUES (?, ?, ?)",
+                    ((chat_id, reason, now) for chat_id, reason in unreachable.items())
+                )
+
+    def unreachable_ids(self) -> List[int]:
+        with self._lock:
+            return [chat_id for (chat_id,) in self._conn.execute("SELECT chat_id FROM unreachable")]
+
+    def clear_unreachable(self, chat_id: int) -> None:
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM unreachable WHERE chat_id = ?", (chat_id,))
+
+    def finish_job(self, job_id: int) -> None:
+        with self._lock, self._conn:
+            self._conn.execute("UPDATE broadcasts SET status = ? WHERE job_id = ?", (JOB_DONE, job_id))
+
+    def recent_jobs(self, limit: int = 10) -> List[Dict[str, Any]]:
+        """Последние задания со счётчиками доставки (для списка рассылок у админа)."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT b.job_id, b.kind, b.text, b.status, b.created_at,"
+                " SUM(d.status = ?), SUM(d.status = ?), COUNT(d.chat_id)"
+                " FROM broadcasts b LEFT JOIN deliveries d ON d.job_id = b.job_id"
+                " GROUP BY b.job_id ORDER BY b.job_id DESC LIMIT ?",
+                (DELIVERY_SENT, DELIVERY_FAILED, limit)
+            ).fetchall()
+        keys = ('job_id', 'kind', 'text', 'status', 'created_at', 'sent', 'failed', 'total')
+        return [dict(zip(keys, row)) for row in rows]
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+# --- 5. ЗАДАНИЕ РАССЫЛКИ ---
+
+class BroadcastJob:
+    """
+    Состояние одной рассылки в памяти: оставшиеся получатели, счётчики для отчёта
+    о прогрессе, ещё не сохранённые результаты и фоновая задача.
+    """
+    def __init__(self, record: Dict[str, Any], pending: List[Tuple[int, Optional[int]]], counts: Dict[str, int]):
+        self.job_id: int = record['job_id']
+        self.kind: str = record['kind']
+        self.text: Optional[str] = record['text']
+        self.status_chat_id: Optional[int] = record['status_chat_id']
+        self.status_message_id: Optional[int] = record['status_message_id']
+        self.pending = pending
+        self.sent = counts.get(DELIVERY_SENT, 0)
+        self.failed = counts.get(DELIVERY_FAILED, 0)
+        self.total = sum(counts.values())
+        # Уже обработанные до (пере)запуска - не учитываются в скорости
+        self._done_at_start = self.sent + self.failed
+        self.results: List[Tuple[int, str, Optional[int], Optional[str]]] = []
+        # Чаты, оказавшиеся недоступными в этом запуске (ещё не сохранённые)
+        self.unreachable: Dict[int, str] = {}
+        # Сколько получателей исключено при запуске как недоступные
+        self.skipped = 0
+        self.started_at = time.monotonic()
+        self.finished_at: Optional[float] = None
+        self.task: Optional[asyncio.Task] = None
+
+    @property
+    def remaining(self) -> int:
+        return self.total - self.sent - self.failed
+
+    @property
+    def done(self) -> bool:
+        return self.finished_at is not None
+
+    @property
+    def elapsed(self) -> float:
+        return (self.finished_at or time.monotonic()) - self.started_at
+
+    @property
+    def throughput(self) -> float:
+        """Обработано сообщений в секунду в текущем запуске."""
+        elapsed = self.elapsed
+        return (self.sent + self.failed - self._done_at_start) / elapsed if elapsed > 0 else 0.0
+
+
+ProgressCallback = Callable[[Any, BroadcastJob], Awaitable[None]]
+
+
+# --- 6. ДВИЖОК РАССЫЛОК ---
+
+class BroadcastEngine:
+    """
+    Запускает рассылки в фоне с ограничением параллельности и скорости.
+    Ограничители общие для всех рассылок, так что две одновременные рассылки
+    вместе не превысят лимит Telegram.
+    """
+    def __init__(self, store: BroadcastStore, on_progress: Optional[ProgressCallback] = None,
+                 concurrency: int = DEFAULT_CONCURRENCY, global_rate: float = DEFAULT_GLOBAL_RATE,
+                 per_chat_interval: float = DEFAULT_PER_CHAT_INTERVAL, progress_interval: float = 5.0):
+        """
+        Args:
+            store (BroadcastStore): Очередь рассылок на диске.
+            on_progress (Optional[ProgressCallback]): Корутина (bot, job), которая периодически и по
+                завершении получает задание (например, чтобы обновить сообщение со статусом).
+            concurrency (int): Максимум одновременных запросов к Telegram.
+            global_rate (float): Максимум сообщений в секунду для всего бота.
+            per_chat_interval (float): Минимальный интервал между сообщениями в один чат (в секундах).
+            progress_interval (float): Как часто вызывать колбэк прогресса (в секундах).
+        """
+        self._store = store
+        self._on_progress = on_progress
+        self._concurrency = concurrency
+        self._global_rate = global_rate
+        self._per_chat_interval = per_chat_interval
+        self._progress_interval = progress_interval
+        # Ограничители создаются лениво: им нужен работающий цикл событий
+        self._global_bucket: Optional[TokenBucket] = None
+        self._chat_buckets: Dict[int, TokenBucket] = {}
+        self._jobs: Dict[int, BroadcastJob] = {}
+        # Недоступные чаты (заблокировали бота и т.п.): исключаются из рассылок без запроса к Telegram
+        self._unreachable: Set[int] = set(store.unreachable_ids())
+
+    @property
+    def jobs(self) -> List[BroadcastJob]:
+        return list(self._jobs.values())
+
+    @property
+    def store(self) -> BroadcastStore:
+        return self._store
+
+    async def _launch(self, bot, job_id: int) -> Optional[BroadcastJob]:
+        """Поднимает задание из базы и запускает его фоновую задачу."""
+        record = await asyncio.to_thread(self._store.get_job, job_id)
+        if record is None:
+            return None
+        pending = await asyncio.to_thread(self._store.pending, job_id)
+        counts = await asyncio.to_thread(self._store.counts, job_id)
+        if self._global_bucket is None:
+            self._global_bucket = TokenBucket(self._global_rate, capacity=self._global_rate)
+        job = BroadcastJob(record, pending, counts)
+        self._jobs[job.job_id] = job
+        job.task = asyncio.create_task(self._run(bot, job), name=f"broadcast-{job.job_id}")
+        return job
+
+    @property
+    def unreachable_count(self) -> int:
+        return len(self._unreachable)
+
+    def is_unreachable(self, chat_id: int) -> bool:
+        return chat_id in self._unreachable
+
+    async def mark_reachable(self, chat_id: int) -> None:
+        """Возвращает чат в рассылки (пользователь снова написал боту). Дёшево, если чат и так доступен."""
+        if chat_id in self._unreachable:
+            self._unreachable.discard(chat_id)
+            await asyncio.to_thread(self._store.clear_unreachable, chat_id)
+            logger.info(f"Пользователь {chat_id} снова доступен для рассылок.")
+
+    async def start(self, bot, recipients: Iterable[int], text: str,
+                    status_chat_id: Optional[int] = None, status_message_id: Optional[int] = None) -> BroadcastJob:
+        """
+        Сохраняет новую рассылку в очередь и запускает её в фоне.
+
+        Args:
+            bot: Экземпляр telegram.Bot.
+            recipients (Iterable[int]): ID чатов получателей.
+            text (str): Текст сообщения.
+            status_chat_id, status_message_id: Сообщение, в котором показывается прогресс.
+        """
+        recipients = list(recipients)
+        # Недоступные чаты отсеиваются до постановки в очередь: на них не тратится лимит Telegram
+        reachable = [(chat_id, None) for chat_id in recipients if chat_id not in self._unreachable]
+        job_id = await asyncio.to_thread(
+            self._store.create_job, KIND_SEND, text, reachable, status_chat_id, status_message_id
+        )
+        job = await self._launch(bot, job_id)
+        job.skipped = len(recipients) - len(reachable)
+        return job
+
+    async def start_followup(self, bot, source_job_id: int, kind: str, text: Optional[str] = None,
+                             status_chat_id: Optional[int] = None,
+                             status_message_id: Optional[int] = None) -> Optional[BroadcastJob]:
+        """
+        Правит (KIND_EDIT) или удаляет (KIND_DELETE) все доставленные сообщения рассылки `source_job_id`.
+        Само действие - тоже задание в очереди, поэтому оно переживает перезапуск.
+
+        Returns:
+            Optional[BroadcastJob]: Задание или None, если исходной рассылки нет.
+        """
+        source = await asyncio.to_thread(self._store.get_job, source_job_id)
+        if source is None or source['kind'] != KIND_SEND:
+            return None
+        delivered = await asyncio.to_thread(self._store.delivered, source_job_id)
+        delivered = [(chat_id, message_id) for chat_id, message_id in delivered if chat_id not in self._unreachable]
+        job_id = await asyncio.to_thread(
+            self._store.create_job, kind, text, delivered, status_chat_id, status_message_id, source_job_id
+        )
+        return await self._launch(bot, job_id)
+
+    async def resume(self, bot) -> List[BroadcastJob]:
+        """Продолжает рассылки, прерванные остановкой или падением бота. Вызывается при старте."""
+        jobs = []
+        for job_id in await asyncio.to_thread(self._store.unfinished_jobs):
+            job = await self._launch(bot, job_id)
+            if job is not None:
+                logger.info(f"Рассылка #{job_id} возобновлена: осталось {job.remaining} из {job.total}.")
+                jobs.append(job)
+        return jobs
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) >= CHAT_BUCKETS_SWEEP_SIZE:
+                self._chat_buckets = {cid: b for cid, b in self._chat_buckets.items() if not b.is_idle()}
+            bucket = self._chat_buckets[chat_id] = TokenBucket(1 / self._per_chat_interval)
+        return bucket
+
+    @staticmethod
+    async def _deliver(bot, job: BroadcastJob, chat_id: int, message_id: Optional[int]) -> Optional[int]:
+        """Выполняет действие задания для одного получателя. Возвращает ID отправленного сообщения."""
+        if job.kind == KIND_SEND:
+            message = await bot.send_message(chat_id=chat_id, text=job.text)
+            return message.message_id
+        if job.kind == KIND_EDIT:
+            try:
+                await bot.edit_message_text(job.text, chat_id=chat_id, message_id=message_id)
+            except BadRequest as e:
+                # Повтор после перезапуска: сообщение уже исправлено
+                if "not modified" not in str(e).lower():
+                    raise
+            return message_id
+        await bot.delete_message(chat_id=chat_id, message_id=message_id)
+        return message_id
+
+    async def _send(self, bot, job: BroadcastJob, chat_id: int, message_id: Optional[int]) -> None:
+        """Обрабатывает одного получателя с учётом лимитов и повторов."""
+        error = None
+        for attempt in range(1, MAX_SEND_ATTEMPTS + 1):
+            await self._chat_bucket(chat_id).acquire()
+            await self._global_bucket.acquire()
+            try:
+                message_id = await self._deliver(bot, job, chat_id, message_id)
+                job.sent += 1
+                job.results.append((chat_id, DELIVERY_SENT, message_id, None))
+                return
+            except RetryAfter as e:
+                retry_after = e.retry_after
+                delay = retry_after.total_seconds() if isinstance(retry_after, timedelta) else float(retry_after)
+                logger.warning(f"Рассылка #{job.job_id}: Telegram просит подождать {delay} с.")
+                # Флуд-контроль касается всего бота - замораживаем общий ограничитель
+                self._global_bucket.pause(delay)
+                error = str(e)
+            except TelegramError as e:
+                error = str(e)
+                # BadRequest в PTB - подкласс NetworkError, но это постоянная ошибка запроса
+                if isinstance(e, NetworkError) and not isinstance(e, BadRequest):
+                    # Временная сетевая ошибка (в т.ч. TimedOut): повторяем с нарастающей паузой
+                    logger.warning(f"Рассылка #{job.job_id}: сетевая ошибка для {chat_id} (попытка {attempt}): {e}")
+                    await asyncio.sleep(2 ** attempt)
+                    continue
+                reason = classify_delivery_error(e)
+                if reason is not None:
+                    # Повторять бессмысленно: запоминаем чат, чтобы не тратить на него следующие рассылки
+                    logger.info(f"Пользователь {chat_id} недоступен ({reason}): {e}")
+                    self._unreachable.add(chat_id)
+                    job.unreachable[chat_id] = reason
+                else:
+                    logger.error(f"Не удалось отправить сообщение пользователю {chat_id}: {e}")
+                break
+            except Exception as e:
+                # Ошибка одного получателя не должна обрывать всю рассылку
+                logger.error(f"Рассылка #{job.job_id}: ошибка при обработке получателя {chat_id}: {e}")
+                error = str(e)
+                break
+        job.failed += 1
+        job.results.append((chat_id, DELIVERY_FAILED, None, error))
+
+    async def _flush_results(self, job: BroadcastJob) -> bool:
+        """Сбрасывает накопленные результаты в базу. False - не удалось, результаты остались в памяти."""
+        results, job.results = job.results, []
+        unreachable, job.unreachable = job.unreachable, {}
+        if not results:
+            return True
+        try:
+            await asyncio.to_thread(self._store.record_results, job.job_id, results, unreachable)
+        except sqlite3.Error as e:
+            logger.error(f"Рассылка #{job.job_id}: не удалось сохранить результаты доставки: {e}")
+            # Вернём их, чтобы записать при следующем сбросе
+            job.results[:0] = results
+            job.unreachable = {**unreachable, **job.unreachable}
+            return False
+        return True
+
+    async def _report_progress(self, bot, job: BroadcastJob) -> None:
+        try:
+            await self._on_progress(bot, job)
+        except Exception as e:
+            logger.warning(f"Рассылка #{job.job_id}: не удалось отправить отчёт о прогрессе: {e}")
+
+    async def _ticker(self, bot, job: BroadcastJob) -> None:
+        """Периодически сохраняет результаты доставки и сообщает о прогрессе."""
+        last_report = time.monotonic()
+        while True:
+            await asyncio.sleep(RESULTS_FLUSH_INTERVAL)
+            await self._flush_results(job)
+            if self._on_progress and time.monotonic() - last_report >= self._progress_interval:
+                last_report = time.monotonic()
+                await self._report_progress(bot, job)
+
+    async def _run(self, bot, job: BroadcastJob) -> None:
+        semaphore = asyncio.Semaphore(self._concurrency)
+        in_flight: Set[asyncio.Task] = set()
+        ticker = asyncio.create_task(self._ticker(bot, job))
+        logger.info(f"Рассылка #{job.job_id} ({job.kind}) запущена: {job.remaining} получателей.")
+        try:
+            for chat_id, message_id in job.pending:
+                # Задачи создаются по мере освобождения семафора - в памяти не больше `concurrency` штук
+                await semaphore.acquire()
+                task = asyncio.create_task(self._send(bot, job, chat_id, message_id))
+                in_flight.add(task)
+                task.add_done_callback(in_flight.discard)
+                task.add_done_callback(lambda _: semaphore.release())
+            if in_flight:
+                for result in await asyncio.gather(*in_flight, return_exceptions=True):
+                    if isinstance(result, Exception):
+                        logger.error(f"Рассылка #{job.job_id}: необработанная ошибка отправки: {result}")
+        except asyncio.CancelledError:
+            # Остановка бота: задание остаётся незавершённым в базе и продолжится при следующем запуске
+            for task in in_flight:
+                task.cancel()
+            await asyncio.gather(*in_flight, return_exceptions=True)
+            raise
+        finally:
+            ticker.cancel()
+            job.finished_at = time.monotonic()
+            self._jobs.pop(job.job_id, None)
+            flushed = await self._flush_results(job)
+        if not flushed:
+            # Задание остаётся незавершённым в базе: неотмеченные получатели будут обработаны после перезапуска
+            logger.error(f"Рассылка #{job.job_id} остановлена: результаты доставки не сохранены.")
+            return
+        await asyncio.to_thread(self._store.finish_job, job.job_id)
+        logger.info(
+            f"Рассылка #{job.job_id} завершена: успешно {job.sent}, ошибок {job.failed}, "
+            f"{job.throughput:.1f} сообщ./с."
+        )
+        if self._on_progress:
+            await self._report_progress(bot, job)
+
+    async def aclose(self) -> None:
+        """Останавливает все незавершённые рассылки (при выключении бота); они продолжатся после перезапуска."""
+        tasks = [job.task for job in self.jobs if job.task]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,96 @@
+# Файл: callbacks.py
+"""
+Диспетчер колбэков инлайн-кнопок.
+
+Вместо цепочки CallbackQueryHandler, каждый из которых проверяет callback_data своим
+регулярным выражением, используется один обработчик:
+- callback_data разбирается по ':' один раз; результат (действие и найденный обработчик)
+  запоминается в LRU-кэше, ведь набор кнопок у бота ограничен;
+- маршрут ищется по таблице префиксов (кортеж сегментов -> обработчик), от самого
+  длинного к короткому, так что 'game:play:blackjack' можно обработать отдельно от 'game:play';
+- остаток callback_data после маршрута попадает в context.args, как аргументы команды
+  у CommandHandler, и обработчикам больше не нужно заново делать split.
+"""
+
+# --- 1. ИМПОРТЫ ---
+
+import logging
+from functools import lru_cache
+
+from telegram import Update
+from telegram.ext import BaseHandler, ContextTypes
+
+# Импорты для тайп-хинтинга
+from typing import Any, Awaitable, Callable, Dict, NamedTuple, Optional, Tuple
+
+
+# --- 2. НАСТРОЙКИ И КОНСТАНТЫ ---
+
+logger = logging.getLogger(__name__)
+
+SEPARATOR = ":"
+# Сколько разобранных callback_data держать в кэше
+ACTION_CACHE_SIZE = 4096
+
+CallbackFunction = Callable[[Update, ContextTypes.DEFAULT_TYPE], Awaitable[Any]]
+
+
+class CallbackAction(NamedTuple):
+    """Разобранная callback_data: маршрут (например, 'game:modify') и оставшиеся сегменты."""
+    route: str
+    args: Tuple[str, ...]
+
+
+# --- 3. ДИСПЕТЧЕР ---
+
+class CallbackDispatcher(BaseHandler):
+    """
+    Обработчик всех колбэков с таблицей маршрутов. Маршруты регистрируются до запуска
+    бота через `register`; callback_data без подходящего маршрута не обрабатывается,
+    как и раньше при отсутствии подходящего шаблона.
+    """
+    def __init__(self, cache_size: int = ACTION_CACHE_SIZE):
+        super().__init__(self._not_routed)
+        self._routes: Dict[Tuple[str, ...], CallbackFunction] = {}
+        self._max_depth = 0
+        self._resolve = lru_cache(maxsize=cache_size)(self._parse)
+
+    @staticmethod
+    async def _not_routed(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        # Не вызывается: handle_update всегда берёт обработчик из найденного маршрута
+        pass
+
+    def register(self, route: str, callback: CallbackFunction) -> None:
+        """Связывает маршрут ('nav', 'game:play:dice' и т.п.) с обработчиком."""
+        key = tuple(route.split(SEPARATOR))
+        if key in self._routes:
+            logger.warning(f"Маршрут колбэка '{route}' переопределён.")
+        self._routes[key] = callback
+        self._max_depth = max(self._max_depth, len(key))
+        # Уже разобранные данные могли попасть на более короткий маршрут
+        self._resolve.cache_clear()
+
+    def _parse(self, data: str) -> Optional[Tuple[CallbackAction, CallbackFunction]]:
+        parts = tuple(data.split(SEPARATOR))
+        for depth in range(min(len(parts), self._max_depth), 0, -1):
+            callback = self._routes.get(parts[:depth])
+            if callback is not None:
+                return CallbackAction(SEPARATOR.join(parts[:depth]), parts[depth:]), callback
+        return None
+
+    def check_update(self, update: object) -> Optional[Tuple[CallbackAction, CallbackFunction]]:
+        if isinstance(update, Update) and update.callback_query:
+            data = update.callback_query.data
+            if isinstance(data, str):
+                return self._resolve(data)
+        return None
+
+    def collect_additional_context(self, context: ContextTypes.DEFAULT_TYPE, update: Update,
+                                   application: Any, check_result: Tuple[CallbackAction, CallbackFunction]) -> None:
+        context.args = list(check_result[0].args)
+
+    async def handle_update(self, update: Update, application: Any,
+                            check_result: Tuple[CallbackAction, CallbackFunction],
+                            context: ContextTypes.DEFAULT_TYPE) -> Any:
+        self.collect_additional_context(context, update, application, check_result)
+        return await check_result[1](update, context)
@@ -0,0 +1,87 @@
+# Файл: flood.py
+"""
+Защита от флуда: token bucket на каждого пользователя.
+
+Каждый пользователь может прислать до `burst` апдейтов подряд, дальше - не чаще `rate`
+в секунду. Состояние ведра - два числа (токены и время последнего обновления) в
+OrderedDict, упорядоченном по последней активности. Ведро, которое не трогали дольше
+времени полного восстановления (burst / rate), снова полное и ничем не отличается от
+отсутствующего, поэтому такие записи удаляются с начала словаря по ходу работы:
+память занимают только активные сейчас пользователи.
+"""
+
+# --- 1. ИМПОРТЫ ---
+
+import time
+from collections import OrderedDict
+
+# Импорты для тайп-хинтинга
+from typing import List, Optional
+
+
+# --- 2. НАСТРОЙКИ И КОНСТАНТЫ ---
+
+# Жёсткий предел числа отслеживаемых пользователей на случай очень большого потока
+MAX_TRACKED_USERS = 100000
+# Сколько просроченных записей удалять за один вызов (чтобы очистка не давала пиков задержки)
+EXPIRE_BATCH = 16
+
+
+# --- 3. ОГРАНИЧИТЕЛЬ ---
+
+class FloodGuard:
+    """
+    Ограничитель частоты апдейтов по пользователям. Не потокобезопасен:
+    вызывается только из цикла событий бота.
+    """
+    def __init__(self, rate: float, burst: int, max_users: int = MAX_TRACKED_USERS):
+        """
+        Args:
+            rate (float): Сколько апдейтов в секунду разрешено в среднем.
+            burst (int): Сколько апдейтов можно прислать подряд без ожидания.
+            max_users (int): Максимум одновременно отслеживаемых пользователей.
+        """
+        self._rate = rate
+        self._burst = float(burst)
+        self._idle_after = burst / rate
+        self._max_users = max_users
+        # ID пользователя -> [токены, время обновления]; порядок - от давно активных к недавним
+        self._buckets: "OrderedDict[int, List[float]]" = OrderedDict()
+        self.dropped = 0
+
+    def allow(self, user_id: int, now: Optional[float] = None) -> bool:
+        """Забирает токен пользователя; False - апдейт нужно отбросить."""
+        if now is None:
+            now = time.monotonic()
+        self._expire(now)
+
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            self._buckets[user_id] = [self._burst - 1, now]
+            if len(self._buckets) > self._max_users:
+                self._buckets.popitem(last=False)
+            return True
+
+        self._buckets.move_to_end(user_id)
+        tokens = min(self._burst, bucket[0] + (now - bucket[1]) * self._rate)
+        bucket[1] = now
+        if tokens >= 1:
+            bucket[0] = tokens - 1
+            return True
+        bucket[0] = tokens
+        self.dropped += 1
+        return False
+
+    def _expire(self, now: float) -> None:
+        """Удаляет несколько самых давних записей, чьи вёдра уже полностью восстановились."""
+        buckets = self._buckets
+        for _ in range(EXPIRE_BATCH):
+            if not buckets:
+                return
+            user_id, bucket = next(iter(buckets.items()))
+            if now - bucket[1] < self._idle_after:
+                return
+            del buckets[user_id]
+
+    def __len__(self) -> int:
+        return len(self._buckets)
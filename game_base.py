@@ -2,34 +2,58 @@
 """
 Содержит базовые классы для управления данными пользователей и игровой логикой.
 
-- UserDataManager: Класс для чтения, записи и управления данными пользователей в XML-файле.
+- UserRecord: Компактная запись пользователя (__slots__, время в epoch-секундах)
+  с интерфейсом словаря для существующего кода.
+- LazyUserMap: Словарь пользователей, который разбирает записи из снимка только при первом обращении.
+- UserDataManager: Класс для чтения, записи и управления данными пользователей
+  поверх подключаемого хранилища (см. storage.py).
 - Game: Абстрактный базовый класс, определяющий "контракт" для всех мини-игр.
 """
 
 # --- 1. ИМПОРТЫ ---
 
+import asyncio
 import logging
 import random
+import sys
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from contextlib import asynccontextmanager
 from datetime import datetime, timedelta
 from abc import ABC, abstractmethod
-import requests
-import json
-import threading
 from telegram.ext import JobQueue
 
 # Импорты для тайп-хинтинга (не влияют на исполнение, но помогают в разработке)
-from typing import Dict, Any, Tuple, Optional
+from typing import AsyncIterator, Callable, Dict, Any, Iterable, Iterator, List, Set, Tuple, Optional
 
 # Импорты Telegram
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes
 
+# Импорты из нашего проекта
+from storage import StorageBackend, StorageError, Snapshot, SnapshotIndex
+from journal import WriteAheadJournal
+from activity import ActivityBuffer
+from ledger import BalanceLedger, LedgerEntry, encode_reason
+from keyboards import KeyboardRows, game_keyboards
+from callbacks import CallbackDispatcher
+from user_stats import FactionIndex, UserStats
+
 
 # --- 2. НАСТРОЙКИ И КОНСТАНТЫ ---
 
 # Настройка логирования для этого модуля
 logger = logging.getLogger(__name__)
 
+# Текущая версия схемы записи пользователя. Увеличивается вместе с добавлением
+# миграции в реестр USER_MIGRATIONS (см. ниже).
+SCHEMA_VERSION = 1
+
+# Сколько последних транзакций помнить для защиты от повторного списания по тому же ключу
+IDEMPOTENCY_CACHE_SIZE = 10000
+
 # Единый источник правды для структуры данных нового пользователя.
 # Чтобы добавить новое поле (например, 'achievements'), просто добавьте его сюда
 # с начальным значением. Код загрузки и сохранения подхватит его автоматически.
@@ -41,158 +65,676 @@ DEFAULT_USER_STRUCTURE = {
     'balance': 10000,                        # Тип: int. Новый пользователь начинает с нулевым балансом (или установите стартовый капитал, например, 100).
     'last_stats_request_time': None,     # Тип: str. Время еще не было запрошено.
     'last_work_time': None,              # Тип: str. Еще не работал.
-    'last_race_time': None               # Тип: str. Еще не участвовал в гонках.
+    'last_race_time': None,              # Тип: str. Еще не участвовал в гонках.
+    'schema_version': SCHEMA_VERSION     # Тип: int. Версия схемы, в которой сохранена запись.
 }
 
-# --- 3. КЛАСС УПРАВЛЕНИЯ ДАННЫМИ ---
+# Поля со временем. В памяти и в хранилище они лежат как целые epoch-секунды,
+# а через интерфейс словаря по-прежнему отдаются ISO-строками.
+TIME_FIELDS = frozenset(('first_seen', 'last_seen', 'last_stats_request_time', 'last_work_time', 'last_race_time'))
+
+
+# --- 3. КОМПАКТНАЯ ЗАПИСЬ ПОЛЬЗОВАТЕЛЯ ---
+
+def _to_epoch(value: Any) -> Optional[int]:
+    """Приводит время из любого сохранённого формата (ISO-строка, число, пусто) к epoch-секундам."""
+    if value is None or value == '':
+        return None
+    if isinstance(value, (int, float)):
+        return int(value)
+    return int(datetime.fromisoformat(value).timestamp())
+
+
+# --- Миграции схемы ---
+# Реестр: версия N -> функция, переводящая "сырой" словарь записи из версии N-1 в N.
+# Миграции применяются один раз при загрузке записи (или при первом обращении
+# в ленивом режиме), после чего запись сохраняется уже в новой версии.
+# Недостающие поля отдельной миграции не требуют: их заполняет UserRecord значениями
+# из DEFAULT_USER_STRUCTURE.
+USER_MIGRATIONS: Dict[int, Callable[[Dict[str, Any]], Dict[str, Any]]] = {}
+
+
+def user_migration(version: int) -> Callable:
+    """Декоратор: регистрирует функцию как миграцию записи до версии `version`."""
+    def decorator(func: Callable[[Dict[str, Any]], Dict[str, Any]]) -> Callable[[Dict[str, Any]], Dict[str, Any]]:
+        USER_MIGRATIONS[version] = func
+        return func
+    return decorator
+
+
+@user_migration(1)
+def _migrate_times_to_epoch(data: Dict[str, Any]) -> Dict[str, Any]:
+    """v1: время хранится в epoch-секундах вместо ISO-строк."""
+    for key in TIME_FIELDS:
+        if key in data:
+            data[key] = _to_epoch(data[key])
+    return data
+
+
+def migrate_user_data(data: Dict[str, Any]) -> Tuple[Dict[str, Any], bool]:
+    """
+    Доводит "сырой" словарь записи до SCHEMA_VERSION.
+
+    Returns:
+        Tuple[Dict[str, Any], bool]: Словарь в текущей версии и флаг "были применены миграции".
+    """
+    version = data.get('schema_version', 0)
+    if version >= SCHEMA_VERSION:
+        return data, False
+    data = dict(data)
+    for next_version in range(version + 1, SCHEMA_VERSION + 1):
+        data = USER_MIGRATIONS[next_version](data)
+    data['schema_version'] = SCHEMA_VERSION
+    return data, True
+
+
+class UserRecord(MutableMapping):
+    """
+    Запись одного пользователя. Поля берутся из DEFAULT_USER_STRUCTURE и хранятся
+    в __slots__ (без словаря на каждый объект), время - целыми epoch-секундами,
+    название фракции - интернированной строкой.
+
+    Для старого кода запись ведёт себя как словарь: `record['balance']`, `record.get(...)`,
+    при этом поля времени через `[]` отдаются ISO-строкой, как раньше.
+    Горячий код читает атрибуты напрямую: `record.last_work_time` - это уже epoch.
+    """
+    __slots__ = tuple(DEFAULT_USER_STRUCTURE) + ('_extra',)
+
+    def __init__(self):
+        for key, default_value in DEFAULT_USER_STRUCTURE.items():
+            setattr(self, key, _to_epoch(default_value) if key in TIME_FIELDS else default_value)
+        # Поля, которых нет в DEFAULT_USER_STRUCTURE (например, из старых версий данных)
+        self._extra: Optional[Dict[str, Any]] = None
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> 'UserRecord':
+        """
+        Создаёт запись из словаря текущей версии схемы (см. migrate_user_data).
+        Недостающие поля получают значения по умолчанию.
+        """
+        record = cls()
+        for key, value in data.items():
+            record[key] = value
+        return record
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Возвращает "сырой" словарь для хранилища (время - в epoch-секундах)."""
+        data = {key: getattr(self, key) for key in DEFAULT_USER_STRUCTURE}
+        if self._extra:
+            data.update(self._extra)
+        return data
+
+    def raw(self, key: str) -> Any:
+        """Возвращает значение поля в формате хранения (без преобразования времени в ISO)."""
+        if key in DEFAULT_USER_STRUCTURE:
+            return getattr(self, key)
+        return (self._extra or {}).get(key)
+
+    # --- Интерфейс словаря ---
+
+    def __getitem__(self, key: str) -> Any:
+        if key in DEFAULT_USER_STRUCTURE:
+            value = getattr(self, key)
+            if key in TIME_FIELDS:
+                return datetime.fromtimestamp(value).isoformat() if value is not None else DEFAULT_USER_STRUCTURE[key]
+            return value
+        if self._extra is not None and key in self._extra:
+            return self._extra[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        if key in TIME_FIELDS:
+            setattr(self, key, _to_epoch(value))
+        elif key == 'faction':
+            self.faction = sys.intern(value) if isinstance(value, str) else value
+        elif key in DEFAULT_USER_STRUCTURE:
+            setattr(self, key, value)
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+
+    def __delitem__(self, key: str) -> None:
+        if key in DEFAULT_USER_STRUCTURE:
+            # Поле из структуры удалить нельзя - возвращаем значение по умолчанию
+            self[key] = DEFAULT_USER_STRUCTURE[key]
+        elif self._extra is not None and key in self._extra:
+            del self._extra[key]
+        else:
+            raise KeyError(key)
+
+    def __contains__(self, key: object) -> bool:
+        return key in DEFAULT_USER_STRUCTURE or (self._extra is not None and key in self._extra)
+
+    def __iter__(self) -> Iterator[str]:
+        yield from DEFAULT_USER_STRUCTURE
+        if self._extra:
+            yield from self._extra
+
+    def __len__(self) -> int:
+        return len(DEFAULT_USER_STRUCTURE) + len(self._extra or ())
+
+    def get(self, key: str, default: Any = None) -> Any:
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __repr__(self) -> str:
+        return f"UserRecord({self.to_dict()!r})"
+
+
+class LazyUserMap(MutableMapping):
+    """
+    Словарь user_id -> UserRecord поверх индекса снимка.
+    При старте известны только ID пользователей; запись разбирается и превращается
+    в UserRecord при первом обращении (`users.get(...)`, `users[...]`) и дальше живёт в памяти.
+    Благодаря этому бот начинает работу за время, не зависящее от размера базы.
+    """
+    def __init__(self, index: SnapshotIndex, build_record: Callable[[int, Dict[str, Any]], UserRecord]):
+        """
+        Args:
+            index (SnapshotIndex): Индекс снимка.
+            build_record (Callable): Превращает "сырой" словарь в UserRecord (с миграциями).
+        """
+        self._index = index
+        self._build_record = build_record
+        self._records: Dict[int, UserRecord] = {}
+        # Сколько пользователей из _records отсутствуют в индексе (новые, созданные после старта)
+        self._new_count = 0
+
+    def _hydrate(self, user_id: int) -> Optional[UserRecord]:
+        raw = self._index.fetch(user_id)
+        if raw is None:
+            return None
+        record = self._records[user_id] = self._build_record(user_id, raw)
+        return record
+
+    def get(self, user_id: int, default: Any = None) -> Any:
+        record = self._records.get(user_id)
+        if record is None:
+            record = self._hydrate(user_id)
+        return record if record is not None else default
+
+    def __getitem__(self, user_id: int) -> UserRecord:
+        record = self.get(user_id)
+        if record is None:
+            raise KeyError(user_id)
+        return record
+
+    def __setitem__(self, user_id: int, record: UserRecord) -> None:
+        if user_id not in self._records and user_id not in self._index:
+            self._new_count += 1
+        self._records[user_id] = record
+
+    def __delitem__(self, user_id: int) -> None:
+        raise TypeError("Удаление пользователей не поддерживается.")
+
+    def __contains__(self, user_id: object) -> bool:
+        return user_id in self._records or user_id in self._index
+
+    def __iter__(self) -> Iterator[int]:
+        yield from self._index
+        for user_id in list(self._records):
+            if user_id not in self._index:
+                yield user_id
+
+    def __len__(self) -> int:
+        return len(self._index) + self._new_count
+
+    @property
+    def hydrated_count(self) -> int:
+        """Сколько записей уже разобрано и находится в памяти."""
+        return len(self._records)
+
+
+# --- Транзакции баланса ---
+
+class InsufficientFundsError(Exception):
+    """Списание отклонено: на балансе меньше, чем требуется."""
+    def __init__(self, balance: int, required: int):
+        super().__init__(f"Недостаточно средств: баланс {balance}, требуется {required}")
+        self.balance = balance
+        self.required = required
+
+
+class Transaction:
+    """
+    Результат транзакции баланса. Для повтора с уже использованным ключом
+    возвращается исходная транзакция с duplicate=True - деньги второй раз не двигаются.
+    """
+    __slots__ = ('key', 'user_id', 'debit', 'credit', 'balance', 'created_at', 'duplicate')
+
+    def __init__(self, key: Optional[str], user_id: int, debit: int, credit: int, balance: int):
+        self.key = key
+        self.user_id = user_id
+        self.debit = debit
+        self.credit = credit
+        # Баланс сразу после транзакции
+        self.balance = balance
+        self.created_at = int(time.time())
+        self.duplicate = False
+
+    def as_duplicate(self) -> 'Transaction':
+        """Копия транзакции для ответа на повтор (исходная запись не меняется)."""
+        copy = Transaction(self.key, self.user_id, self.debit, self.credit, self.balance)
+        copy.created_at = self.created_at
+        copy.duplicate = True
+        return copy
+
+
+# --- 4. КЛАСС УПРАВЛЕНИЯ ДАННЫМИ ---
 
 class UserDataManager:
     """
     Управляет данными пользователей с кешированием в памяти и периодическим
-    сохранением в облако JSONBin.io.
+    сохранением в выбранное хранилище (JSONBin.io, локальный SQLite и т.д.).
     """
-    def __init__(self, api_key: str, bin_id: str):
-        self._api_key = api_key
-        self._bin_id = bin_id
-        self._api_url = f"https://api.jsonbin.io/v3/b/{self._bin_id}"
-        self._headers = {'X-Master-Key': self._api_key}
+    def __init__(self, storage: StorageBackend, journal: Optional[WriteAheadJournal] = None, lazy_load: bool = False,
+                 ledger: Optional[BalanceLedger] = None):
+        """
+        Args:
+            storage (StorageBackend): Хранилище данных пользователей.
+            journal (Optional[WriteAheadJournal]): Журнал изменений для защиты от потери данных.
+            ledger (Optional[BalanceLedger]): Журнал изменений баланса для истории и аудита.
+            lazy_load (bool): Если True, при старте строится только индекс пользователей,
+                              а записи разбираются при первом обращении.
+        """
+        self._storage = storage
+        # Журнал изменений: защищает данные между сохранениями от потери при падении бота
+        self._journal = journal
+        # История изменений баланса: каждое изменение - запись с причиной и итоговым балансом
+        self._ledger = ledger
 
         # --- НОВЫЕ АТРИБУТЫ ДЛЯ ОТЛОЖЕННОГО СОХРАНЕНИЯ ---
-        self._is_dirty = False  # Флаг, который показывает, были ли изменения
-        self._save_lock = threading.Lock() # Замок, чтобы избежать гонки данных при сохранении
+        # Какие пользователи и какие их поля изменились с прошлого сохранения.
+        # Сохранение отправляет только эту дельту, поэтому его цена O(изменённых пользователей).
+        self._dirty: Dict[int, Set[str]] = {}
+        # Замок, чтобы плановое и финальное сохранения не пересекались.
+        # Создаётся лениво, уже внутри работающего цикла событий.
+        self._save_lock: Optional[asyncio.Lock] = None
+        # Буфер активности: interaction_count/last_seen применяются к записям пачкой по таймеру
+        self._activity = ActivityBuffer()
+        # Агрегаты для статистики, обновляемые за O(1) при каждом изменении записи.
+        # В ленивом режиме _stats содержит только изменения после старта, а вклад
+        # снимка (_stats_base) досчитывается в фоновом потоке и добавляется позже.
+        self._stats = UserStats()
+        self._stats_base: Optional[UserStats] = None
+        self._stats_ready = not lazy_load
+        # Индекс фракция -> подписчики. В ленивом режиме он строится тем же фоновым потоком,
+        # а смены фракций до его готовности копятся в _faction_changes (ID -> новая фракция).
+        self._factions = FactionIndex()
+        self._factions_base: Optional[FactionIndex] = None
+        self._faction_changes: Dict[int, str] = {}
+        # Замки пользователей для транзакций: ID -> [замок, число держащих/ждущих].
+        # Запись удаляется, когда замок никому не нужен.
+        self._user_locks: Dict[int, List[Any]] = {}
+        # Последние транзакции по ключу идемпотентности (ограниченный LRU)
+        self._transactions: "OrderedDict[str, Transaction]" = OrderedDict()
 
         # Загружаем данные при старте
-        self._full_data_cache = self._load_bin()
-        self.users = self._full_data_cache.get('users', {})
-        logger.info(f"UserDataManager инициализирован. Загружено {len(self.users)} пользователей.")
-
-    def _load_bin(self) -> Dict[str, Any]:
-        """Загружает ВСЁ содержимое "бина" из JSONBin.io при старте."""
-        try:
-            response = requests.get(f"{self._api_url}/latest", headers=self._headers, timeout=10)
-            response.raise_for_status()
-            data = response.json().get('record', {})
-            if 'users' in data and isinstance(data['users'], dict):
-                data['users'] = {int(k): v for k, v in data['users'].items()}
-            logger.info(f"Успешно загружены данные из JSONBin (ID: {self._bin_id})")
-            return data
-        except requests.exceptions.RequestException as e:
-            logger.error(f"Сетевая ошибка при загрузке данных: {e}. Бот не может запуститься.")
-            raise ConnectionError("Не удалось загрузить данные из облака.")
-        except (json.JSONDecodeError, KeyError, ValueError):
-            logger.warning(f"Данные в JSONBin повреждены или пусты. Начинаем с пустой базы.")
-            return {}
-
-    def _mark_as_dirty(self) -> None:
-        """
-        Приватный метод. Просто помечает данные как "измененные".
+        if lazy_load:
+            index = self._storage.open_index()
+            self.users: MutableMapping = LazyUserMap(index, self._build_record)
+            threading.Thread(
+                target=self._count_snapshot_stats, args=(index,), name="snapshot-stats", daemon=True
+            ).start()
+        else:
+            data = self._storage.load()
+            self.users = {
+                user_id: self._build_record(user_id, record) for user_id, record in data.get('users', {}).items()
+            }
+            if self._dirty:
+                logger.info(f"Схема {len(self._dirty)} записей обновлена до версии {SCHEMA_VERSION}.")
+            for user_id, record in self.users.items():
+                self._stats.add_record(record)
+                self._factions.move(user_id, None, record.faction)
+        if self._journal:
+            self._replay_journal()
+        logger.info(f"UserDataManager инициализирован ({self._storage.name}). Загружено {len(self.users)} пользователей.")
+
+    def _build_record(self, user_id: int, raw: Dict[str, Any]) -> UserRecord:
+        """Превращает загруженный словарь в UserRecord, применяя миграции схемы один раз."""
+        data, migrated = migrate_user_data(raw)
+        if migrated:
+            # Сохраним запись уже в новой версии, чтобы миграция не повторялась при каждом старте.
+            # В журнал не пишем: при падении миграция просто выполнится снова.
+            self._dirty.setdefault(user_id, set()).update(DEFAULT_USER_STRUCTURE)
+        return UserRecord.from_dict(data)
+
+    def _count_snapshot_stats(self, index: SnapshotIndex) -> None:
+        """Фоновый поток ленивого режима: считает агрегаты и индекс фракций по снимку, не сохраняя записи в памяти."""
+        base = UserStats()
+        factions = FactionIndex()
+        for user_id, raw in index.scan():
+            data, _ = migrate_user_data(raw)
+            base.add(data.get('first_seen'), data.get('last_seen'), data.get('interaction_count', 0))
+            factions.move(user_id, None, data.get('faction'))
+        # Присваивание ссылок атомарно; объединение с изменениями сделает цикл событий
+        # (см. _merge_snapshot_aggregates). Индекс присваиваем первым: готовность проверяется по _stats_base.
+        self._factions_base = factions
+        self._stats_base = base
+        logger.info(f"Агрегаты статистики по снимку подсчитаны: {base.total_users} пользователей.")
+
+    def _replay_journal(self) -> None:
+        """Проигрывает журнал поверх загруженного снимка, восстанавливая изменения после падения."""
+        replayed = 0
+        for user_id, fields in self._journal.replay():
+            record = self.users.get(user_id)
+            if record is None:
+                record = self.users[user_id] = UserRecord()
+            else:
+                self._stats.add_record(record, sign=-1)
+            old_faction = record.faction
+            record.update(fields)
+            self._stats.add_record(record)
+            if record.faction != old_faction:
+                self._on_faction_change(user_id, old_faction, record.faction)
+            # Записи уже есть в журнале, поэтому повторно их не журналируем - только помечаем для сохранения
+            self._dirty.setdefault(user_id, set()).update(fields)
+            replayed += 1
+        if replayed:
+            logger.info(f"Из журнала восстановлено {replayed} изменений ({len(self._dirty)} пользователей).")
+
+    def _mark_as_dirty(self, user_id: int, *fields: str) -> None:
+        """
+        Приватный метод. Помечает поля пользователя как "измененные"
+        и записывает их новые значения в журнал.
         Теперь это будет вызываться вместо прямого сохранения.
+        Если поля не указаны, считается изменённой вся запись.
+        """
+        fields = fields or tuple(DEFAULT_USER_STRUCTURE.keys())
+        self._dirty.setdefault(user_id, set()).update(fields)
+        if self._journal:
+            record = self.users[user_id]
+            self._journal.append(user_id, {key: record.raw(key) for key in fields})
+
+    def _take_snapshot(self) -> Tuple[Dict[int, Set[str]], Snapshot]:
         """
-        self._is_dirty = True
+        Забирает накопленную дельту и копирует записи изменившихся пользователей.
+        Выполняется синхронно в цикле событий, поэтому ни один обработчик не может
+        изменить данные посередине: снимок согласован, а его цена - O(изменённых пользователей).
+        """
+        changes, self._dirty = self._dirty, {}
+        snapshot = {user_id: self.users[user_id].to_dict() for user_id in changes if user_id in self.users}
+        return changes, snapshot
 
-    def force_save(self) -> None:
+    async def force_save(self) -> None:
         """
-        Принудительно сохраняет данные в JSONBin.io, если они были изменены.
+        Принудительно сохраняет данные в хранилище, если они были изменены.
         Этот метод будет вызываться по таймеру и при выключении бота.
+        Не блокирует цикл событий: сериализация и запись идут в фоне.
         """
+        if self._save_lock is None:
+            self._save_lock = asyncio.Lock()
         # Блокируем, чтобы избежать ситуации, когда бот выключается
         # прямо во время планового сохранения.
-        with self._save_lock:
-            if not self._is_dirty:
+        async with self._save_lock:
+            # Сначала применяем накопленную активность, чтобы она попала в снимок
+            self.flush_activity()
+            if not self._dirty:
                 # Если изменений не было, ничего не делаем
                 return
 
-            logger.info("Обнаружены изменения. Начинаю синхронизацию с JSONBin.io...")
+            # Закрываем текущий сегмент журнала: всё, что в нём есть, войдёт в этот снимок.
+            # Записи, пришедшие во время ротации, попадут в новый сегмент - это безопасно,
+            # так как журнал идемпотентен.
+            journal_segment = await asyncio.to_thread(self._journal.rotate) if self._journal else None
+            changes, snapshot = self._take_snapshot()
+            logger.info(f"Изменено пользователей: {len(changes)}. Начинаю синхронизацию с {self._storage.name}...")
             try:
-                self._full_data_cache['users'] = self.users
-                headers = {**self._headers, 'Content-Type': 'application/json'}
-                response = requests.put(self._api_url, headers=headers, json=self._full_data_cache, timeout=10)
-                response.raise_for_status()
+                await self._storage.save(snapshot)
+                logger.info(f"Синхронизация с {self._storage.name} успешно завершена.")
+                if journal_segment is not None:
+                    # Снимок сохранён - закрытые сегменты журнала больше не нужны
+                    await asyncio.to_thread(self._journal.compact, journal_segment)
+            except StorageError as e:
+                logger.error(f"КРИТИЧЕСКАЯ ОШИБКА: Не удалось сохранить данные: {e}")
+                # Возвращаем несохранённую дельту, чтобы повторить её при следующей попытке
+                for user_id, fields in changes.items():
+                    self._dirty.setdefault(user_id, set()).update(fields)
+
+    async def aclose(self) -> None:
+        """Закрывает журнал и хранилище. Вызывается после финального сохранения."""
+        if self._journal:
+            await asyncio.to_thread(self._journal.close)
+        if self._ledger:
+            await asyncio.to_thread(self._ledger.close)
+        await self._storage.aclose()
+
+    def flush_activity(self) -> None:
+        """Применяет накопленную активность к записям пользователей одной пачкой."""
+        if not len(self._activity):
+            return
+        counts, last_seen = self._activity.drain()
+        for user_id, count in counts.items():
+            record = self.users.get(user_id)
+            if record is None:
+                continue
+            self._stats.add_record(record, sign=-1)
+            record.interaction_count += count
+            record.last_seen = max(record.last_seen or 0, last_seen[user_id])
+            self._stats.add_record(record)
+            self._mark_as_dirty(user_id, 'interaction_count', 'last_seen')
+
+    async def _activity_flush_job(self, context: ContextTypes.DEFAULT_TYPE) -> None:
+        self.flush_activity()
+
+    def start_activity_flush(self, job_queue: JobQueue, interval_seconds: int = 10) -> None:
+        """
+        Запускает периодическое применение буфера активности к записям.
+        Политика сброса активности не зависит от сохранения балансов.
+        """
+        job_queue.run_repeating(
+            callback=self._activity_flush_job,
+            interval=interval_seconds,
+            name="activity_flush"
+        )
+        logger.info(f"Сброс буфера активности настроен с интервалом {interval_seconds} секунд.")
 
-                # Если сохранение прошло успешно, сбрасываем флаг
-                self._is_dirty = False
-                logger.info("Синхронизация с JSONBin.io успешно завершена.")
-            except requests.exceptions.RequestException as e:
-                logger.error(f"КРИТИЧЕСКАЯ ОШИБКА: Не удалось сохранить данные в JSONBin: {e}")
+    async def _autosave_job(self, context: ContextTypes.DEFAULT_TYPE) -> None:
+        await self.force_save()
 
     def start_autosave(self, job_queue: JobQueue, interval_seconds: int = 3600) -> None:
         """
         Запускает повторяющуюся задачу для автоматического сохранения данных.
+        Сохраняется только дельта изменений, поэтому интервал можно делать коротким.
         """
-        # Важно! Мы передаем МЕТОД, а не его вызов. `force_save`, а не `force_save()`.
+        # Важно! Мы передаем МЕТОД, а не его вызов. Корутина выполняется в том же
+        # цикле событий, что и обработчики, но не блокирует их.
         job_queue.run_repeating(
-            callback=lambda _: self.force_save(), # Используем лямбду, чтобы job_queue не передавал аргументы
+            callback=self._autosave_job,
             interval=interval_seconds,
-            name="hourly_data_save"
+            name="data_autosave"
         )
-        logger.info(f"Автосохранение данных в облако настроено с интервалом {interval_seconds} секунд.")
+        logger.info(f"Автосохранение данных настроено с интервалом {interval_seconds} секунд.")
 
     # --- ТЕПЕРЬ ВСЕ МЕТОДЫ, МЕНЯЮЩИЕ ДАННЫЕ, ВЫЗЫВАЮТ _mark_as_dirty ---
 
     def update_user_activity(self, user_id: int) -> None:
-        current_time_iso = datetime.now().isoformat()
-        made_changes = False
         if user_id not in self.users:
-            self.users[user_id] = DEFAULT_USER_STRUCTURE.copy()
-            self.users[user_id]['first_seen'] = current_time_iso
-            self.users[user_id]['interaction_count'] = 1
-            made_changes = True
-        else:
-            for key, default_value in DEFAULT_USER_STRUCTURE.items():
-                if key not in self.users[user_id]:
-                    self.users[user_id][key] = default_value
-                    made_changes = True # Обнаружили, что нужно было добавить поле
-            self.users[user_id]['interaction_count'] += 1
-        
-        self.users[user_id]['last_seen'] = current_time_iso
-        # Помечаем, что данные изменились
-        self._mark_as_dirty()
+            # Нового пользователя создаём сразу: от записи зависят баланс и кулдауны
+            now = int(time.time())
+            record = self.users[user_id] = UserRecord()
+            record.first_seen = now
+            record.interaction_count = 1
+            record.last_seen = now
+            self._stats.add_record(record)
+            # Новый пользователь: изменена вся запись
+            self._mark_as_dirty(user_id)
+            return
+
+        # Схема записи уже актуальна (миграции применены при загрузке), а сама
+        # активность копится в буфере и применяется к записи пачкой (см. flush_activity).
+        self._activity.hit(user_id)
     
-    def update_user_balance(self, user_id: int, amount_change: int) -> None:
+    def _record_balance_change(self, user_id: int, reason: str, delta: int, balance: int) -> None:
+        if self._ledger and delta:
+            self._ledger.append(user_id, reason, delta, balance)
+
+    def update_user_balance(self, user_id: int, amount_change: int, reason: str = '') -> None:
+        # Причина проверяется до изменения баланса, чтобы ошибка не оставила его без записи в журнале
+        encode_reason(reason)
         if user_id in self.users:
             current_balance = self.users[user_id].get('balance', DEFAULT_USER_STRUCTURE['balance'])
             self.users[user_id]['balance'] = current_balance + amount_change
-            self._mark_as_dirty() # <-- ИЗМЕНЕНИЕ
+            self._mark_as_dirty(user_id, 'balance')
+            self._record_balance_change(user_id, reason, amount_change, current_balance + amount_change)
         else:
             logger.warning(f"Попытка обновить баланс несуществующего пользователя: {user_id}")
     
+    @asynccontextmanager
+    async def _user_lock(self, user_id: int) -> AsyncIterator[None]:
+        entry = self._user_locks.get(user_id)
+        if entry is None:
+            entry = self._user_locks[user_id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._user_locks[user_id]
+
+    async def transact(self, user_id: int, debit: int = 0, credit: int = 0,
+                       idempotency_key: Optional[str] = None, reason: str = '') -> Transaction:
+        """
+        Атомарно списывает `debit` и зачисляет `credit` (например, ставку и выигрыш раунда).
+
+        Проверка баланса и изменение выполняются под замком пользователя одним шагом,
+        поэтому два параллельных раунда не могут оба пройти проверку и уйти в минус.
+        Повтор с тем же ключом (повторная доставка колбэка, двойное нажатие) ничего не
+        меняет и возвращает исходную транзакцию с duplicate=True. `reason` (обычно ID игры)
+        попадает в журнал баланса.
+
+        Raises:
+            InsufficientFundsError: Если на балансе меньше `debit`. Баланс при этом не меняется.
+            ValueError: Если `reason` не помещается в запись журнала баланса.
+        """
+        encode_reason(reason)
+        async with self._user_lock(user_id):
+            if idempotency_key is not None:
+                previous = self._transactions.get(idempotency_key)
+                if previous is not None:
+                    self._transactions.move_to_end(idempotency_key)
+                    return previous.as_duplicate()
+
+            if user_id not in self.users:
+                self.update_user_activity(user_id)
+            record = self.users[user_id]
+            balance = record.balance
+            if debit > balance:
+                raise InsufficientFundsError(balance, debit)
+            record.balance = balance - debit + credit
+            self._mark_as_dirty(user_id, 'balance')
+            self._record_balance_change(user_id, reason, credit - debit, record.balance)
+
+            transaction = Transaction(idempotency_key, user_id, debit, credit, record.balance)
+            if idempotency_key is not None:
+                self._transactions[idempotency_key] = transaction
+                if len(self._transactions) > IDEMPOTENCY_CACHE_SIZE:
+                    self._transactions.popitem(last=False)
+            return transaction
+
     # ...и так далее для ВСЕХ методов, которые раньше вызывали _save()
     def check_and_apply_bankruptcy(self, user_id: int) -> bool:
         user_data = self.users.get(user_id)
         if user_data and user_data.get('balance', 0) < 100:
+            old_balance = user_data.get('balance', 0)
             self.users[user_id]['balance'] = 100
-            self._mark_as_dirty() # <-- ИЗМЕНЕНИЕ
+            self._mark_as_dirty(user_id, 'balance')
+            self._record_balance_change(user_id, 'bankruptcy', 100 - old_balance, 100)
             return True
         return False
 
     def _check_and_update_cooldown(self, user_id: int, cooldown_key: str, cooldown_duration: timedelta) -> Tuple[bool, Optional[timedelta]]:
-        # ... (логика проверки кулдауна остается той же)
-        user_data = self.users.get(user_id, {})
-        last_action_str = user_data.get(cooldown_key)
-        if last_action_str:
-            last_action_time = datetime.fromisoformat(last_action_str)
-            if datetime.now() < last_action_time + cooldown_duration:
-                time_left = (last_action_time + cooldown_duration) - datetime.now()
-                return False, time_left
+        # Время хранится в epoch-секундах, поэтому проверка - это просто сравнение чисел
+        now = int(time.time())
+        user_data = self.users.get(user_id)
+        last_action_time = getattr(user_data, cooldown_key) if user_data is not None else None
+        if last_action_time is not None:
+            available_at = last_action_time + int(cooldown_duration.total_seconds())
+            if now < available_at:
+                return False, timedelta(seconds=available_at - now)
         
         if user_id not in self.users:
              self.update_user_activity(user_id) # Этот метод уже вызывает _mark_as_dirty
         
-        self.users[user_id][cooldown_key] = datetime.now().isoformat()
-        self._mark_as_dirty() # <-- ИЗМЕНЕНИЕ
+        setattr(self.users[user_id], cooldown_key, now)
+        self._mark_as_dirty(user_id, cooldown_key)
         return True, None
 
     def set_user_faction(self, user_id: int, faction: str) -> None:
-        if user_id in self.users:
-            self.users[user_id]['faction'] = faction
-            self._mark_as_dirty() # <-- ИЗМЕНЕНИЕ
+        record = self.users.get(user_id)
+        if record is not None:
+            old_faction = record.faction
+            record['faction'] = faction # Строка фракции интернируется внутри записи
+            self._on_faction_change(user_id, old_faction, record.faction)
+            self._mark_as_dirty(user_id, 'faction')
+
+    def _on_faction_change(self, user_id: int, old_faction: str, new_faction: str) -> None:
+        if self._stats_ready:
+            self._factions.move(user_id, old_faction, new_faction)
+        else:
+            # Индекс снимка ещё строится - запоминаем итоговую фракцию, применим при объединении
+            self._faction_changes[user_id] = new_faction
     
     # Методы, которые только читают данные, не меняются
     def get_user_balance(self, user_id: int) -> int:
         return self.users.get(user_id, {}).get('balance', 0)
 
-    def get_all_users(self) -> Dict[int, Dict[str, Any]]:
+    def get_balance_history(self, user_id: int, limit: int = 10) -> Optional[List[LedgerEntry]]:
+        """Последние изменения баланса пользователя (новые первыми) или None, если журнал баланса отключён."""
+        if self._ledger is None:
+            return None
+        return self._ledger.history(user_id, limit)
+
+    def get_all_users(self) -> MutableMapping:
         return self.users
+
+    def _merge_snapshot_aggregates(self) -> bool:
+        """
+        В ленивом режиме объединяет посчитанные в фоне агрегаты снимка с изменениями после старта.
+        Возвращает False, пока фоновый подсчёт не завершён.
+        """
+        if self._stats_ready:
+            return True
+        if self._stats_base is None:
+            return False
+        self._stats_base.merge(self._stats)
+        self._stats, self._stats_base = self._stats_base, None
+        self._factions_base.apply(self._faction_changes)
+        self._factions, self._factions_base = self._factions_base, None
+        self._faction_changes = {}
+        self._stats_ready = True
+        return True
+
+    def get_faction_counts(self) -> Optional[Dict[str, int]]:
+        """Число подписчиков каждой фракции (по индексу, без обхода пользователей) или None, если индекс ещё строится."""
+        if not self._merge_snapshot_aggregates():
+            return None
+        return self._factions.counts()
+
+    def get_faction_audience(self, factions: Iterable[str]) -> Optional[Set[int]]:
+        """
+        Подписчики указанных фракций за O(получателей).
+        Возвращает None, пока индекс фракций строится в фоне (ленивый режим).
+        """
+        if not self._merge_snapshot_aggregates():
+            return None
+        return self._factions.audience(factions)
+
+    def get_stats(self) -> Optional[UserStats]:
+        """
+        Возвращает агрегаты по всем пользователям (за O(1), без обхода базы).
+        В ленивом режиме возвращает None, пока фоновый подсчёт снимка не завершён.
+        """
+        if not self._merge_snapshot_aggregates():
+            return None
+        # Подтягиваем свежую активность, чтобы счётчики взаимодействий были точными
+        self.flush_activity()
+        return self._stats
     
     def check_work_cooldown(self, user_id: int) -> Tuple[bool, Optional[timedelta]]:
         return self._check_and_update_cooldown(user_id, 'last_work_time', timedelta(hours=1))
@@ -204,7 +746,7 @@ class UserDataManager:
         return self._check_and_update_cooldown(user_id, 'last_race_time', timedelta(hours=2))
 
 
-# --- 4. АБСТРАКТНЫЙ КЛАСС ИГРЫ ---
+# --- 5. АБСТРАКТНЫЙ КЛАСС ИГРЫ ---
 
 class Game(ABC):
     """
@@ -216,6 +758,10 @@ class Game(ABC):
     # Атрибут класса, показывающий, требует ли игра предварительной ставки.
     # Может быть переопределен в дочерних классах (например, для Гонки Академиков).
     requires_bet: bool = True
+    # Игра сама отвечает на колбэк кнопки основного действия (play): алертом, если раунд
+    # нельзя сыграть, иначе обычным ответом сразу после проверок. Остальным играм
+    # handle_play отвечает сразу, до розыгрыша, - на колбэк можно ответить только один раз.
+    answers_callback: bool = False
     
     def __init__(self, game_id: str, name: str, user_manager_instance: UserDataManager):
         """
@@ -229,6 +775,13 @@ class Game(ABC):
         self.id = game_id
         self.name = name
         self.user_manager = user_manager_instance
+        # Кнопки, не зависящие от ставки и состояния, создаются один раз на игру;
+        # при смене ставки пересобирается только строка с её суммой.
+        self._control_rows = self.build_control_rows()
+        self._replay_keyboard = InlineKeyboardMarkup([
+            [InlineKeyboardButton("🎮 Сыграть ещё раз", callback_data=f'game:start:{self.id}:new')], # 'new' сбрасывает ставку
+            [InlineKeyboardButton("⬅️ Вернуться в Игровой Клуб", callback_data='nav:games')]
+        ])
 
     @abstractmethod
     def get_rules_text(self, balance: int, bet: int) -> str:
@@ -272,13 +825,105 @@ class Game(ABC):
         """
         pass
     
+    # --- Маршруты колбэков ---
+
+    def register_callbacks(self, dispatcher: CallbackDispatcher) -> None:
+        """
+        Регистрирует кнопки игры в диспетчере колбэков. По умолчанию - 'game:play:<id>';
+        остаток callback_data (например, выбранный цвет в рулетке) доступен в context.args.
+        """
+        dispatcher.register(f'game:play:{self.id}', self.handle_play)
+
+    async def handle_play(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Обработчик кнопки основного действия игры: проверки ставки и баланса делает сам play()."""
+        if not self.answers_callback:
+            # Сразу отвечаем на колбэк, чтобы кнопка не "зависала" на время раунда
+            await update.callback_query.answer()
+        await self.play(update, context)
+
+    async def abandon(self, user_id: int, user_data: Dict[str, Any]) -> None:
+        """
+        Вызывается перед удалением состояния неактивного пользователя (см. user_state.py).
+        Игра с незавершённым раундом, где ставка уже списана, должна его рассчитать.
+        По умолчанию ничего не делает.
+        """
+        pass
+
+    def resume(self, application: Any, user_id: int, user_data: Dict[str, Any]) -> None:
+        """
+        Вызывается при запуске для состояния, восстановленного после перезапуска (см. persistence.py).
+        Игра, чей раунд зависит от таймера (см. timing_wheel.py), должна запустить его заново.
+        По умолчанию ничего не делает.
+        """
+        pass
+
+    # --- Защита раунда от повторного розыгрыша ---
+    # Двойное нажатие на кнопку приходит двумя разными колбэками, поэтому ключа
+    # идемпотентности транзакции недостаточно: сообщение, на котором раунд уже сыгран,
+    # помечается, и повторное нажатие на его кнопку игнорируется. "Сыграть ещё раз"
+    # (game_start_handler) снимает пометку, и то же сообщение снова готово к игре.
+
+    @staticmethod
+    def is_round_settled(query, context: ContextTypes.DEFAULT_TYPE) -> bool:
+        return context.user_data.get('settled_message_id') == query.message.message_id
+
+    @staticmethod
+    def mark_round_settled(query, context: ContextTypes.DEFAULT_TYPE) -> None:
+        context.user_data['settled_message_id'] = query.message.message_id
+
+    async def settle_round(self, query, context: ContextTypes.DEFAULT_TYPE, bet: int, winnings: int) -> Optional[Transaction]:
+        """
+        Проводит ставку и выигрыш раунда одной транзакцией (ключ - ID колбэка): между списанием
+        и зачислением нет промежуточного состояния, а повтор колбэка не спишет ставку дважды.
+        Сама отвечает на колбэк (см. answers_callback): алертом, если раунд нельзя
+        сыграть, иначе обычным ответом до правки сообщения с результатом.
+        Возвращает None, если раунд уже сыгран или средств не хватает.
+        """
+        if bet <= 0:
+            await query.answer("Сначала нужно сделать ставку!", show_alert=True)
+            return None
+        if self.is_round_settled(query, context):
+            await query.answer("Этот раунд уже сыгран.")
+            return None
+        try:
+            transaction = await self.user_manager.transact(
+                query.from_user.id, debit=bet, credit=winnings, idempotency_key=f"cb:{query.id}", reason=self.id
+            )
+        except InsufficientFundsError as e:
+            await query.answer(f"Недостаточно средств. Ваш баланс: {e.balance:,}", show_alert=True)
+            return None
+        if transaction.duplicate:
+            # Повторная доставка того же колбэка: на него уже ответили при первой
+            return None
+        self.mark_round_settled(query, context)
+        # Ответ до правки сообщения с результатом, чтобы индикатор загрузки не висел всё время запроса
+        await query.answer()
+        return transaction
+
     def get_replay_keyboard(self) -> InlineKeyboardMarkup:
         """
         Возвращает стандартную клавиатуру после окончания раунда.
         Позволяет сыграть еще раз или вернуться в игровое меню.
         """
-        keyboard = [
-            [InlineKeyboardButton(f"🎮 Сыграть ещё раз", callback_data=f'game:start:{self.id}:new')], # 'new' сбрасывает ставку
-            [InlineKeyboardButton("⬅️ Вернуться в Игровой Клуб", callback_data='nav:games')]
-        ]
-        return InlineKeyboardMarkup(keyboard)
\ No newline at end of file
+        return self._replay_keyboard
+
+    # --- Клавиатура со ставкой ---
+
+    def build_control_rows(self) -> KeyboardRows:
+        """
+        Ряды кнопок под строкой ставки (сыграть, умножить ставку, выйти). Вызывается один раз
+        при создании игры; игры со ставкой переопределяют метод.
+        """
+        return []
+
+    def get_bet_label(self, bet: int) -> str:
+        return f"Ставка: {bet:,}" if bet > 0 else "Сделайте ставку!"
+
+    def get_bet_keyboard(self, bet: int, state: Any = None) -> InlineKeyboardMarkup:
+        """
+        Строка ставки и кнопки управления. Готовая клавиатура запоминается по
+        (ID игры, ставка, состояние), при промахе собирается только строка ставки.
+        """
+        return game_keyboards.get((self.id, bet, state), lambda: InlineKeyboardMarkup(
+            [[InlineKeyboardButton(self.get_bet_label(bet), callback_data='do_nothing')], *self._control_rows]
+        ))
\ No newline at end of file
@@ -0,0 +1,223 @@
+# Файл: journal.py
+"""
+Журнал упреждающей записи (write-ahead journal) для изменений данных пользователей.
+
+Каждое изменение записывается в локальный файл одной строкой JSON:
+    {"u": <user_id>, "f": {"<поле>": <новое значение>, ...}}
+В журнал пишутся уже итоговые значения полей, а не приращения, поэтому повторное
+применение записи безопасно (идемпотентно).
+
+- Запись дешёвая: строка попадает в буфер в памяти, а фоновый поток сбрасывает
+  буфер на диск пачками с одним fsync на пачку (group commit).
+- Если запись на диск не удалась, пачка остаётся в буфере и уходит при следующем
+  сбросе, так что упреждающая запись не теряется молча.
+- Журнал разбит на сегменты. Перед снимком данных текущий сегмент закрывается,
+  а после успешного сохранения снимка все закрытые сегменты удаляются (компакция).
+- При старте все оставшиеся сегменты проигрываются поверх последнего снимка.
+"""
+
+# --- 1. ИМПОРТЫ ---
+
+import json
+import logging
+import os
+import threading
+import time
+
+# Импорты для тайп-хинтинга
+from typing import Dict, Any, Iterator, List, Tuple
+
+
+# --- 2. НАСТРОЙКИ И КОНСТАНТЫ ---
+
+logger = logging.getLogger(__name__)
+
+SEGMENT_PREFIX = "journal."
+SEGMENT_SUFFIX = ".jsonl"
+# Пауза перед повторной попыткой, если запись на диск не удалась
+RETRY_INTERVAL = 1.0
+
+
+# --- 3. КЛАСС ЖУРНАЛА ---
+
+class WriteAheadJournal:
+    """
+    Append-only журнал изменений с групповым fsync.
+    """
+    def __init__(self, directory: str, flush_interval: float = 0.05):
+        """
+        Args:
+            directory (str): Папка, в которой хранятся сегменты журнала.
+            flush_interval (float): Максимальная задержка (в секундах) перед сбросом буфера на диск.
+                                    Это и есть окно возможной потери данных при аварии.
+        """
+        self._directory = directory
+        self._flush_interval = flush_interval
+        os.makedirs(directory, exist_ok=True)
+
+        self._buffer: List[str] = []
+        self._cond = threading.Condition()
+        # Отдельный замок на файл: сброс буфера и ротация не должны пересекаться
+        self._file_lock = threading.Lock()
+        self._closed = False
+        # Предыдущая запись не удалась и могла оставить в файле оборванную строку
+        self._write_failed = False
+
+        existing = self._list_segments()
+        self._segment_seq = (existing[-1][0] + 1) if existing else 1
+        self._file = self._open_segment(self._segment_seq)
+
+        self._flusher = threading.Thread(target=self._flush_loop, name="journal-flusher", daemon=True)
+        self._flusher.start()
+
+    # --- 4. РАБОТА С СЕГМЕНТАМИ ---
+
+    def _segment_path(self, seq: int) -> str:
+        return os.path.join(self._directory, f"{SEGMENT_PREFIX}{seq:08d}{SEGMENT_SUFFIX}")
+
+    def _open_segment(self, seq: int):
+        return open(self._segment_path(seq), 'a', encoding='utf-8')
+
+    def _list_segments(self) -> List[Tuple[int, str]]:
+        """Возвращает отсортированный список (номер, путь) всех сегментов в папке."""
+        segments = []
+        for name in os.listdir(self._directory):
+            if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX):
+                try:
+                    seq = int(name[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)])
+                except ValueError:
+                    continue
+                segments.append((seq, os.path.join(self._directory, name)))
+        segments.sort()
+        return segments
+
+    # --- 5. ЗАПИСЬ ---
+
+    def append(self, user_id: int, fields: Dict[str, Any]) -> None:
+        """
+        Добавляет запись об изменении полей пользователя. Не блокирует вызывающий код:
+        на диск запись попадёт при ближайшем групповом сбросе.
+        """
+        line = json.dumps({'u': user_id, 'f': fields}, ensure_ascii=False, separators=(',', ':'))
+        with self._cond:
+            self._buffer.append(line)
+            if len(self._buffer) == 1:
+                # Будим поток сброса только на первой записи пачки
+                self._cond.notify()
+
+    def _write_pending(self) -> None:
+        """Записывает накопленную пачку в текущий сегмент и делает один fsync на всю пачку."""
+        # Буфер забираем под замком файла: иначе пачка, взятая до ротации,
+        # могла бы попасть в новый сегмент позже более свежих записей.
+        with self._file_lock:
+            with self._cond:
+                lines, self._buffer = self._buffer, []
+            if not lines:
+                return
+            try:
+                if self._write_failed:
+                    # Отделяем возможный обрывок прошлой попытки: replay пропустит его как повреждённую строку
+                    self._file.write("\n")
+                self._file.write("\n".join(lines) + "\n")
+                self._file.flush()
+                os.fsync(self._file.fileno())
+            except OSError:
+                # Возвращаем пачку в начало буфера, перед записями, пришедшими за это время.
+                # Если часть пачки всё же попала на диск, повтор безопасен: журнал идемпотентен.
+                with self._cond:
+                    self._buffer[:0] = lines
+                self._write_failed = True
+                raise
+            self._write_failed = False
+
+    def _flush_loop(self) -> None:
+        """Фоновый поток группового сброса: копит записи до `flush_interval`, затем пишет их одним fsync."""
+        while True:
+            with self._cond:
+                while not self._buffer and not self._closed:
+                    self._cond.wait()
+                if self._closed:
+                    return
+            # Даём набежать остальным записям пачки
+            time.sleep(self._flush_interval)
+            try:
+                self._write_pending()
+            except OSError as e:
+                logger.error(f"КРИТИЧЕСКАЯ ОШИБКА: Не удалось записать журнал на диск, повтор через {RETRY_INTERVAL} с: {e}")
+                time.sleep(RETRY_INTERVAL)
+
+    def flush(self) -> None:
+        """
+        Синхронно сбрасывает всё, что накопилось в буфере.
+
+        Raises:
+            OSError: Если запись не удалась; записи остаются в буфере.
+        """
+        self._write_pending()
+
+    # --- 6. РОТАЦИЯ, КОМПАКЦИЯ И ВОССТАНОВЛЕНИЕ ---
+
+    def rotate(self) -> int:
+        """
+        Закрывает текущий сегмент и открывает новый. Вызывается непосредственно перед
+        снимком данных: всё, что попало в закрытые сегменты, войдёт в этот снимок.
+
+        Returns:
+            int: Номер последнего закрытого сегмента (для последующей компакции).
+        """
+        try:
+            self.flush()
+        except OSError as e:
+            # Записи остались в буфере и уйдут в новый сегмент, а снимок, ради которого
+            # делается ротация, и так их покрывает
+            logger.error(f"Не удалось сбросить журнал перед ротацией: {e}")
+        with self._file_lock:
+            closed_seq = self._segment_seq
+            try:
+                self._file.close()
+            except OSError as e:
+                logger.error(f"Не удалось закрыть сегмент журнала {closed_seq}: {e}")
+            self._segment_seq += 1
+            self._file = self._open_segment(self._segment_seq)
+            self._write_failed = False
+        return closed_seq
+
+    def compact(self, upto_seq: int) -> None:
+        """Удаляет сегменты с номером не больше `upto_seq` (их данные уже есть в сохранённом снимке)."""
+        for seq, path in self._list_segments():
+            if seq > upto_seq:
+                break
+            try:
+                os.remove(path)
+            except OSError as e:
+                logger.warning(f"Не удалось удалить сегмент журнала {path}: {e}")
+
+    def replay(self) -> Iterator[Tuple[int, Dict[str, Any]]]:
+        """
+        Последовательно читает все сегменты журнала.
+        Оборванная последняя строка (авария во время записи) пропускается.
+
+        Yields:
+            Tuple[int, Dict[str, Any]]: ID пользователя и новые значения его полей.
+        """
+        for seq, path in self._list_segments():
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                        yield int(entry['u']), entry['f']
+                    except (json.JSONDecodeError, KeyError, TypeError, ValueError):
+                        logger.warning(f"Пропущена повреждённая запись журнала в {path}.")
+
+    def close(self) -> None:
+        """Останавливает фоновый поток и сбрасывает остаток буфера на диск."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._flusher.join()
+        try:
+            self.flush()
+        except OSError as e:
+            logger.error(f"КРИТИЧЕСКАЯ ОШИБКА: Не удалось записать остаток журнала при закрытии: {e}")
+        with self._file_lock:
+            self._file.close()
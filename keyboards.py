@@ -0,0 +1,60 @@
+# Файл: keyboards.py
+"""
+Кэш готовых инлайн-клавиатур.
+
+InlineKeyboardMarkup и InlineKeyboardButton после создания неизменяемы, поэтому
+один и тот же объект можно отдавать в любое количество сообщений. Статические меню
+собираются один раз при запуске, а клавиатуры игр, зависящие от ставки и состояния,
+запоминаются в ограниченном LRU-кэше по ключу (ID игры, ставка, состояние).
+"""
+
+# --- 1. ИМПОРТЫ ---
+
+from collections import OrderedDict
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+# Импорты для тайп-хинтинга
+from typing import Callable, Hashable, List
+
+
+# --- 2. НАСТРОЙКИ И КОНСТАНТЫ ---
+
+# Сколько клавиатур игр держать в кэше. Ставки у большинства игроков повторяются
+# (умножение x2/x10/x50 от круглых сумм), так что попаданий много даже при небольшом размере.
+KEYBOARD_CACHE_SIZE = 4096
+
+KeyboardRows = List[List[InlineKeyboardButton]]
+
+
+# --- 3. КЭШ КЛАВИАТУР ---
+
+class KeyboardCache:
+    """
+    Ограниченный LRU-кэш клавиатур. При промахе клавиатура собирается функцией `build`,
+    самая давно не использованная вытесняется при переполнении.
+    """
+    def __init__(self, max_size: int = KEYBOARD_CACHE_SIZE):
+        self._max_size = max_size
+        self._markups: "OrderedDict[Hashable, InlineKeyboardMarkup]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable, build: Callable[[], InlineKeyboardMarkup]) -> InlineKeyboardMarkup:
+        markup = self._markups.get(key)
+        if markup is not None:
+            self._markups.move_to_end(key)
+            self.hits += 1
+            return markup
+        self.misses += 1
+        markup = self._markups[key] = build()
+        if len(self._markups) > self._max_size:
+            self._markups.popitem(last=False)
+        return markup
+
+    def __len__(self) -> int:
+        return len(self._markups)
+
+
+# Общий кэш для всех игр: ID игры входит в ключ
+game_keyboards = KeyboardCache()
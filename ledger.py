@@ -0,0 +1,239 @@
+# Файл: ledger.py
+"""
+Журнал изменений баланса (ledger) для истории операций и аудита.
+
+- ledger.log - append-only файл записей фиксированной длины:
+  ID пользователя, время, причина (ID игры и т.п.), изменение, итоговый баланс
+  и смещение предыдущей записи того же пользователя. Записи пользователя образуют
+  цепочку от новой к старой, поэтому история читается без сканирования чужих записей.
+- ledger.idx - хеш-таблица с открытой адресацией в файле, отображённом в память (mmap):
+  ID пользователя -> смещение его последней записи. Обновление индекса - это запись
+  16 байт в память, без системных вызовов.
+
+Если после аварии индекс отстаёт от лога, недостающий хвост лога проигрывается при открытии.
+"""
+
+# --- 1. ИМПОРТЫ ---
+
+import logging
+import mmap
+import os
+import struct
+import time
+
+# Импорты для тайп-хинтинга
+from typing import Iterator, List, NamedTuple, Optional
+
+
+# --- 2. НАСТРОЙКИ И КОНСТАНТЫ ---
+
+logger = logging.getLogger(__name__)
+
+LOG_FILE = "ledger.log"
+INDEX_FILE = "ledger.idx"
+
+# Максимальная длина причины изменения баланса в байтах UTF-8
+REASON_SIZE = 16
+# Запись лога: user_id, timestamp, delta, balance, prev_offset (+1, 0 - нет), reason
+RECORD = struct.Struct(f"<qqqqq{REASON_SIZE}s")
+# Заголовок индекса: сигнатура, ёмкость (степень двойки), занято слотов, длина лога, учтённая в индексе
+INDEX_HEADER = struct.Struct("<8sqqq")
+INDEX_MAGIC = b"LEDGIDX1"
+# Слот индекса: user_id, смещение последней записи + 1 (0 - пустой слот)
+SLOT = struct.Struct("<qq")
+INITIAL_CAPACITY = 1 << 16
+MAX_LOAD_FACTOR = 0.7
+# Множитель Фибоначчи для перемешивания ID перед взятием индекса слота
+HASH_MULTIPLIER = 0x9E3779B97F4A7C15
+
+
+def encode_reason(reason: str) -> bytes:
+    """
+    Кодирует причину для записи в лог.
+
+    Raises:
+        ValueError: Если причина длиннее REASON_SIZE байт (обрезка могла бы разрезать
+            многобайтовый символ и молча исказить историю).
+    """
+    encoded = reason.encode('utf-8')
+    if len(encoded) > REASON_SIZE:
+        raise ValueError(f"Причина изменения баланса длиннее {REASON_SIZE} байт: {reason!r}")
+    return encoded
+
+
+class LedgerEntry(NamedTuple):
+    timestamp: int
+    reason: str
+    delta: int
+    balance: int
+
+
+# --- 3. ИНДЕКС ---
+
+class _OffsetIndex:
+    """
+    Хеш-таблица user_id -> смещение последней записи в файле, отображённом в память.
+    Линейное пробирование; при заполнении больше MAX_LOAD_FACTOR таблица удваивается.
+    """
+    def __init__(self, path: str, capacity: int = INITIAL_CAPACITY):
+        self.path = path
+        if not os.path.exists(path) or os.path.getsize(path) < INDEX_HEADER.size:
+            self._create(path, capacity)
+        self._open()
+        magic, self.capacity, self.used, self.log_size = INDEX_HEADER.unpack_from(self._map, 0)
+        if magic != INDEX_MAGIC or os.path.getsize(path) != INDEX_HEADER.size + self.capacity * SLOT.size:
+            raise ValueError(f"Повреждён индекс журнала баланса: {path}")
+
+    @staticmethod
+    def _create(path: str, capacity: int) -> None:
+        with open(path, 'wb') as f:
+            f.write(INDEX_HEADER.pack(INDEX_MAGIC, capacity, 0, 0))
+            f.truncate(INDEX_HEADER.size + capacity * SLOT.size)
+
+    def _open(self) -> None:
+        self._file = open(self.path, 'r+b')
+        self._map = mmap.mmap(self._file.fileno(), 0)
+
+    def _slot(self, user_id: int) -> int:
+        """Номер слота, где лежит `user_id`, или первого пустого слота на его пути."""
+        mask = self.capacity - 1
+        slot = ((user_id * HASH_MULTIPLIER) & 0xFFFFFFFFFFFFFFFF) >> 32 & mask
+        while True:
+            key, offset = SLOT.unpack_from(self._map, INDEX_HEADER.size + slot * SLOT.size)
+            if offset == 0 or key == user_id:
+                return slot
+            slot = (slot + 1) & mask
+
+    def get(self, user_id: int) -> Optional[int]:
+        _, offset = SLOT.unpack_from(self._map, INDEX_HEADER.size + self._slot(user_id) * SLOT.size)
+        return offset - 1 if offset else None
+
+    def put(self, user_id: int, offset: int, log_size: int) -> None:
+        slot = self._slot(user_id)
+        position = INDEX_HEADER.size + slot * SLOT.size
+        if SLOT.unpack_from(self._map, position)[1] == 0:
+            if self.used + 1 > self.capacity * MAX_LOAD_FACTOR:
+                self._grow()
+                self.put(user_id, offset, log_size)
+                return
+            self.used += 1
+        SLOT.pack_into(self._map, position, user_id, offset + 1)
+        self.log_size = log_size
+        INDEX_HEADER.pack_into(self._map, 0, INDEX_MAGIC, self.capacity, self.used, self.log_size)
+
+    def _grow(self) -> None:
+        """Переносит все слоты в таблицу вдвое большего размера и атомарно подменяет файл."""
+        entries = []
+        for slot in range(self.capacity):
+            key, offset = SLOT.unpack_from(self._map, INDEX_HEADER.size + slot * SLOT.size)
+            if offset:
+                entries.append((key, offset))
+        tmp_path = self.path + ".tmp"
+        self._create(tmp_path, self.capacity * 2)
+        self.close()
+        os.replace(tmp_path, self.path)
+        self._open()
+        self.capacity *= 2
+        self.used = 0
+        for key, offset in entries:
+            position = INDEX_HEADER.size + self._slot(key) * SLOT.size
+            SLOT.pack_into(self._map, position, key, offset)
+            self.used += 1
+        INDEX_HEADER.pack_into(self._map, 0, INDEX_MAGIC, self.capacity, self.used, self.log_size)
+        logger.info(f"Индекс журнала баланса увеличен до {self.capacity} слотов.")
+
+    def flush(self) -> None:
+        self._map.flush()
+
+    def close(self) -> None:
+        self._map.close()
+        self._file.close()
+
+
+# --- 4. ЖУРНАЛ БАЛАНСА ---
+
+class BalanceLedger:
+    """
+    Append-only журнал изменений баланса с индексом по пользователям.
+    Вызывается из цикла событий: запись - один системный вызов write.
+    """
+    def __init__(self, directory: str):
+        os.makedirs(directory, exist_ok=True)
+        self._log_path = os.path.join(directory, LOG_FILE)
+        self._fd = os.open(self._log_path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        # Обрезаем недописанную при аварии последнюю запись
+        size = os.fstat(self._fd).st_size
+        if size % RECORD.size:
+            logger.warning("Журнал баланса: отброшена повреждённая последняя запись.")
+            size -= size % RECORD.size
+            os.ftruncate(self._fd, size)
+        self._size = size
+
+        index_path = os.path.join(directory, INDEX_FILE)
+        try:
+            self._index = _OffsetIndex(index_path)
+        except ValueError as e:
+            logger.warning(f"{e}. Индекс будет перестроен.")
+            os.remove(index_path)
+            self._index = _OffsetIndex(index_path)
+        self._recover()
+
+    def _recover(self) -> None:
+        """Доигрывает в индекс записи лога, которые не успели в него попасть."""
+        start = self._index.log_size
+        if start > self._size:
+            # Индекс новее лога (лог потерял хвост) - строим заново
+            self._index.close()
+            index_path = self._index.path
+            os.remove(index_path)
+            self._index = _OffsetIndex(index_path)
+            start = 0
+        if start == self._size:
+            return
+        for offset in range(start, self._size, RECORD.size):
+            user_id = RECORD.unpack(os.pread(self._fd, RECORD.size, offset))[0]
+            self._index.put(user_id, offset, offset + RECORD.size)
+        logger.info(f"Индекс журнала баланса восстановлен: {(self._size - start) // RECORD.size} записей.")
+
+    def append(self, user_id: int, reason: str, delta: int, balance: int, timestamp: Optional[int] = None) -> None:
+        """Добавляет запись об изменении баланса пользователя."""
+        previous = self._index.get(user_id)
+        record = RECORD.pack(
+            user_id,
+            int(time.time()) if timestamp is None else timestamp,
+            delta,
+            balance,
+            0 if previous is None else previous + 1,
+            encode_reason(reason)
+        )
+        offset = self._size
+        os.write(self._fd, record)
+        self._size += RECORD.size
+        self._index.put(user_id, offset, self._size)
+
+    def entries(self, user_id: int) -> Iterator[LedgerEntry]:
+        """Все записи пользователя от новой к старой. Читаются только его записи."""
+        offset = self._index.get(user_id)
+        while offset is not None:
+            _, timestamp, delta, balance, previous, reason = RECORD.unpack(os.pread(self._fd, RECORD.size, offset))
+            yield LedgerEntry(timestamp, reason.rstrip(b'\0').decode('utf-8', 'replace'), delta, balance)
+            offset = previous - 1 if previous else None
+
+    def history(self, user_id: int, limit: int = 10) -> List[LedgerEntry]:
+        """Последние `limit` записей пользователя (новые первыми)."""
+        result = []
+        for entry in self.entries(user_id):
+            result.append(entry)
+            if len(result) >= limit:
+                break
+        return result
+
+    def flush(self) -> None:
+        """Сбрасывает лог и индекс на диск."""
+        os.fsync(self._fd)
+        self._index.flush()
+
+    def close(self) -> None:
+        self.flush()
+        self._index.close()
+        os.close(self._fd)
@@ -1,23 +1,41 @@
 # чтобы остановить программу нажми cntrl+C, тебе действительно не нужно завершать её аварийно...
 #main.py
 from dotenv import load_dotenv
+import asyncio
 import logging
 import os
+import re
+import signal
+import time
 from datetime import datetime, timedelta
 import random
 from abc import ABC, abstractmethod
-from game_base import Game, UserDataManager # Если вынесли UserDataManager
+from game_base import Game, UserDataManager, LazyUserMap # Если вынесли UserDataManager
+from storage import StorageBackend, JsonBinStorage, SQLiteStorage
+from journal import WriteAheadJournal
+from ledger import BalanceLedger
+from callbacks import CallbackDispatcher
+from message_edits import message_editor
+from keyboards import game_keyboards
+from flood import FloodGuard
+from user_state import UserStateReaper
+from persistence import SQLitePersistence
+from timing_wheel import timers
+from webhook import WebhookServer
+from update_processor import PerUserUpdateProcessor
+from broadcast import BroadcastEngine, BroadcastJob, BroadcastStore, KIND_SEND, KIND_EDIT, KIND_DELETE
 from minigames import DiceGame, RouletteGame, CoinFlipGame # Если вынесли UserDataManager
 from blackjack_game import BlackjackGame
 from academic_race_game import AcademicRaceGame
-from typing import Dict, Any
+from typing import Dict, Any, Optional, Tuple
 
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import TelegramError
 from telegram.request import HTTPXRequest
 from telegram.ext import (
     Application,
+    ApplicationHandlerStop,
     CommandHandler,
-    CallbackQueryHandler,
     ContextTypes,
     TypeHandler,
     MessageHandler,
@@ -36,6 +54,48 @@ TOKEN = os.getenv("TELEGRAM_TOKEN")
 ADMIN_ID = os.getenv("ADMIN_ID_TGBOT")
 JSONBIN_API_KEY=os.getenv("JSONBIN_API_KEY")
 JSONBIN_BIN_ID=os.getenv("JSONBIN_BIN_ID")
+# Хранилище данных: 'jsonbin' (облако, по умолчанию) или 'sqlite' (локальный файл)
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "jsonbin").lower()
+SQLITE_PATH = os.getenv("SQLITE_PATH", "user_data.db")
+# Ленивая загрузка: при старте строится только индекс пользователей, записи разбираются при первом обращении
+LAZY_LOAD = os.getenv("LAZY_LOAD", "0") == "1"
+# Локальная копия бина JSONBin: из неё собираются сохранения (и читаются записи в ленивом режиме)
+JSONBIN_CACHE_PATH = os.getenv("JSONBIN_CACHE_PATH", "jsonbin_snapshot.json")
+# Интервал автосохранения в секундах. Сохраняется только дельта, поэтому для локального
+# SQLite достаточно нескольких секунд; JSONBin всё равно принимает документ целиком.
+AUTOSAVE_INTERVAL = int(os.getenv("AUTOSAVE_INTERVAL", "5" if STORAGE_BACKEND == "sqlite" else "3600"))
+# Папка журнала изменений (защита от потери данных между сохранениями). Пустое значение отключает журнал.
+JOURNAL_DIR = os.getenv("JOURNAL_DIR", "journal")
+# Как часто накопленная активность (interaction_count/last_seen) применяется к записям
+ACTIVITY_FLUSH_INTERVAL = int(os.getenv("ACTIVITY_FLUSH_INTERVAL", "10"))
+# Папка журнала изменений баланса (история операций, /history). Пустое значение отключает журнал.
+LEDGER_DIR = os.getenv("LEDGER_DIR", "ledger")
+# Локальная очередь рассылок: статус каждого получателя, чтобы продолжить рассылку после перезапуска
+BROADCAST_DB_PATH = os.getenv("BROADCAST_DB_PATH", "broadcasts.db")
+# Режим вебхука: если задан публичный адрес WEBHOOK_URL, апдейты принимает HTTP-сервер вместо long polling
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+# Сколько необработанных апдейтов держать в очереди, прежде чем отвечать Telegram 503
+WEBHOOK_MAX_PENDING = int(os.getenv("WEBHOOK_MAX_PENDING", "1000"))
+# Адрес Bot API (например, локального сервера или заглушки для тестов); по умолчанию - api.telegram.org
+TELEGRAM_BASE_URL = os.getenv("TELEGRAM_BASE_URL")
+# Сколько апдейтов разных пользователей обрабатывать одновременно (апдейты одного пользователя - всегда по очереди)
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "32"))
+# Антифлуд: не больше FLOOD_RATE апдейтов в секунду от пользователя в среднем и FLOOD_BURST подряд.
+# FLOOD_RATE=0 отключает ограничение.
+FLOOD_RATE = float(os.getenv("FLOOD_RATE", "2"))
+FLOOD_BURST = int(os.getenv("FLOOD_BURST", "8"))
+# Через сколько секунд бездействия удалять игровое состояние пользователя (context.user_data)
+# и сколько пользователей с состоянием держать в памяти не больше
+USER_STATE_TTL = int(os.getenv("USER_STATE_TTL", "1800"))
+USER_STATE_MAX_USERS = int(os.getenv("USER_STATE_MAX_USERS", "50000"))
+# Локальное хранилище игрового состояния (context.user_data), чтобы незавершённые игры
+# переживали перезапуск. Пустое значение отключает сохранение.
+STATE_DB_PATH = os.getenv("STATE_DB_PATH", "user_state.db")
+STATE_FLUSH_INTERVAL = int(os.getenv("STATE_FLUSH_INTERVAL", "10"))
 
 # Критически важная проверка: убеждаемся, что токен и ID админа были найдены.
 # Если нет, бот не сможет запуститься, и мы выводим информативную ошибку.
@@ -43,10 +103,17 @@ if not TOKEN:
     raise ValueError("Ошибка: Токен TELEGRAM_TOKEN не найден в переменных окружения.")
 if not ADMIN_ID:
     raise ValueError("Ошибка: ID администратора ADMIN_ID_TGBOT не найден в переменных окружения.")
-if not JSONBIN_API_KEY:
-    raise ValueError("Ошибка: JSONBIN_API_KEY не найден в переменных окружения.")
-if not JSONBIN_BIN_ID:
-    raise ValueError("Ошибка: JSONBIN_BIN_ID не найден в переменных окружения.")
+# ID из окружения приходит строкой, а effective_user.id - число: без приведения админ не распознаётся
+ADMIN_ID = int(ADMIN_ID)
+if WEBHOOK_URL and not WEBHOOK_SECRET:
+    raise ValueError("Ошибка: для режима вебхука нужен WEBHOOK_SECRET (секретный токен для проверки запросов).")
+if STORAGE_BACKEND not in ("jsonbin", "sqlite"):
+    raise ValueError(f"Ошибка: неизвестное хранилище STORAGE_BACKEND={STORAGE_BACKEND}. Используйте jsonbin или sqlite.")
+if STORAGE_BACKEND == "jsonbin":
+    if not JSONBIN_API_KEY:
+        raise ValueError("Ошибка: JSONBIN_API_KEY не найден в переменных окружения.")
+    if not JSONBIN_BIN_ID:
+        raise ValueError("Ошибка: JSONBIN_BIN_ID не найден в переменных окружения.")
 
 DATA_FILE = "user_data.xml"
 FACTIONS = ["белые", "красные", "синие", "зеленые", "чёрные", "прозрачные"]
@@ -68,11 +135,56 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 # --- ГЛОБАЛЬНЫЙ МЕНЕДЖЕР И ОБРАБОТЧИК АКТИВНОСТИ ---
-user_manager = UserDataManager(api_key=  JSONBIN_API_KEY, bin_id = JSONBIN_BIN_ID)
+def create_storage() -> StorageBackend:
+    """Создает хранилище данных, выбранное через переменную окружения STORAGE_BACKEND."""
+    if STORAGE_BACKEND == "sqlite":
+        return SQLiteStorage(SQLITE_PATH)
+    return JsonBinStorage(api_key=JSONBIN_API_KEY, bin_id=JSONBIN_BIN_ID, cache_path=JSONBIN_CACHE_PATH)
+
+user_manager = UserDataManager(
+    create_storage(),
+    journal=WriteAheadJournal(JOURNAL_DIR) if JOURNAL_DIR else None,
+    lazy_load=LAZY_LOAD,
+    ledger=BalanceLedger(LEDGER_DIR) if LEDGER_DIR else None
+)
+
+async def report_broadcast_progress(bot, job: BroadcastJob) -> None:
+    """Обновляет у админа сообщение со статусом рассылки."""
+    if job.status_message_id is not None:
+        # Прогресс без изменений (например, всё ещё ждём RetryAfter) не отправляется повторно
+        await message_editor.edit(
+            bot, job.status_chat_id, job.status_message_id, format_broadcast_progress(job), debounce=False
+        )
+
+broadcaster = BroadcastEngine(BroadcastStore(BROADCAST_DB_PATH), on_progress=report_broadcast_progress)
+
+flood_guard = FloodGuard(FLOOD_RATE, FLOOD_BURST) if FLOOD_RATE > 0 else None
+
+async def answer_flooded(update: object) -> None:
+    """
+    Ответ на апдейт, отброшенный антифлудом или процессором апдейтов: колбэк получает
+    короткий ответ (иначе у кнопки крутится индикатор загрузки), сообщение просто игнорируется.
+    """
+    if isinstance(update, Update) and update.callback_query:
+        try:
+            await update.callback_query.answer("Слишком часто! Подождите пару секунд.")
+        except TelegramError:
+            pass
 
 async def track_user_activity(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Предобработчик всех апдейтов (группа -1): антифлуд и учёт активности.
+    Апдейт сверх лимита пользователя дальше не обрабатывается (см. answer_flooded).
+    """
     if update.effective_user:
-        user_manager.update_user_activity(update.effective_user.id)
+        user_id = update.effective_user.id
+        if flood_guard and user_id != ADMIN_ID and not flood_guard.allow(user_id):
+            await answer_flooded(update)
+            raise ApplicationHandlerStop
+        user_state.touch(user_id)
+        user_manager.update_user_activity(user_id)
+        # Пользователь снова пишет боту - значит, его можно включать в рассылки
+        await broadcaster.mark_reachable(user_id)
 
 # Создаем экземпляры игр и регистрируем их
 GAMES = {
@@ -84,59 +196,77 @@ GAMES = {
 }
 # --- КОНЕЦ НОВОГО БЛОКА ---
 
+# Состояние игр в context.user_data держится только для активных пользователей
+user_state = UserStateReaper(GAMES.values(), ttl_seconds=USER_STATE_TTL, max_users=USER_STATE_MAX_USERS)
+
 # --- ГЕНЕРАТОРЫ КЛАВИАТУР ---
+# Статические меню не зависят от пользователя: собираются один раз при запуске,
+# и один и тот же объект отправляется всем (клавиатуры Telegram неизменяемы).
+MAIN_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📰 Новости", callback_data='nav:news')],
+    [InlineKeyboardButton("🎮 Игры", callback_data='nav:games')],
+    [InlineKeyboardButton("ℹ️ Информация", callback_data='nav:info')]
+])
+
+NEWS_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🩶 (Все новости)", callback_data='sub:прозрачные')],
+    [InlineKeyboardButton("❤️", callback_data='sub:красные'), InlineKeyboardButton("💚", callback_data='sub:зеленые')],
+    [InlineKeyboardButton("🤍", callback_data='sub:белые'), InlineKeyboardButton("💙", callback_data='sub:синие'), InlineKeyboardButton("🖤", callback_data='sub:чёрные')],
+    [InlineKeyboardButton("⬅️ Назад", callback_data='nav:main')]
+])
+
+INFO_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📊 Статистика", callback_data='get_public_stats')],
+    [InlineKeyboardButton("✍️ Сообщение разработчику", callback_data='contact:message')],
+    [InlineKeyboardButton("🚀 Заказать бота", callback_data='contact:order')],
+    [InlineKeyboardButton("⬅️ Назад", callback_data='nav:main')]
+])
+
+# Меню игр: меняется только строка с балансом, остальные ряды общие
+GAMES_MENU_ROWS = (
+    (InlineKeyboardButton("💪 Работать (+5,000)", callback_data='game:work'),),
+    # Кнопки теперь ведут на универсальный обработчик
+    (InlineKeyboardButton("🎓 Гонки академиков", callback_data='game:start:academic_race'),),
+    (InlineKeyboardButton("🎲 Играть в Кости", callback_data='game:start:dice'),),
+    (InlineKeyboardButton("🎡 Играть в Рулетку", callback_data='game:start:roulette'),),
+    (InlineKeyboardButton("🪙 Играть в Монетку", callback_data='game:start:coinflip'),),
+    (InlineKeyboardButton("🃏 Играть в Блэкджек", callback_data='game:start:blackjack'),),
+    (InlineKeyboardButton("⬅️ Назад", callback_data='nav:main'),)
+)
+
 def get_main_keyboard() -> InlineKeyboardMarkup:
-    keyboard = [[InlineKeyboardButton("📰 Новости", callback_data='nav:news')],
-                [InlineKeyboardButton("🎮 Игры", callback_data='nav:games')],
-                [InlineKeyboardButton("ℹ️ Информация", callback_data='nav:info')]]
-    return InlineKeyboardMarkup(keyboard)
+    return MAIN_KEYBOARD
 
 def get_news_keyboard() -> InlineKeyboardMarkup:
-    keyboard = [[InlineKeyboardButton("🩶 (Все новости)", callback_data='sub:прозрачные')],
-                [InlineKeyboardButton("❤️", callback_data='sub:красные'), InlineKeyboardButton("💚", callback_data='sub:зеленые')],
-                [InlineKeyboardButton("🤍", callback_data='sub:белые'), InlineKeyboardButton("💙", callback_data='sub:синие'), InlineKeyboardButton("🖤", callback_data='sub:чёрные')],
-                [InlineKeyboardButton("⬅️ Назад", callback_data='nav:main')]]
-    return InlineKeyboardMarkup(keyboard)
+    return NEWS_KEYBOARD
 
 def get_info_keyboard() -> InlineKeyboardMarkup:
-    keyboard = [[InlineKeyboardButton("📊 Статистика", callback_data='get_public_stats')],
-                [InlineKeyboardButton("✍️ Сообщение разработчику", callback_data='contact:message')],
-                [InlineKeyboardButton("🚀 Заказать бота", callback_data='contact:order')],
-                [InlineKeyboardButton("⬅️ Назад", callback_data='nav:main')]]
-    return InlineKeyboardMarkup(keyboard)
+    return INFO_KEYBOARD
 
 def get_games_keyboard(user_id: int) -> InlineKeyboardMarkup:
     balance = user_manager.get_user_balance(user_id)
-    keyboard = [
-        [InlineKeyboardButton(f"💰 Ваш баланс: {balance:,} дукатов", callback_data='do_nothing')],
-        [InlineKeyboardButton("💪 Работать (+5,000)", callback_data='game:work')],
-        # Кнопки теперь ведут на универсальный обработчик
-        [InlineKeyboardButton("🎓 Гонки академиков", callback_data='game:start:academic_race')], # <-- ИЗМЕНЕНО
-        [InlineKeyboardButton("🎲 Играть в Кости", callback_data='game:start:dice')],
-        [InlineKeyboardButton("🎡 Играть в Рулетку", callback_data='game:start:roulette')],
-        [InlineKeyboardButton("🪙 Играть в Монетку", callback_data='game:start:coinflip')], # <-- ДОБАВЛЕНА ЭТА СТРОКА
-        [InlineKeyboardButton("🃏 Играть в Блэкджек", callback_data='game:start:blackjack')], # <-- ДОБАВЛЕНО
-        [InlineKeyboardButton("⬅️ Назад", callback_data='nav:main')]
-    ]
-    return InlineKeyboardMarkup(keyboard)
+    balance_row = (InlineKeyboardButton(f"💰 Ваш баланс: {balance:,} дукатов", callback_data='do_nothing'),)
+    return InlineKeyboardMarkup((balance_row, *GAMES_MENU_ROWS))
+
+# --- ГЕНЕРАТОР ОТЧЕТА ---
+STATS_NOT_READY_TEXT = "📊 Статистика ещё подсчитывается после запуска бота. Попробуйте через минуту."
+
+def get_faction_counts(stats) -> Dict[str, int]:
+    """Распределение по фракциям из индекса подписчиков; пользователи без фракции - остаток от общего числа."""
+    index_counts = user_manager.get_faction_counts() or {}
+    faction_counts = {faction: index_counts.get(faction, 0) for faction in FACTIONS}
+    faction_counts['Без фракции'] = stats.total_users - sum(index_counts.values())
+    return faction_counts
 
-# --- ГЕНЕРАТОР ОТЧЕТА (без изменений) ---
 def generate_public_stats_report() -> str:
-    # ... (код функции без изменений)
-    users = user_manager.get_all_users()
-    total_users = len(users)
-    total_interactions = sum(user.get('interaction_count', 0) for user in users.values())
-    faction_counts = {faction: 0 for faction in FACTIONS}
-    faction_counts['Без фракции'] = 0
-    for user_data in users.values():
-        faction = user_data.get('faction', 'None')
-        if faction in faction_counts:
-            faction_counts[faction] += 1
-        elif faction == 'None':
-             faction_counts['Без фракции'] += 1
+    # Агрегаты поддерживаются UserDataManager при каждом изменении - обхода всех пользователей нет
+    stats = user_manager.get_stats()
+    if stats is None:
+        return STATS_NOT_READY_TEXT
+    faction_counts = get_faction_counts(stats)
     report = "📊 *Общая статистика бота*\n\n"
-    report += f"👥 *Всего пользователей:* {total_users}\n"
-    report += f"💬 *Всего взаимодействий:* {total_interactions}\n\n"
+    report += f"👥 *Всего пользователей:* {stats.total_users}\n"
+    report += f"💬 *Всего взаимодействий:* {stats.total_interactions}\n\n"
     report += "📈 *Популярность фракций:*\n"
     sorted_factions = sorted(faction_counts.items(), key=lambda item: item[1], reverse=True)
     for faction, count in sorted_factions:
@@ -156,7 +286,7 @@ async def nav_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
     query = update.callback_query
     await query.answer()
     user_id = query.from_user.id
-    nav_target = query.data.split(':')[1]
+    nav_target = context.args[0]
 
     # Сброс игрового состояния при выходе из раздела игр
     if nav_target != 'games':
@@ -174,14 +304,14 @@ async def nav_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
     elif nav_target == 'news': text, keyboard = "Выберите фракцию для подписки:", get_news_keyboard()
     elif nav_target == 'info': text, keyboard = INFO_TEXT, get_info_keyboard()
 
-    await query.edit_message_text(text, reply_markup=keyboard, parse_mode='Markdown', disable_web_page_preview=True)
+    await message_editor.edit_query(query, text, reply_markup=keyboard, parse_mode='Markdown', disable_web_page_preview=True)
 
 # ... (subscription_handler, show_public_stats, stata_command, say_command, contact_admin_start_handler остаются без изменений)
 async def subscription_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
     await query.answer()
     user_id = query.from_user.id
-    faction = query.data.split(':')[1]
+    faction = context.args[0]
     user_manager.set_user_faction(user_id, faction)
 
     await query.message.delete()
@@ -207,43 +337,112 @@ async def show_public_stats(update: Update, context: ContextTypes.DEFAULT_TYPE)
     report = generate_public_stats_report()
     menu_button = InlineKeyboardButton("⬅️ Назад", callback_data='nav:info')
     reply_markup = InlineKeyboardMarkup([[menu_button]])
-    await query.edit_message_text(text=report, parse_mode='Markdown', reply_markup=reply_markup)
+    await message_editor.edit_query(query, text=report, parse_mode='Markdown', reply_markup=reply_markup)
+
+STATA_USAGE_TEXT = (
+    "Неверный период. Примеры:\n"
+    "/stata день | неделя | месяц | вся\n"
+    "/stata 12ч | 3д | 2н - последние N часов, дней или недель\n"
+    "/stata 2024-01-01 [2024-01-31] - с даты (по дату включительно)\n"
+    "/stata когорты [период] - удержание по недельным когортам (по умолчанию 8н)"
+)
+COHORT_PERIODS = 4
+STATS_PERIOD_RE = re.compile(r'^(\d+)([чдн])$')
+STATS_PERIOD_UNITS = {'ч': ('hours', "час."), 'д': ('days', "дн."), 'н': ('weeks', "нед.")}
+
+def parse_stats_period(args, now: datetime, default: str = 'вся') -> Tuple[datetime, Optional[datetime], str]:
+    """
+    Разбирает период для /stata.
+
+    Returns:
+        Tuple[datetime, Optional[datetime], str]: Начало, конец (None - до текущего момента) и подпись периода.
+    Raises:
+        ValueError: Если период не распознан.
+    """
+    if len(args) > 2:
+        raise ValueError(args)
+    period_arg = args[0] if args else default
+    period_map = {
+        'день': (now - timedelta(days=1), "за последний день"),
+        'неделя': (now - timedelta(weeks=1), "за последнюю неделю"),
+        'месяц': (now - timedelta(days=30), "за последний месяц"),
+        'вся': (datetime(2000, 1, 1), "за всё время")
+    }
+    if period_arg in period_map and len(args) < 2:
+        start_date, period_text = period_map[period_arg]
+        return start_date, None, period_text
+    match = STATS_PERIOD_RE.match(period_arg)
+    if match and len(args) < 2:
+        amount, (unit, unit_text) = int(match.group(1)), STATS_PERIOD_UNITS[match.group(2)]
+        return now - timedelta(**{unit: amount}), None, f"за последние {amount} {unit_text}"
+    # Даты в формате ГГГГ-ММ-ДД; конечная дата входит в период
+    start_date = datetime.strptime(period_arg, "%Y-%m-%d")
+    if len(args) < 2:
+        return start_date, None, f"с {period_arg}"
+    end_date = datetime.strptime(args[1], "%Y-%m-%d") + timedelta(days=1)
+    if end_date <= start_date:
+        raise ValueError(args)
+    return start_date, end_date, f"с {period_arg} по {args[1]}"
+
+def generate_cohort_report(stats, start_ts: float, end_ts: float, period_text: str) -> str:
+    """Таблица удержания по недельным когортам: доля пользователей, возвращавшихся спустя 1..N недель."""
+    rows = stats.cohort_table(start_ts, end_ts, cohort_days=7, periods=COHORT_PERIODS)
+    report = f"📊 *Удержание по недельным когортам {period_text}*\n\n"
+    if not rows:
+        return report + "В этом периоде новых пользователей не было."
+    header = "неделя    кол-во " + " ".join(f"{f'+{k}н':>5}" for k in range(1, COHORT_PERIODS + 1))
+    lines = [header]
+    now = time.time()
+    for cohort_start, size, retained in rows:
+        cells = []
+        for k, count in enumerate(retained, start=1):
+            # Период ещё не наступил для всей когорты - удержание пока не определено
+            if cohort_start + (k + 1) * 7 * 86400 > now:
+                cells.append(f"{'—':>5}")
+            else:
+                cells.append(f"{round(100 * count / size):>4}%")
+        day = datetime.fromtimestamp(cohort_start).strftime("%d.%m.%y")
+        lines.append(f"{day:<9} {size:>6} " + " ".join(cells))
+    return report + "```\n" + "\n".join(lines) + "\n```"
 
 async def stata_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.effective_user.id
 
     if user_id == ADMIN_ID:
         # Админская логика
-        period_arg = context.args[0].lower() if context.args else 'вся'
-        now = datetime.now()
-        period_map = {
-            'день': (now - timedelta(days=1), "за последний день"),
-            'неделя': (now - timedelta(weeks=1), "за последнюю неделю"),
-            'месяц': (now - timedelta(days=30), "за последний месяц"),
-            'вся': (datetime(2000, 1, 1), "за всё время")
-        }
-        if period_arg not in period_map:
-            await update.message.reply_text("Неверный период. Используйте: день, неделя, месяц, вся.")
+        args = [arg.lower() for arg in context.args] if context.args else []
+        show_cohorts = bool(args) and args[0] == 'когорты'
+        if show_cohorts:
+            args = args[1:]
+        try:
+            start_date, end_date, period_text = parse_stats_period(args, datetime.now(), default='8н' if show_cohorts else 'вся')
+        except ValueError:
+            await update.message.reply_text(STATA_USAGE_TEXT)
             return
 
-        start_date, period_text = period_map[period_arg]
-        users = user_manager.get_all_users()
-        total_users = len(users)
-        new_users_in_period = sum(1 for u in users.values() if datetime.fromisoformat(u['first_seen']) >= start_date)
-        active_users_in_period = sum(1 for u in users.values() if datetime.fromisoformat(u['last_seen']) >= start_date)
-        total_interactions = sum(u.get('interaction_count', 0) for u in users.values())
-
-        faction_counts = {faction: 0 for faction in FACTIONS + ['Без фракции']}
-        for user_data in users.values():
-            faction = user_data.get('faction', 'None')
-            key = 'Без фракции' if faction == 'None' else faction
-            if key in faction_counts: faction_counts[key] += 1
+        stats = user_manager.get_stats()
+        if stats is None:
+            await update.message.reply_text(STATS_NOT_READY_TEXT)
+            return
+        # Почасовые гистограммы поддерживаются инкрементально: запрос за O(log часов), без обхода пользователей
+        start_ts = start_date.timestamp()
+        end_ts = end_date.timestamp() if end_date else None
+        if show_cohorts:
+            report = generate_cohort_report(stats, start_ts, end_ts or time.time(), period_text)
+            await update.message.reply_text(report, parse_mode='Markdown')
+            return
+
+        new_users_in_period = stats.count_new_between(start_ts, end_ts)
+        active_users_in_period = stats.count_active_between(start_ts, end_ts)
+        faction_counts = get_faction_counts(stats)
 
         report = f"📊 *Админская статистика {period_text}*\n\n"
         report += f"👤 *Новые пользователи:* {new_users_in_period}\n"
-        report += f"🔥 *Активные пользователи:* {active_users_in_period}\n\n"
-        report += f"👥 *Всего пользователей в базе:* {total_users}\n"
-        report += f"💬 *Всего взаимодействий за всё время:* {total_interactions}\n\n"
+        # Для закрытого периода известен только последний визит, а не вся история активности
+        active_label = "Активные пользователи" if end_date is None else "Последний визит в периоде"
+        report += f"🔥 *{active_label}:* {active_users_in_period}\n\n"
+        report += f"👥 *Всего пользователей в базе:* {stats.total_users}\n"
+        report += f"💬 *Всего взаимодействий за всё время:* {stats.total_interactions}\n\n"
         report += "📈 *Распределение по фракциям:*\n"
         for faction, count in faction_counts.items():
             if count > 0: report += f"- {faction.capitalize()}: {count}\n"
@@ -270,31 +469,150 @@ async def say_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         return
     target_faction = args[0].lower()
     message_to_send = " ".join(args[1:])
-    all_users = user_manager.get_all_users()
-    recipients = set()
     if target_faction == "все":
-        recipients = set(all_users.keys())
+        recipients = set(user_manager.get_all_users().keys())
     elif target_faction in FACTIONS:
-        for sub_id, user_data in all_users.items():
-            if user_data.get('faction') in [target_faction, 'прозрачные']:
-                recipients.add(sub_id)
+        # Подписчики берутся из индекса фракций: цена O(получателей), без обхода всей базы
+        recipients = user_manager.get_faction_audience([target_faction, 'прозрачные'])
+        if recipients is None:
+            await update.message.reply_text("Список подписчиков ещё загружается после запуска бота. Попробуйте через минуту.")
+            return
     else:
         await update.message.reply_text(f"Неизвестная фракция: {target_faction}")
         return
 
-    successful_sends = 0
-    for recipient_id in recipients:
+    # Рассылка идёт в фоне: обработчик сразу освобождается, а статус обновляется в отдельном сообщении
+    status_message = await update.message.reply_text(f"📤 Рассылка запущена: {len(recipients)} получателей.")
+    await broadcaster.start(
+        context.bot, recipients, message_to_send,
+        status_chat_id=status_message.chat_id, status_message_id=status_message.message_id
+    )
+
+BROADCAST_KIND_TITLES = {KIND_SEND: "Рассылка", KIND_EDIT: "Правка рассылки", KIND_DELETE: "Удаление рассылки"}
+
+def format_broadcast_progress(job: BroadcastJob) -> str:
+    title = BROADCAST_KIND_TITLES.get(job.kind, "Рассылка")
+    state = "✅ готово" if job.done else "📤 идёт"
+    return (
+        f"{title} #{job.job_id}: {state}\n"
+        f"Успешно: {job.sent}\n"
+        f"Ошибок: {job.failed}\n"
+        f"Осталось: {job.remaining} из {job.total}\n"
+        f"Скорость: {job.throughput:.1f} сообщ./с"
+        + (f"\nПропущено недоступных: {job.skipped}" if job.skipped else "")
+    )
+
+async def broadcasts_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Список последних рассылок с номерами для /sayedit и /saydelete."""
+    if update.effective_user.id != ADMIN_ID:
+        await update.message.reply_text("Эта команда доступна только администратору.")
+        return
+    jobs = await asyncio.to_thread(broadcaster.store.recent_jobs)
+    if not jobs:
+        await update.message.reply_text("Рассылок ещё не было.")
+        return
+    lines = ["📬 Последние рассылки:"]
+    for job in jobs:
+        created = datetime.fromtimestamp(job['created_at']).strftime("%d.%m %H:%M")
+        state = "идёт" if job['status'] == 'running' else "готово"
+        preview = (job['text'] or "")[:30]
+        lines.append(
+            f"#{job['job_id']} {created} {BROADCAST_KIND_TITLES.get(job['kind'], job['kind'])} ({state}): "
+            f"{job['sent'] or 0}/{job['total']}, ошибок {job['failed'] or 0} {preview}"
+        )
+    lines.append(f"\n🚫 Недоступных пользователей (исключены из рассылок): {broadcaster.unreachable_count}")
+    await update.message.reply_text("\n".join(lines))
+
+LEDGER_REASON_TITLES = {
+    "dice": "Кости",
+    "roulette": "Рулетка",
+    "coinflip": "Монетка",
+    "blackjack": "Блэкджек",
+    "academic_race": "Гонки Академиков",
+    "work": "Работа",
+    "bankruptcy": "Пособие по банкротству",
+}
+
+async def history_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    История изменений баланса. Пользователь видит свои последние операции,
+    администратор может посмотреть чужие: /history <ID> [количество].
+    """
+    user_id = update.effective_user.id
+    limit = 10
+    if context.args and user_id == ADMIN_ID:
         try:
-            await context.bot.send_message(chat_id=recipient_id, text=message_to_send)
-            successful_sends += 1
-        except Exception as e:
-            logger.error(f"Не удалось отправить сообщение пользователю {recipient_id}: {e}")
-    await update.message.reply_text(f"Сообщение успешно отправлено {successful_sends} из {len(recipients)} получателей.")
+            user_id = int(context.args[0])
+            if len(context.args) > 1:
+                limit = max(1, min(int(context.args[1]), 100))
+        except ValueError:
+            await update.message.reply_text("Использование: /history [ID пользователя] [количество]")
+            return
+
+    entries = user_manager.get_balance_history(user_id, limit)
+    if entries is None:
+        await update.message.reply_text("История баланса отключена.")
+        return
+    if not entries:
+        await update.message.reply_text("Операций с балансом пока не было.")
+        return
+    lines = [f"📜 Последние операции ({user_id}):"]
+    for entry in entries:
+        when = datetime.fromtimestamp(entry.timestamp).strftime("%d.%m %H:%M")
+        title = LEDGER_REASON_TITLES.get(entry.reason, entry.reason or "—")
+        lines.append(f"{when} {title}: {entry.delta:+,} → {entry.balance:,}")
+    await update.message.reply_text("\n".join(lines))
+
+async def memory_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Админская сводка: сколько памяти занимает состояние пользователей."""
+    if update.effective_user.id != ADMIN_ID:
+        await update.message.reply_text("Эта команда доступна только администратору.")
+        return
+    users_with_state, state_bytes = user_state.footprint()
+    users = user_manager.get_all_users()
+    lines = [
+        f"🧠 Состояние пользователей в памяти: {users_with_state:,} польз., ~{state_bytes / 1024:,.0f} КБ",
+        f"Удалено неактивных с запуска: {user_state.evicted:,}",
+        f"Пользователей в базе: {len(users):,}",
+    ]
+    if isinstance(users, LazyUserMap):
+        lines.append(f"Записей разобрано из снимка: {users.hydrated_count:,}")
+    lines.append(
+        f"Кэш клавиатур: {len(game_keyboards):,} шт., попаданий {game_keyboards.hits:,}, промахов {game_keyboards.misses:,}"
+    )
+    await update.message.reply_text("\n".join(lines))
+
+async def _start_broadcast_followup(update: Update, context: ContextTypes.DEFAULT_TYPE, kind: str) -> None:
+    """Общая часть /sayedit и /saydelete: действие над всеми доставленными сообщениями рассылки."""
+    if update.effective_user.id != ADMIN_ID:
+        await update.message.reply_text("Эта команда доступна только администратору.")
+        return
+    args = context.args or []
+    min_args = 2 if kind == KIND_EDIT else 1
+    if len(args) < min_args or not args[0].lstrip('#').isdigit():
+        usage = "/sayedit <номер рассылки> <новый текст>" if kind == KIND_EDIT else "/saydelete <номер рассылки>"
+        await update.message.reply_text(f"Использование: {usage}\nНомера рассылок: /broadcasts")
+        return
+    source_job_id = int(args[0].lstrip('#'))
+    text = " ".join(args[1:]) if kind == KIND_EDIT else None
+    status_message = await update.message.reply_text(f"📤 {BROADCAST_KIND_TITLES[kind]} #{source_job_id}: запуск...")
+    job = await broadcaster.start_followup(
+        context.bot, source_job_id, kind, text,
+        status_chat_id=status_message.chat_id, status_message_id=status_message.message_id
+    )
+    if job is None:
+        await status_message.edit_text(f"Рассылка #{source_job_id} не найдена.")
+
+async def say_edit_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await _start_broadcast_followup(update, context, KIND_EDIT)
+
+async def say_delete_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await _start_broadcast_followup(update, context, KIND_DELETE)
 
 async def contact_admin_start_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
     await query.answer()
-    contact_type = query.data.split(':')[1]
+    contact_type = context.args[0]
     context.user_data['contact_state'] = 'awaiting_admin_message'
     context.user_data['contact_type'] = contact_type
 
@@ -303,7 +621,7 @@ async def contact_admin_start_handler(update: Update, context: ContextTypes.DEFA
 
     cancel_button = InlineKeyboardButton("⬅️ Назад", callback_data='nav:info')
     reply_markup = InlineKeyboardMarkup([[cancel_button]])
-    await query.edit_message_text(
+    await message_editor.edit_query(query, 
         text=f"{prompt_text}\n\nОтправьте свой текст следующим сообщением.",
         reply_markup=reply_markup
     )
@@ -317,9 +635,9 @@ async def work_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     is_allowed, time_left = user_manager.check_work_cooldown(user_id)
     if is_allowed:
         work_bonus = 5000
-        user_manager.update_user_balance(user_id, work_bonus)
+        user_manager.update_user_balance(user_id, work_bonus, reason='work')
         await query.answer(f"Вы славно потрудились и заработали {work_bonus:,} дукатов!", show_alert=True)
-        await query.edit_message_reply_markup(reply_markup=get_games_keyboard(user_id))
+        await message_editor.edit_query(query, reply_markup=get_games_keyboard(user_id))
     else:
         minutes, seconds = divmod(int(time_left.total_seconds()), 60)
         await query.answer(f"Вы слишком устали. Возвращайтесь через {minutes} мин {seconds} сек.", show_alert=True)
@@ -334,13 +652,14 @@ async def game_start_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
     user_id = query.from_user.id
 
     # --- Шаг 1: Базовая настройка ---
-    parts = query.data.split(':')
-    game_id = parts[2]
+    game_id = context.args[0]
     game = GAMES.get(game_id)
 
     # Если игрок нажал "Новая ставка", сбрасываем ее
-    if len(parts) > 3 and parts[3] == 'new':
+    if context.args[1:2] == ['new']:
         context.user_data.pop('current_bet', None)
+    # Сообщение снова показывает игру - на нём можно сыграть новый раунд (см. Game.is_round_settled)
+    context.user_data.pop('settled_message_id', None)
 
     # --- Шаг 2: Проверяем, требует ли игра ставку (используем наш новый флаг!) ---
     if game.requires_bet:
@@ -352,7 +671,7 @@ async def game_start_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
         text = game.get_rules_text(balance, current_bet)
         keyboard = game.get_game_keyboard(context)
 
-        await query.edit_message_text(
+        await message_editor.edit_query(query, 
             text=text,
             reply_markup=keyboard,
             parse_mode='Markdown'
@@ -370,7 +689,7 @@ async def game_start_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
         text = game.get_rules_text(balance, 0) # Ставка равна 0
         keyboard = game.get_game_keyboard(context) # Клавиатура с кнопкой "Начать!"
 
-        await query.edit_message_text(
+        await message_editor.edit_query(query, 
             text=text,
             reply_markup=keyboard,
             parse_mode='Markdown'
@@ -381,8 +700,8 @@ async def game_modify_bet_handler(update: Update, context: ContextTypes.DEFAULT_
     query = update.callback_query
     user_id = query.from_user.id
 
-    parts = query.data.split(':') # game:modify:dice:multiply:2 или game:modify:roulette:allin
-    game_id, action = parts[2], parts[3]
+    # game:modify:dice:multiply:2 или game:modify:roulette:allin
+    game_id, action = context.args[0], context.args[1]
     game = GAMES.get(game_id)
 
     current_bet = context.user_data.get('current_bet', 0)
@@ -393,7 +712,7 @@ async def game_modify_bet_handler(update: Update, context: ContextTypes.DEFAULT_
     balance = user_manager.get_user_balance(user_id)
     new_bet = 0
     if action == 'multiply':
-        multiplier = int(parts[4])
+        multiplier = int(context.args[2])
         new_bet = current_bet * multiplier
     elif action == 'allin':
         new_bet = balance
@@ -408,31 +727,27 @@ async def game_modify_bet_handler(update: Update, context: ContextTypes.DEFAULT_
 
     context.user_data['current_bet'] = new_bet
     await query.answer(f"Ставка изменена на {new_bet:,}")
-    await query.edit_message_reply_markup(reply_markup=game.get_game_keyboard(context))
+    await message_editor.edit_query(query, reply_markup=game.get_game_keyboard(context))
 
-async def game_play_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+async def post_init_handler(application: Application) -> None:
     """
-    Универсальный обработчик для основного действия игры.
-    Теперь он НЕ проверяет баланс, а полностью делегирует это классу игры.
+    Вызывается при запуске бота: продолжает рассылки, прерванные прошлой остановкой,
+    и таймеры игр, чьё состояние восстановлено из STATE_DB_PATH.
     """
-    query = update.callback_query
-    await query.answer() # Сразу отвечаем на колбэк, чтобы кнопка не "зависала"
-
-    game_id = query.data.split(':')[2]
-    game = GAMES.get(game_id)
-
-    # Проверки на наличие ставки и ее корректность теперь полностью
-    # находятся внутри метода .play() каждого конкретного игрового класса.
-    # Это правильно с точки зрения архитектуры.
-    if game:
-        await game.play(update, context)
-    else:
-        logger.warning(f"Получен вызов для несуществующей игры: {game_id}")
+    for user_id, data in application.user_data.items():
+        for game in GAMES.values():
+            game.resume(application, user_id, data)
+    await broadcaster.resume(application.bot)
 
 async def shutdown_handler(application: Application) -> None:
     """Вызывается при остановке бота для финального сохранения данных."""
     logger.info("Сигнал остановки получен. Выполняю финальное сохранение данных...")
-    user_manager.force_save()
+    # Несработавшие таймеры игр не нужны: идущие раунды восстановит resume() при следующем запуске
+    await timers.aclose()
+    await broadcaster.aclose()
+    broadcaster.store.close()
+    await user_manager.force_save()
+    await user_manager.aclose()
     logger.info("Финальное сохранение завершено. Бот выключен.")
 
 # --- ОБНОВЛЕННЫЙ УНИВЕРСАЛЬНЫЙ ОБРАБОТЧИК ТЕКСТА ---
@@ -522,55 +837,118 @@ async def text_message_router(update: Update, context: ContextTypes.DEFAULT_TYPE
             reply_markup=get_main_keyboard() # Показываем клавиатуру главного меню
         )
 
+async def run_webhook(application: Application) -> None:
+    """
+    Запускает бота в режиме вебхука: апдейты принимает WebhookServer и кладёт
+    в очередь приложения. post_init/post_shutdown вызываются вручную, так как
+    их вызывает только run_polling/run_webhook самой библиотеки.
+    """
+    loop = asyncio.get_running_loop()
+    stop_event = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    await application.initialize()
+    await post_init_handler(application)
+    await application.start()
+    server = WebhookServer(
+        application, loop, WEBHOOK_SECRET,
+        listen=WEBHOOK_LISTEN, port=WEBHOOK_PORT, url_path=WEBHOOK_PATH, max_pending=WEBHOOK_MAX_PENDING
+    )
+    server.start()
+    try:
+        await application.bot.set_webhook(
+            url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=Update.ALL_TYPES
+        )
+        await stop_event.wait()
+    finally:
+        server.stop()
+        await application.stop()
+        await application.shutdown()
+        await shutdown_handler(application)
+
 def main() -> None:
         # Настраиваем более устойчивые сетевые параметры
     # connect_timeout - время на установку соединения
     # read_timeout - время на ожидание ответа от сервера (должно быть больше polling_timeout)
     # pool_timeout - время жизни соединений в пуле
+    # connection_pool_size - сколько запросов к Telegram может идти одновременно
+    # (по умолчанию 1, и параллельные обработчики и рассылки выстраивались бы в очередь)
     request = HTTPXRequest(
+        connection_pool_size=max(UPDATE_CONCURRENCY, 32),
         connect_timeout=10.0,
         read_timeout=60.0,
         pool_timeout=None  # None означает отсутствие тайм-аута для пула
     )
 
-    application = (
+    builder = (
         Application.builder()
         .token(TOKEN)
         .job_queue(JobQueue())
         .request(request)
+        # Апдейты разных пользователей - параллельно, одного пользователя - строго по порядку
+        # Предел принятых апдейтов - не меньше лимита вебхука, чтобы семафор базового класса
+        # (он выдаёт слоты не по очереди) не задерживал апдейты до очереди пользователя
+        .concurrent_updates(PerUserUpdateProcessor(
+            UPDATE_CONCURRENCY, max_pending_updates=WEBHOOK_MAX_PENDING, on_drop=answer_flooded
+        ))
+        .post_init(post_init_handler)
         .post_shutdown(shutdown_handler)
-        .build()
     )
+    if STATE_DB_PATH:
+        builder = builder.persistence(SQLitePersistence(STATE_DB_PATH, update_interval=STATE_FLUSH_INTERVAL))
+    if TELEGRAM_BASE_URL:
+        # Например, локальный Bot API сервер или заглушка для тестов вебхука
+        builder = builder.base_url(TELEGRAM_BASE_URL)
+    application = builder.build()
 
     application.add_handler(TypeHandler(Update, track_user_activity), group=-1)
 
     # Команды
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("say", say_command))
+    application.add_handler(CommandHandler("sayedit", say_edit_command))
+    application.add_handler(CommandHandler("saydelete", say_delete_command))
+    application.add_handler(CommandHandler("broadcasts", broadcasts_command))
     application.add_handler(CommandHandler("stata", stata_command))
+    application.add_handler(CommandHandler("history", history_command))
+    application.add_handler(CommandHandler("memory", memory_command))
 
+    # Все инлайн-кнопки - через один диспетчер с таблицей маршрутов (см. callbacks.py)
+    callbacks = CallbackDispatcher()
     # Навигация и основные кнопки
-    application.add_handler(CallbackQueryHandler(nav_handler, pattern='^nav:'))
-    application.add_handler(CallbackQueryHandler(subscription_handler, pattern='^sub:'))
-    application.add_handler(CallbackQueryHandler(show_public_stats, pattern='^get_public_stats$'))
-    application.add_handler(CallbackQueryHandler(contact_admin_start_handler, pattern='^contact:'))
-    application.add_handler(CallbackQueryHandler(lambda u, c: u.callback_query.answer(), pattern='^do_nothing$'))
+    callbacks.register('nav', nav_handler)
+    callbacks.register('sub', subscription_handler)
+    callbacks.register('get_public_stats', show_public_stats)
+    callbacks.register('contact', contact_admin_start_handler)
+    callbacks.register('do_nothing', lambda u, c: u.callback_query.answer())
 
     # Игровые обработчики (теперь полностью универсальные)
-    application.add_handler(CallbackQueryHandler(work_handler, pattern='^game:work$'))
-    application.add_handler(CallbackQueryHandler(game_start_handler, pattern=r'^game:start:'))
-    application.add_handler(CallbackQueryHandler(game_modify_bet_handler, pattern=r'^game:modify:'))
-    application.add_handler(CallbackQueryHandler(game_play_handler, pattern=r'^game:play:'))
+    callbacks.register('game:work', work_handler)
+    callbacks.register('game:start', game_start_handler)
+    callbacks.register('game:modify', game_modify_bet_handler)
+    # Кнопки самих игр каждая игра регистрирует сама
+    for game in GAMES.values():
+        game.register_callbacks(callbacks)
+    application.add_handler(callbacks)
 
     # Универсальный обработчик текста
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, text_message_router))
 
     # --- ЗАПУСК АВТОСОХРАНЕНИЯ ПОСЛЕ СОЗДАНИЯ ПРИЛОЖЕНИЯ ---
     # Мы передаем в менеджер очередь задач из нашего приложения.
-    user_manager.start_autosave(application.job_queue, interval_seconds=3600) # 3600 секунд = 1 час
+    user_manager.start_autosave(application.job_queue, interval_seconds=AUTOSAVE_INTERVAL)
+    user_manager.start_activity_flush(application.job_queue, interval_seconds=ACTIVITY_FLUSH_INTERVAL)
+    user_state.start(application)
 
-    print("Бот запущен...")
-    application.run_polling()
+    if WEBHOOK_URL:
+        print("Бот запущен в режиме вебхука...")
+        asyncio.run(run_webhook(application))
+    else:
+        print("Бот запущен...")
+        application.run_polling()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,194 @@
+# Файл: message_edits.py
+"""
+Слой редактирования сообщений бота.
+
+- Для каждого сообщения (чат, ID) запоминается отпечаток последнего отправленного
+  состояния: текст, клавиатура и параметры разметки. Правка, которая ничего не меняет,
+  не отправляется: это экономит запрос к Bot API и избавляет от ошибки
+  "message is not modified".
+- Быстрые последовательные правки одного сообщения (серия нажатий x2/x10) склеиваются:
+  первая уходит сразу, а следующие в пределах окна `debounce_seconds` заменяют друг
+  друга, и по истечении окна отправляется только последняя.
+
+Все правки сообщений с кнопками должны идти через этот слой, иначе сохранённый отпечаток
+устареет и нужная правка может быть ошибочно пропущена.
+"""
+
+# --- 1. ИМПОРТЫ ---
+
+import asyncio
+import logging
+from collections import OrderedDict
+
+from telegram import CallbackQuery, InlineKeyboardMarkup
+from telegram.error import BadRequest
+
+# Импорты для тайп-хинтинга
+from typing import Any, Dict, Optional, Tuple
+
+
+# --- 2. НАСТРОЙКИ И КОНСТАНТЫ ---
+
+logger = logging.getLogger(__name__)
+
+# Окно, в котором повторные правки одного сообщения склеиваются в одну
+EDIT_DEBOUNCE_SECONDS = 0.5
+# Сколько сообщений помнить; давно не редактированные вытесняются
+MAX_TRACKED_MESSAGES = 10000
+
+# Текст сообщения неизвестен (правили только клавиатуру сообщения, которое ещё не видели)
+_UNKNOWN_TEXT = object()
+
+
+class _EditRequest:
+    __slots__ = ('bot', 'text', 'reply_markup', 'kwargs', 'fingerprint')
+
+    def __init__(self, bot, text: Optional[str], reply_markup: Optional[InlineKeyboardMarkup],
+                 kwargs: Dict[str, Any], fingerprint: Tuple):
+        self.bot = bot
+        self.text = text
+        self.reply_markup = reply_markup
+        self.kwargs = kwargs
+        self.fingerprint = fingerprint
+
+
+class _MessageSlot:
+    """Состояние одного сообщения: последний отпечаток, время отправки и отложенная правка."""
+    __slots__ = ('fingerprint', 'sent_at', 'pending', 'timer')
+
+    def __init__(self):
+        self.fingerprint: Optional[Tuple] = None
+        self.sent_at = float('-inf')
+        self.pending: Optional[_EditRequest] = None
+        self.timer: Optional[asyncio.Task] = None
+
+
+# --- 3. РЕДАКТОР СООБЩЕНИЙ ---
+
+class MessageEditor:
+    """
+    Отправляет правки сообщений, пропуская повторы и склеивая частые правки.
+    """
+    def __init__(self, debounce_seconds: float = EDIT_DEBOUNCE_SECONDS, max_tracked: int = MAX_TRACKED_MESSAGES):
+        self._window = debounce_seconds
+        self._max_tracked = max_tracked
+        self._slots: "OrderedDict[Tuple[int, int], _MessageSlot]" = OrderedDict()
+        self.sent = 0
+        self.skipped = 0
+        self.coalesced = 0
+
+    def _slot(self, key: Tuple[int, int]) -> _MessageSlot:
+        slot = self._slots.get(key)
+        if slot is not None:
+            self._slots.move_to_end(key)
+            return slot
+        slot = self._slots[key] = _MessageSlot()
+        if len(self._slots) > self._max_tracked:
+            # Отложенная правка вытесненного сообщения всё равно будет отправлена - задача держит свой слот
+            self._slots.popitem(last=False)
+        return slot
+
+    async def edit(self, bot, chat_id: int, message_id: int, text: Optional[str] = None,
+                   reply_markup: Optional[InlineKeyboardMarkup] = None, debounce: bool = True, **kwargs) -> None:
+        """
+        Редактирует сообщение. Без `text` меняется только клавиатура.
+
+        Args:
+            debounce (bool): Разрешить отложить правку, если сообщение только что редактировалось.
+                Правки, после которых сразу запускается таймер (гонка академиков), передают False.
+            **kwargs: Прочие параметры edit_message_text (parse_mode и т.п.).
+        """
+        key = (chat_id, message_id)
+        slot = self._slot(key)
+        if text is None:
+            # Текст и его разметка не меняются - берём их из прошлого отпечатка
+            text_part, options = (slot.fingerprint[0], slot.fingerprint[2]) if slot.fingerprint else (_UNKNOWN_TEXT, ())
+        else:
+            text_part, options = text, tuple(sorted(kwargs.items()))
+        fingerprint = (text_part, reply_markup, options)
+        request = _EditRequest(bot, text, reply_markup, kwargs, fingerprint)
+
+        if slot.timer is not None:
+            if debounce:
+                # Отложенная правка уже запланирована - она отправит самое свежее состояние.
+                # Правка одной клавиатуры не должна потерять ещё не отправленный новый текст.
+                pending = slot.pending
+                if text is None and pending is not None and pending.text is not None:
+                    request = _EditRequest(bot, pending.text, reply_markup, pending.kwargs,
+                                           (pending.fingerprint[0], reply_markup, pending.fingerprint[2]))
+                slot.pending = request
+                self.coalesced += 1
+                return
+            slot.timer.cancel()
+            slot.timer, slot.pending = None, None
+
+        if fingerprint == slot.fingerprint:
+            self.skipped += 1
+            return
+
+        delay = slot.sent_at + self._window - asyncio.get_running_loop().time()
+        if debounce and delay > 0:
+            slot.pending = request
+            slot.timer = asyncio.create_task(self._send_later(key, slot, delay))
+            return
+        await self._send(key, slot, request)
+
+    async def edit_query(self, query: CallbackQuery, text: Optional[str] = None,
+                         reply_markup: Optional[InlineKeyboardMarkup] = None, debounce: bool = True, **kwargs) -> None:
+        """То же, что `edit`, для сообщения, на кнопку которого нажали."""
+        message = query.message
+        if message is None:
+            # Сообщение недоступно боту (слишком старое) - правим напрямую, без учёта
+            if text is None:
+                await query.edit_message_reply_markup(reply_markup=reply_markup)
+            else:
+                await query.edit_message_text(text, reply_markup=reply_markup, **kwargs)
+            return
+        await self.edit(query.get_bot(), message.chat_id, message.message_id, text, reply_markup, debounce, **kwargs)
+
+    async def _send_later(self, key: Tuple[int, int], slot: _MessageSlot, delay: float) -> None:
+        await asyncio.sleep(delay)
+        slot.timer = None
+        request, slot.pending = slot.pending, None
+        if request is None or request.fingerprint == slot.fingerprint:
+            return
+        try:
+            await self._send(key, slot, request)
+        except Exception as e:
+            logger.warning(f"Не удалось применить отложенную правку сообщения {key}: {e}")
+
+    async def _send(self, key: Tuple[int, int], slot: _MessageSlot, request: _EditRequest) -> None:
+        # Отпечаток и время фиксируются до запроса: правка, пришедшая во время него,
+        # сравнивается уже с новым состоянием и при необходимости откладывается
+        slot.sent_at = asyncio.get_running_loop().time()
+        slot.fingerprint = request.fingerprint
+        chat_id, message_id = key
+        try:
+            if request.text is None:
+                await request.bot.edit_message_reply_markup(
+                    chat_id=chat_id, message_id=message_id, reply_markup=request.reply_markup
+                )
+            else:
+                await request.bot.edit_message_text(
+                    request.text, chat_id=chat_id, message_id=message_id,
+                    reply_markup=request.reply_markup, **request.kwargs
+                )
+            self.sent += 1
+        except BadRequest as e:
+            if "not modified" in str(e).lower():
+                return
+            slot.fingerprint = None
+            raise
+        except Exception:
+            slot.fingerprint = None
+            raise
+
+    def forget(self, chat_id: int, message_id: int) -> None:
+        """Забывает сообщение (например, после удаления)."""
+        slot = self._slots.pop((chat_id, message_id), None)
+        if slot and slot.timer:
+            slot.timer.cancel()
+
+
+# Общий редактор для обработчиков и игр
+message_editor = MessageEditor()
@@ -1,4 +1,5 @@
 from game_base import *
+from message_edits import message_editor
 
 # --- ИГРОВЫЕ КОНСТАНТЫ ---
 ROULETTE_PAYOUT_GREEN = 36
@@ -7,6 +8,9 @@ ROULETTE_RED_NUMBERS = [1, 3, 5, 7, 9, 12, 14, 16, 18, 19, 21, 23, 25, 27, 30, 3
 ROULETTE_BLACK_NUMBERS = [2, 4, 6, 8, 10, 11, 13, 15, 17, 20, 22, 24, 26, 28, 29, 31, 33, 35]
 
 class DiceGame(Game):
+    # На колбэк отвечает settle_round
+    answers_callback = True
+
     def get_rules_text(self, balance: int, bet: int) -> str:
         bet_text = f"Текущая ставка: *{bet:,}* дукатов." if bet > 0 else "Отправьте в чат сумму, которую хотите поставить."
         return (
@@ -21,11 +25,11 @@ class DiceGame(Game):
             "- *3* одинаковых кубика (тройка): выигрыш *x10*."
         )
 
-    def get_game_keyboard(self, context: ContextTypes.DEFAULT_TYPE) -> InlineKeyboardMarkup:
-        current_bet = context.user_data.get('current_bet', 0)
-        bet_text = f"Ставка: {current_bet:,} дукатов" if current_bet > 0 else "Сделайте ставку!"
-        keyboard = [
-            [InlineKeyboardButton(bet_text, callback_data='do_nothing')],
+    def get_bet_label(self, bet: int) -> str:
+        return f"Ставка: {bet:,} дукатов" if bet > 0 else "Сделайте ставку!"
+
+    def build_control_rows(self) -> KeyboardRows:
+        return [
             [InlineKeyboardButton("🎲 Бросить кубики!", callback_data=f'game:play:{self.id}')],
             [
                 InlineKeyboardButton("x2", callback_data=f'game:modify:{self.id}:multiply:2'),
@@ -38,14 +42,14 @@ class DiceGame(Game):
                 InlineKeyboardButton("⬅️ Выйти", callback_data='nav:games')
             ]
         ]
-        return InlineKeyboardMarkup(keyboard)
+
+    def get_game_keyboard(self, context: ContextTypes.DEFAULT_TYPE) -> InlineKeyboardMarkup:
+        return self.get_bet_keyboard(context.user_data.get('current_bet', 0))
 
     async def play(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         query = update.callback_query
-        user_id = query.from_user.id
         bet = context.user_data.get('current_bet', 0)
 
-        self.user_manager.update_user_balance(user_id, -bet)
         d1, d2, d3 = random.randint(1, 6), random.randint(1, 6), random.randint(1, 6)
         dice_sum = d1 + d2 + d3
         dice_icons = {1: '⚀', 2: '⚁', 3: '⚂', 4: '⚃', 5: '⚄', 6: '⚅'}
@@ -68,14 +72,15 @@ class DiceGame(Game):
             winnings = 0
             result_text += f"😥 *ПОРАЖЕНИЕ!* Вы проиграли: `0`"
         
-        if winnings > 0:
-            self.user_manager.update_user_balance(user_id, winnings)
-        
-        final_balance = self.user_manager.get_user_balance(user_id)
-        result_text += f"\n\nВаш итоговый баланс: *{final_balance:,}* дукатов."
-        await query.edit_message_text(result_text, reply_markup=self.get_replay_keyboard(), parse_mode='Markdown')
+        transaction = await self.settle_round(query, context, bet, winnings)
+        if transaction is None:
+            return
+        result_text += f"\n\nВаш итоговый баланс: *{transaction.balance:,}* дукатов."
+        await message_editor.edit_query(query, result_text, reply_markup=self.get_replay_keyboard(), parse_mode='Markdown')
 
 class RouletteGame(Game):
+    answers_callback = True
+
     def get_rules_text(self, balance: int, bet: int) -> str:
         bet_text = f"Текущая ставка: *{bet:,}* дукатов." if bet > 0 else "Отправьте в чат сумму, которую хотите поставить."
         return (
@@ -87,11 +92,8 @@ class RouletteGame(Game):
             f"- *Зелёное (Зеро)*: выигрыш *x{ROULETTE_PAYOUT_GREEN}*."
         )
 
-    def get_game_keyboard(self, context: ContextTypes.DEFAULT_TYPE) -> InlineKeyboardMarkup:
-        current_bet = context.user_data.get('current_bet', 0)
-        bet_text = f"Ставка: {current_bet:,}" if current_bet > 0 else "Сделайте ставку!"
-        keyboard = [
-            [InlineKeyboardButton(bet_text, callback_data='do_nothing')],
+    def build_control_rows(self) -> KeyboardRows:
+        return [
             [
                 InlineKeyboardButton(f"🔴 Красное", callback_data=f'game:play:{self.id}:red'),
                 InlineKeyboardButton(f"⚫️ Чёрное", callback_data=f'game:play:{self.id}:black')
@@ -106,14 +108,14 @@ class RouletteGame(Game):
             [InlineKeyboardButton("✏️ Новая ставка", callback_data=f'game:start:{self.id}:new')],
             [InlineKeyboardButton("⬅️ Выйти", callback_data='nav:games')]
         ]
-        return InlineKeyboardMarkup(keyboard)
+
+    def get_game_keyboard(self, context: ContextTypes.DEFAULT_TYPE) -> InlineKeyboardMarkup:
+        return self.get_bet_keyboard(context.user_data.get('current_bet', 0))
 
     async def play(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         query = update.callback_query
-        user_id = query.from_user.id
         bet = context.user_data.get('current_bet', 0)
         
-        self.user_manager.update_user_balance(user_id, -bet)
         roll = random.randint(0, 36)
         
         winning_color, winning_color_icon = None, ""
@@ -123,7 +125,7 @@ class RouletteGame(Game):
             
         result_text = f"Ваша ставка: *{bet:,}*\nВыпало: {winning_color_icon} *{roll} {winning_color.capitalize()}*\n\n"
         
-        player_choice = query.data.split(':')[-1]
+        player_choice = context.args[-1]
         winnings = 0
         if player_choice == winning_color:
             payout = ROULETTE_PAYOUT_GREEN if winning_color == "green" else ROULETTE_PAYOUT_COLOR
@@ -132,14 +134,15 @@ class RouletteGame(Game):
         else:
             result_text += f"😥 *ПОРАЖЕНИЕ!* Увы, вы проиграли: `0`"
 
-        if winnings > 0:
-            self.user_manager.update_user_balance(user_id, winnings)
-            
-        final_balance = self.user_manager.get_user_balance(user_id)
-        result_text += f"\n\nВаш итоговый баланс: *{final_balance:,}* дукатов."
-        await query.edit_message_text(result_text, reply_markup=self.get_replay_keyboard(), parse_mode='Markdown')
+        transaction = await self.settle_round(query, context, bet, winnings)
+        if transaction is None:
+            return
+        result_text += f"\n\nВаш итоговый баланс: *{transaction.balance:,}* дукатов."
+        await message_editor.edit_query(query, result_text, reply_markup=self.get_replay_keyboard(), parse_mode='Markdown')
 
 class CoinFlipGame(Game):
+    answers_callback = True
+
     def get_rules_text(self, balance: int, bet: int) -> str:
         bet_text = f"Текущая ставка: *{bet:,}* дукатов." if bet > 0 else "Отправьте в чат сумму, которую хотите поставить."
         return (
@@ -151,11 +154,8 @@ class CoinFlipGame(Game):
             f"- Не угадали - теряете ставку."
         )
 
-    def get_game_keyboard(self, context: ContextTypes.DEFAULT_TYPE) -> InlineKeyboardMarkup:
-        current_bet = context.user_data.get('current_bet', 0)
-        bet_text = f"Ставка: {current_bet:,}" if current_bet > 0 else "Сделайте ставку!"
-        keyboard = [
-            [InlineKeyboardButton(bet_text, callback_data='do_nothing')],
+    def build_control_rows(self) -> KeyboardRows:
+        return [
             [
                 InlineKeyboardButton("🦅 Орёл", callback_data=f'game:play:{self.id}:heads'),
                 InlineKeyboardButton("🪙 Решка", callback_data=f'game:play:{self.id}:tails')
@@ -169,18 +169,17 @@ class CoinFlipGame(Game):
             [InlineKeyboardButton("✏️ Новая ставка", callback_data=f'game:start:{self.id}:new')],
             [InlineKeyboardButton("⬅️ Выйти", callback_data='nav:games')]
         ]
-        return InlineKeyboardMarkup(keyboard)
+
+    def get_game_keyboard(self, context: ContextTypes.DEFAULT_TYPE) -> InlineKeyboardMarkup:
+        return self.get_bet_keyboard(context.user_data.get('current_bet', 0))
 
     async def play(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         query = update.callback_query
-        user_id = query.from_user.id
         bet = context.user_data.get('current_bet', 0)
-
-        self.user_manager.update_user_balance(user_id, -bet)
         
         # Симулируем бросок
         result = random.choice(['heads', 'tails'])
-        player_choice = query.data.split(':')[-1]
+        player_choice = context.args[-1]
 
         result_icon = "🦅" if result == 'heads' else "🪙"
         result_word = "Орёл" if result == 'heads' else "Решка"
@@ -194,9 +193,8 @@ class CoinFlipGame(Game):
             winnings = 0
             result_text += f"😥 *ПОРАЖЕНИЕ!* В следующий раз повезёт: `0`"
         
-        if winnings > 0:
-            self.user_manager.update_user_balance(user_id, winnings)
-        
-        final_balance = self.user_manager.get_user_balance(user_id)
-        result_text += f"\n\nВаш итоговый баланс: *{final_balance:,}* дукатов."
-        await query.edit_message_text(result_text, reply_markup=self.get_replay_keyboard(), parse_mode='Markdown')
+        transaction = await self.settle_round(query, context, bet, winnings)
+        if transaction is None:
+            return
+        result_text += f"\n\nВаш итоговый баланс: *{transaction.balance:,}* дукатов."
+        await message_editor.edit_query(query, result_text, reply_markup=self.get_replay_keyboard(), parse_mode='Markdown')
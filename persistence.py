@@ -0,0 +1,192 @@
+# Файл: persistence.py
+"""
+Сохранение context.user_data между перезапусками бота.
+
+Без этого перезапуск терял незавершённые игры: ставка открытой раздачи блэкджека уже
+списана, а раздача исчезала; гонки академиков обрывались. SQLitePersistence - реализация
+BasePersistence из python-telegram-bot поверх локального SQLite (режим WAL):
+
+- user_data каждого пользователя хранится отдельной строкой в компактном бинарном виде (pickle);
+- Application раз в `update_interval` секунд передаёт только пользователей, у которых были
+  апдейты; если закодированное состояние не изменилось, строка не перезаписывается;
+- все изменения одного цикла сохранения пишутся одной транзакцией в рабочем потоке.
+
+Сохраняется только user_data: chat_data, bot_data и callback_data бот не использует.
+"""
+
+# --- 1. ИМПОРТЫ ---
+
+import asyncio
+import logging
+import pickle
+import sqlite3
+import threading
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+# Импорты для тайп-хинтинга
+from typing import Any, Dict, Optional
+
+
+# --- 2. НАСТРОЙКИ И КОНСТАНТЫ ---
+
+logger = logging.getLogger(__name__)
+
+# Через сколько секунд повторить запись после ошибки SQLite (например, занятой базы)
+WRITE_RETRY_SECONDS = 5.0
+
+
+# --- 3. ХРАНИЛИЩЕ СОСТОЯНИЯ ---
+
+class SQLitePersistence(BasePersistence):
+    """
+    Хранит user_data в SQLite. Изменения копятся в памяти и записываются пачкой
+    после каждого цикла сохранения Application и при остановке (flush).
+    """
+    def __init__(self, path: str, update_interval: float = 10):
+        """
+        Args:
+            path (str): Путь к файлу базы.
+            update_interval (float): Как часто Application передаёт изменения, в секундах.
+        """
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval
+        )
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS user_data ("
+            " user_id INTEGER PRIMARY KEY,"
+            " data BLOB NOT NULL"
+            ")"
+        )
+        self._conn.commit()
+        # ID пользователя -> хеш последнего записанного состояния (чтобы не писать неизменившееся)
+        self._written: Dict[int, int] = {}
+        # Изменения, ещё не записанные в базу: ID -> закодированное состояние (None - удалить)
+        self._pending: Dict[int, Optional[bytes]] = {}
+        self._write_task: Optional[asyncio.Task] = None
+        self._flushing = False
+
+    # --- Запись ---
+
+    def _write_batch(self, batch: Dict[int, Optional[bytes]]) -> None:
+        upserts = [(user_id, data) for user_id, data in batch.items() if data is not None]
+        deletes = [(user_id,) for user_id, data in batch.items() if data is None]
+        with self._lock:
+            with self._conn:
+                if upserts:
+                    self._conn.executemany(
+                        "INSERT INTO user_data (user_id, data) VALUES (?, ?)"
+                        " ON CONFLICT(user_id) DO UPDATE SET data = excluded.data",
+                        upserts
+                    )
+                if deletes:
+                    self._conn.executemany("DELETE FROM user_data WHERE user_id = ?", deletes)
+
+    async def _write_pending(self, delay: float = 0) -> None:
+        # Application вызывает update_user_data для всех пользователей цикла подряд
+        # (asyncio.gather); одна уступка циклу событий - и вся пачка уже собрана
+        await asyncio.sleep(delay)
+        self._write_task = None
+        batch, self._pending = self._pending, {}
+        if not batch:
+            return
+        try:
+            await asyncio.to_thread(self._write_batch, batch)
+        except sqlite3.Error as e:
+            logger.error(f"Не удалось сохранить состояние {len(batch)} пользователей: {e}")
+            # Вернём в очередь то, что не перезаписано более свежими изменениями
+            for user_id, data in batch.items():
+                self._pending.setdefault(user_id, data)
+                self._written.pop(user_id, None)
+            # Без повтора пачка ждала бы следующего изменения, которого может и не быть.
+            # При остановке повтор не нужен: flush сам запишет остаток.
+            if not self._flushing:
+                self._schedule_write(WRITE_RETRY_SECONDS)
+
+    def _schedule_write(self, delay: float = 0) -> None:
+        if self._write_task is None:
+            self._write_task = asyncio.create_task(self._write_pending(delay))
+
+    async def update_user_data(self, user_id: int, data: Dict[Any, Any]) -> None:
+        encoded = pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL)
+        fingerprint = hash(encoded)
+        if self._written.get(user_id) == fingerprint:
+            return
+        self._written[user_id] = fingerprint
+        self._pending[user_id] = encoded
+        self._schedule_write()
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._written.pop(user_id, None)
+        self._pending[user_id] = None
+        self._schedule_write()
+
+    async def flush(self) -> None:
+        self._flushing = True
+        if self._write_task is not None:
+            await self._write_task
+        if self._pending:
+            batch, self._pending = self._pending, {}
+            await asyncio.to_thread(self._write_batch, batch)
+        with self._lock:
+            self._conn.close()
+
+    # --- Чтение ---
+
+    async def get_user_data(self) -> Dict[int, Dict[Any, Any]]:
+        with self._lock:
+            rows = self._conn.execute("SELECT user_id, data FROM user_data").fetchall()
+        user_data = {}
+        for user_id, data in rows:
+            try:
+                user_data[user_id] = pickle.loads(data)
+            except Exception as e:
+                logger.warning(f"Повреждённое состояние пользователя {user_id} пропущено: {e}")
+                continue
+            self._written[user_id] = hash(bytes(data))
+        logger.info(f"Восстановлено состояние {len(user_data)} пользователей из {self.path}.")
+        return user_data
+
+    async def refresh_user_data(self, user_id: int, user_data: Dict[Any, Any]) -> None:
+        pass
+
+    # --- Неиспользуемые виды данных ---
+
+    async def get_chat_data(self) -> Dict[int, Any]:
+        return {}
+
+    async def get_bot_data(self) -> Dict[Any, Any]:
+        return {}
+
+    async def get_callback_data(self) -> None:
+        return None
+
+    async def get_conversations(self, name: str) -> Dict:
+        return {}
+
+    async def update_chat_data(self, chat_id: int, data: Any) -> None:
+        pass
+
+    async def update_bot_data(self, data: Any) -> None:
+        pass
+
+    async def update_callback_data(self, data: Any) -> None:
+        pass
+
+    async def update_conversation(self, name: str, key: Any, new_state: Optional[object]) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: Any) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: Any) -> None:
+        pass
@@ -0,0 +1,509 @@
+# Файл: storage.py
+"""
+Бэкенды хранения данных пользователей для UserDataManager.
+
+- StorageBackend: Абстрактный интерфейс хранилища (загрузка и асинхронное сохранение).
+- SnapshotIndex: Индекс сырых записей для "ленивой" загрузки (записи разбираются при первом обращении).
+- JsonBinStorage: Облачное хранилище JSONBin.io (весь "бин" целиком).
+- SQLiteStorage: Локальная база SQLite в режиме WAL, пишет только изменившиеся строки.
+"""
+
+# --- 1. ИМПОРТЫ ---
+
+import asyncio
+import json
+import logging
+import mmap
+import os
+import re
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from array import array
+from bisect import bisect_left
+
+import httpx
+import requests
+
+# Импорты для тайп-хинтинга
+from typing import Dict, Any, Iterator, List, Optional, Tuple
+
+
+# --- 2. НАСТРОЙКИ И КОНСТАНТЫ ---
+
+logger = logging.getLogger(__name__)
+
+
+# Снимок для сохранения: копии записей только тех пользователей, что изменились.
+Snapshot = Dict[int, Dict[str, Any]]
+
+
+class StorageError(Exception):
+    """Ошибка при сохранении данных в хранилище. Данные в памяти при этом не теряются."""
+
+
+# --- 3. ИНДЕКС СНИМКА ДЛЯ ЛЕНИВОЙ ЗАГРУЗКИ ---
+
+class SnapshotIndex(ABC):
+    """
+    Индекс пользователей в сохранённом снимке: только отсортированный массив ID
+    (8 байт на пользователя), без разбора самих записей. Запись читается и
+    разбирается только по запросу через `fetch`.
+    """
+    def __init__(self, user_ids: array):
+        self._ids = user_ids
+
+    def _position(self, user_id: int) -> int:
+        """Позиция пользователя в отсортированном массиве ID или -1, если его нет."""
+        i = bisect_left(self._ids, user_id)
+        return i if i < len(self._ids) and self._ids[i] == user_id else -1
+
+    def __contains__(self, user_id: object) -> bool:
+        return isinstance(user_id, int) and self._position(user_id) >= 0
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self._ids)
+
+    @abstractmethod
+    def fetch(self, user_id: int) -> Optional[Dict[str, Any]]:
+        """Читает и разбирает запись пользователя. Возвращает None, если записи нет."""
+        pass
+
+    def scan(self) -> Iterator[Tuple[int, Dict[str, Any]]]:
+        """
+        Последовательно разбирает все записи снимка (пары ID, запись), не сохраняя их в памяти.
+        Может выполняться в рабочем потоке параллельно с `fetch` из цикла событий.
+        """
+        return ((user_id, self.fetch(user_id)) for user_id in self._ids)
+
+
+class DictSnapshotIndex(SnapshotIndex):
+    """Индекс поверх уже разобранного документа. Используется бэкендами без собственного ленивого режима."""
+    def __init__(self, users: Dict[int, Dict[str, Any]]):
+        super().__init__(array('q', sorted(users)))
+        self._users = users
+
+    def fetch(self, user_id: int) -> Optional[Dict[str, Any]]:
+        return self._users.get(user_id)
+
+
+class JsonSnapshotIndex(SnapshotIndex):
+    """
+    Индекс по JSON-файлу снимка вида {"users": {"<id>": {...}, ...}}.
+    Файл отображается в память (mmap), а начала записей находятся одним проходом
+    регулярного выражения (на скорости C), без создания объектов для каждой записи.
+    Границы записи (span) вычисляются без разбора: запись заканчивается последней
+    закрывающей скобкой перед ключом следующей записи.
+    """
+    # Ключ пользователя - строка из цифр, за которой сразу идёт объект записи.
+    # Сами записи плоские (без вложенных объектов), поэтому внутри них совпадений нет.
+    _USER_KEY_RE = re.compile(rb'"(\d+)"\s*:\s*\{')
+    _DECODER = json.JSONDecoder()
+
+    def __init__(self, path: str):
+        self._file = open(path, 'rb')
+        size = os.fstat(self._file.fileno()).st_size
+        self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+
+        # (ID, начало объекта записи, начало ключа) в порядке следования в файле
+        matches = []
+        users_key = self._mm.find(b'"users"')
+        if users_key >= 0:
+            users_open = self._mm.find(b'{', users_key)
+            for match in self._USER_KEY_RE.finditer(self._mm, users_open + 1):
+                matches.append((int(match.group(1)), match.end() - 1, match.start()))
+            users_close = self._find_users_close(users_open, matches[-1][1] if matches else None)
+            # Всё, что окружает содержимое объекта users (остальные ключи документа), сохраняем как есть
+            self._prefix = self._mm[:users_open + 1]
+            self._suffix = self._mm[users_close:]
+            self._users_range = (users_open + 1, users_close)
+        else:
+            users_close = 0
+            self._prefix, self._suffix = b'{"users": {', b'}}'
+            self._users_range = (0, 0)
+
+        # Запись не может заходить дальше ключа следующей записи (или конца объекта users)
+        limits = [start for _, _, start in matches[1:]] + [users_close]
+        triples = sorted(zip((m[0] for m in matches), (m[1] for m in matches), limits))
+        super().__init__(array('q', (t[0] for t in triples)))
+        self._offsets = array('q', (t[1] for t in triples))
+        self._limits = array('q', (t[2] for t in triples))
+
+    def _find_users_close(self, users_open: int, last_offset: Optional[int]) -> int:
+        """Находит закрывающую скобку объекта users: она идёт сразу за последней записью."""
+        if last_offset is None:
+            return self._mm.find(b'}', users_open)
+        _, length = self._decode_at(last_offset)
+        return self._mm.find(b'}', last_offset + length)
+
+    def _decode_at(self, offset: int) -> Tuple[Dict[str, Any], int]:
+        """Разбирает одну запись, начиная с `offset`. Читает окно и расширяет его, пока запись не поместится."""
+        window = 1024
+        while True:
+            chunk = self._mm[offset:offset + window]
+            try:
+                # Окно может обрезать многобайтовый символ на конце - он всё равно за пределами записи
+                text = chunk.decode('utf-8', errors='ignore')
+                record, end = self._DECODER.raw_decode(text)
+                return record, len(text[:end].encode('utf-8'))
+            except json.JSONDecodeError:
+                if offset + window >= len(self._mm):
+                    raise
+                window *= 4
+
+    def fetch(self, user_id: int) -> Optional[Dict[str, Any]]:
+        i = self._position(user_id)
+        if i < 0:
+            return None
+        return self._decode_at(self._offsets[i])[0]
+
+    def span(self, user_id: int) -> Tuple[int, int]:
+        """(Смещение, длина) JSON-текста записи в файле - без разбора записи."""
+        i = self._position(user_id)
+        offset = self._offsets[i]
+        return offset, self._mm.rfind(b'}', offset, self._limits[i]) + 1 - offset
+
+    def splice(self, records: Dict[int, bytes]) -> bytes:
+        """
+        Собирает документ снимка, подставив вместо записей из `records` (ID -> JSON записи)
+        новые. Пользователи, которых нет в снимке, добавляются в конец объекта users.
+        Остальные записи копируются из файла непрерывными кусками, без разбора и перекодирования.
+        """
+        replaced, added = [], []
+        for user_id, record in records.items():
+            if user_id in self:
+                offset, length = self.span(user_id)
+                replaced.append((offset, offset + length, record))
+            else:
+                added.append(b'"%d": %s' % (user_id, record))
+        replaced.sort()
+
+        start, end = self._users_range
+        parts = [self._prefix]
+        for record_start, record_end, record in replaced:
+            parts.append(self._mm[start:record_start])
+            parts.append(record)
+            start = record_end
+        parts.append(self._mm[start:end])
+        if added:
+            if len(self):
+                parts.append(b', ')
+            parts.append(b', '.join(added))
+        parts.append(self._suffix)
+        return b''.join(parts)
+
+    def close(self) -> None:
+        if isinstance(self._mm, mmap.mmap):
+            self._mm.close()
+        self._file.close()
+
+
+# --- 4. АБСТРАКТНЫЙ БЭКЕНД ---
+
+class StorageBackend(ABC):
+    """
+    "Контракт" для всех хранилищ данных пользователей.
+    UserDataManager работает только через этот интерфейс и не знает,
+    где физически лежат данные.
+
+    Сохранение вызывается из цикла событий бота, поэтому `save` не должен
+    его блокировать: по умолчанию вся работа уходит в рабочий поток.
+    """
+    # Человекочитаемое имя бэкенда для логов
+    name: str = "storage"
+
+    @abstractmethod
+    def load(self) -> Dict[str, Any]:
+        """
+        Загружает весь документ с данными при старте.
+
+        Returns:
+            Dict[str, Any]: Документ вида {'users': {user_id (int): {...}}}.
+        """
+        pass
+
+    def open_index(self) -> SnapshotIndex:
+        """
+        Открывает снимок в ленивом режиме: строит индекс ID без разбора записей.
+        По умолчанию загружает документ целиком; бэкенды переопределяют это,
+        чтобы время старта не зависело от размера базы.
+        """
+        return DictSnapshotIndex(self.load().get('users', {}))
+
+    @abstractmethod
+    def write(self, snapshot: Snapshot) -> None:
+        """
+        Синхронно записывает изменившихся пользователей. Каждый бэкенд сам решает,
+        в каком виде отправить дельту (строки, фрагменты документа и т.д.).
+
+        Args:
+            snapshot (Snapshot): Копии записей изменившихся пользователей.
+
+        Raises:
+            StorageError: Если сохранить не удалось.
+        """
+        pass
+
+    async def save(self, snapshot: Snapshot) -> None:
+        """
+        Асинхронно сохраняет снимок, не блокируя цикл событий.
+        По умолчанию выполняет `write` в рабочем потоке.
+
+        Raises:
+            StorageError: Если сохранить не удалось.
+        """
+        await asyncio.to_thread(self.write, snapshot)
+
+    async def aclose(self) -> None:
+        """Освобождает ресурсы бэкенда (соединения, файлы). По умолчанию ничего не делает."""
+        pass
+
+
+# --- 5. JSONBIN.IO ---
+
+class JsonBinStorage(StorageBackend):
+    """
+    Хранит весь документ в одном "бине" JSONBin.io.
+    API JSONBin не умеет частичных обновлений, поэтому каждое сохранение
+    отправляет документ целиком (PUT). Зато сериализуются заново только
+    изменившиеся пользователи: остальные копируются кусками байт из последнего
+    отправленного (или скачанного) документа, который лежит в локальном файле.
+    Сборка тела идёт в рабочем потоке, а отправка - через общий асинхронный
+    HTTP-клиент с keep-alive.
+
+    Бин скачивается потоком в локальный файл `cache_path`; в ленивом режиме по нему же
+    UserDataManager читает нетронутых пользователей. После успешной отправки тело
+    записывается в соседний файл и становится новой основой, поэтому в памяти хранятся
+    только записи, изменившиеся с последней удачной отправки.
+    """
+    name = "JSONBin.io"
+
+    def __init__(self, api_key: str, bin_id: str, cache_path: str = "jsonbin_snapshot.json"):
+        self._bin_id = bin_id
+        self._api_url = f"https://api.jsonbin.io/v3/b/{self._bin_id}"
+        self._headers = {'X-Master-Key': api_key}
+        # Записи (JSON в UTF-8), изменившиеся с последней удачной отправки
+        self._dirty_records: Dict[int, bytes] = {}
+        # Асинхронный HTTP-клиент создаётся при первом сохранении внутри цикла событий
+        self._client: Optional[httpx.AsyncClient] = None
+        self._cache_path = cache_path
+        # Индекс локальной копии бина, отданный UserDataManager (только в ленивом режиме)
+        self._snapshot_index: Optional[JsonSnapshotIndex] = None
+        # Документ, из которого собирается тело запроса: скачанный бин или последнее отправленное тело
+        self._base: Optional[JsonSnapshotIndex] = None
+        # Отправленные тела пишутся по очереди в два файла, чтобы не перезаписывать отображённый в память
+        self._generation = 0
+
+    def _download(self) -> None:
+        """Скачивает бин потоком в локальный файл (память не растёт с размером базы)."""
+        tmp_path = f"{self._cache_path}.tmp"
+        try:
+            # X-Bin-Meta: false - отдать сам документ, без обёртки {"record": ..., "metadata": ...}
+            headers = {**self._headers, 'X-Bin-Meta': 'false'}
+            with requests.get(f"{self._api_url}/latest", headers=headers, timeout=10, stream=True) as response:
+                response.raise_for_status()
+                with open(tmp_path, 'wb') as f:
+                    for chunk in response.iter_content(chunk_size=1 << 20):
+                        f.write(chunk)
+            os.replace(tmp_path, self._cache_path)
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Сетевая ошибка при загрузке данных: {e}. Бот не может запуститься.")
+            raise ConnectionError("Не удалось загрузить данные из облака.")
+
+    def load(self) -> Dict[str, Any]:
+        """Загружает ВСЁ содержимое "бина" из JSONBin.io при старте."""
+        self._download()
+        try:
+            with open(self._cache_path, 'rb') as f:
+                data = json.load(f)
+            if not isinstance(data, dict):
+                raise ValueError("документ не является объектом")
+            if 'users' in data and isinstance(data['users'], dict):
+                data['users'] = {int(k): v for k, v in data['users'].items()}
+            logger.info(f"Успешно загружены данные из JSONBin (ID: {self._bin_id})")
+        except (json.JSONDecodeError, KeyError, ValueError):
+            logger.warning(f"Данные в JSONBin повреждены или пусты. Начинаем с пустой базы.")
+            data = {}
+            with open(self._cache_path, 'wb') as f:
+                f.write(b'{"users": {}}')
+        self._base = JsonSnapshotIndex(self._cache_path)
+        return data
+
+    def open_index(self) -> SnapshotIndex:
+        """Скачивает бин в локальный файл и индексирует его без разбора записей."""
+        self._download()
+        self._snapshot_index = self._base = JsonSnapshotIndex(self._cache_path)
+        logger.info(f"Бин JSONBin (ID: {self._bin_id}) скачан и проиндексирован: {len(self._snapshot_index)} пользователей.")
+        return self._snapshot_index
+
+    def _build_body(self, snapshot: Snapshot) -> bytes:
+        """Собирает тело запроса из последнего документа, сериализуя заново только изменившихся пользователей."""
+        for user_id, record in snapshot.items():
+            self._dirty_records[user_id] = json.dumps(record).encode('utf-8')
+        return self._base.splice(self._dirty_records)
+
+    def _rebase(self, body: bytes) -> None:
+        """Делает успешно отправленное тело новой основой; изменённые записи больше не нужно хранить."""
+        generation = self._generation ^ 1
+        path = f"{self._cache_path}.{generation}"
+        try:
+            with open(path, 'wb') as f:
+                f.write(body)
+            base = JsonSnapshotIndex(path)
+        except (OSError, ValueError) as e:
+            # Остаёмся на прежней основе: изменённые записи продолжат подставляться из памяти
+            logger.warning(f"Не удалось сохранить отправленный документ в {path}: {e}")
+            return
+        if self._base is not None and self._base is not self._snapshot_index:
+            self._base.close()
+        self._base, self._generation = base, generation
+        self._dirty_records.clear()
+
+    def write(self, snapshot: Snapshot) -> None:
+        body = self._build_body(snapshot)
+        headers = {**self._headers, 'Content-Type': 'application/json'}
+        try:
+            response = requests.put(self._api_url, headers=headers, data=body, timeout=10)
+            response.raise_for_status()
+        except requests.exceptions.RequestException as e:
+            raise StorageError(f"JSONBin: {e}") from e
+        self._rebase(body)
+
+    async def save(self, snapshot: Snapshot) -> None:
+        # Сериализация - это работа CPU, уводим её из цикла событий
+        body = await asyncio.to_thread(self._build_body, snapshot)
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                headers={**self._headers, 'Content-Type': 'application/json'},
+                timeout=10.0,
+                limits=httpx.Limits(max_keepalive_connections=2)
+            )
+        try:
+            response = await self._client.put(self._api_url, content=body)
+            response.raise_for_status()
+        except httpx.HTTPError as e:
+            # Изменённые записи остаются в памяти и войдут в тело следующей попытки
+            raise StorageError(f"JSONBin: {e}") from e
+        await asyncio.to_thread(self._rebase, body)
+
+    async def aclose(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+        if self._base is not None and self._base is not self._snapshot_index:
+            self._base.close()
+        if self._snapshot_index is not None:
+            self._snapshot_index.close()
+
+
+# --- 6. ЛОКАЛЬНЫЙ SQLITE ---
+
+class SQLiteStorage(StorageBackend):
+    """
+    Локальное хранилище на SQLite в режиме WAL.
+    Каждый пользователь - отдельная строка (запись хранится как JSON),
+    поэтому сохранение пишет только строки изменившихся пользователей,
+    пачками по `batch_size` строк в одной транзакции.
+    """
+    name = "SQLite"
+
+    def __init__(self, path: str, batch_size: int = 500):
+        self.path = path
+        self._batch_size = batch_size
+        # Запись идёт из рабочих потоков, поэтому доступ к соединению защищаем замком.
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        # В режиме WAL synchronous=NORMAL безопасен и заметно быстрее FULL
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS users ("
+            " user_id INTEGER PRIMARY KEY,"
+            " data TEXT NOT NULL"
+            ")"
+        )
+        self._conn.commit()
+
+    @staticmethod
+    def _encode(record: Dict[str, Any]) -> str:
+        return json.dumps(record, ensure_ascii=False, sort_keys=True)
+
+    def load(self) -> Dict[str, Any]:
+        with self._lock:
+            rows = self._conn.execute("SELECT user_id, data FROM users").fetchall()
+        users = {}
+        for user_id, data in rows:
+            try:
+                users[user_id] = json.loads(data)
+            except json.JSONDecodeError:
+                logger.warning(f"Повреждённая запись пользователя {user_id} в SQLite пропущена.")
+                continue
+        logger.info(f"Успешно загружены данные из SQLite ({self.path})")
+        return {'users': users}
+
+    def open_index(self) -> SnapshotIndex:
+        """Читает только ID пользователей (по первичному ключу, без разбора JSON)."""
+        with self._lock:
+            user_ids = array('q', (row[0] for row in self._conn.execute("SELECT user_id FROM users ORDER BY user_id")))
+        logger.info(f"SQLite ({self.path}) проиндексирован: {len(user_ids)} пользователей.")
+        return SQLiteSnapshotIndex(self, user_ids)
+
+    def fetch(self, user_id: int) -> Optional[Dict[str, Any]]:
+        """Читает одну запись пользователя."""
+        with self._lock:
+            row = self._conn.execute("SELECT data FROM users WHERE user_id = ?", (user_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def write(self, snapshot: Snapshot) -> None:
+        changed: List[Tuple[int, str]] = [
+            (user_id, self._encode(record)) for user_id, record in snapshot.items()
+        ]
+        if not changed:
+            return
+
+        try:
+            with self._lock:
+                for start in range(0, len(changed), self._batch_size):
+                    batch = changed[start:start + self._batch_size]
+                    # `with conn` открывает транзакцию и делает COMMIT (или ROLLBACK при ошибке)
+                    with self._conn:
+                        self._conn.executemany(
+                            "INSERT INTO users (user_id, data) VALUES (?, ?) "
+                            "ON CONFLICT(user_id) DO UPDATE SET data = excluded.data",
+                            batch
+                        )
+        except sqlite3.Error as e:
+            raise StorageError(f"SQLite: {e}") from e
+        logger.info(f"SQLite: записано {len(changed)} изменённых пользователей.")
+
+    async def aclose(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+class SQLiteSnapshotIndex(SnapshotIndex):
+    """Индекс SQLite: массив ID в памяти, сами записи читаются по первичному ключу при первом обращении."""
+    def __init__(self, storage: SQLiteStorage, user_ids: array):
+        super().__init__(user_ids)
+        self._storage = storage
+
+    def fetch(self, user_id: int) -> Optional[Dict[str, Any]]:
+        return self._storage.fetch(user_id) if user_id in self else None
+
+    def scan(self) -> Iterator[Tuple[int, Dict[str, Any]]]:
+        # Отдельное соединение: в режиме WAL читатель видит базу на момент начала
+        # запроса и не мешает сохранениям. Запрос выполняется сразу при вызове,
+        # поэтому последующие сохранения в результат скана уже не попадут.
+        conn = sqlite3.connect(self._storage.path, check_same_thread=False)
+        cursor = conn.execute("SELECT user_id, data FROM users")
+
+        def rows() -> Iterator[Tuple[int, Dict[str, Any]]]:
+            try:
+                for user_id, data in cursor:
+                    yield user_id, json.loads(data)
+            finally:
+                conn.close()
+        return rows()
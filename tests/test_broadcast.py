@@ -0,0 +1,64 @@
+# Файл: tests/test_broadcast.py
+"""Проверки классификации ошибок доставки в движке рассылок."""
+
+import os
+import tempfile
+import unittest
+from types import SimpleNamespace
+
+from telegram.error import BadRequest
+
+from broadcast import BroadcastEngine, BroadcastStore, UNREACHABLE_CHAT_NOT_FOUND
+
+
+class FakeBot:
+    """Бот, который отвечает на send_message заранее заданными ошибками."""
+    def __init__(self, errors):
+        self.errors = errors
+        self.calls = {}
+
+    async def send_message(self, chat_id, text):
+        self.calls[chat_id] = self.calls.get(chat_id, 0) + 1
+        error = self.errors.get(chat_id)
+        if error is not None:
+            raise error
+        return SimpleNamespace(message_id=100 + chat_id)
+
+
+class BroadcastErrorsTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.store = BroadcastStore(os.path.join(self.tmp.name, "broadcasts.db"))
+
+    def tearDown(self):
+        self.store.close()
+        self.tmp.cleanup()
+
+    async def _run(self, bot, recipients):
+        engine = BroadcastEngine(self.store)
+        job = await engine.start(bot, recipients, "привет")
+        await job.task
+        return engine, job
+
+    async def test_chat_not_found_is_unreachable_after_one_attempt(self):
+        bot = FakeBot({1: BadRequest("Chat not found")})
+        engine, job = await self._run(bot, [1, 2])
+
+        self.assertEqual(bot.calls, {1: 1, 2: 1})
+        self.assertEqual((job.sent, job.failed), (1, 1))
+        self.assertTrue(engine.is_unreachable(1))
+        self.assertEqual(self.store.unreachable_ids(), [1])
+        reason = self.store._conn.execute("SELECT reason FROM unreachable WHERE chat_id = 1").fetchone()[0]
+        self.assertEqual(reason, UNREACHABLE_CHAT_NOT_FOUND)
+
+    async def test_other_bad_request_is_not_retried(self):
+        bot = FakeBot({1: BadRequest("Message is too long")})
+        engine, job = await self._run(bot, [1])
+
+        self.assertEqual(bot.calls, {1: 1})
+        self.assertEqual(job.failed, 1)
+        self.assertFalse(engine.is_unreachable(1))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,42 @@
+# Файл: tests/test_callbacks.py
+"""Проверки разбора callback_data диспетчером колбэков."""
+
+import unittest
+
+from callbacks import CallbackAction, CallbackDispatcher
+
+
+async def play(update, context):
+    pass
+
+
+async def play_blackjack(update, context):
+    pass
+
+
+class CallbackParsingTest(unittest.TestCase):
+    def setUp(self):
+        self.dispatcher = CallbackDispatcher()
+        self.dispatcher.register("nav", play)
+        self.dispatcher.register("game:play", play)
+
+    def test_longest_route_wins_and_rest_becomes_args(self):
+        self.dispatcher.register("game:play:blackjack", play_blackjack)
+        self.assertEqual(self.dispatcher._resolve("game:play:dice:100"),
+                         (CallbackAction("game:play", ("dice", "100")), play))
+        self.assertEqual(self.dispatcher._resolve("game:play:blackjack:hit"),
+                         (CallbackAction("game:play:blackjack", ("hit",)), play_blackjack))
+        self.assertEqual(self.dispatcher._resolve("nav"), (CallbackAction("nav", ()), play))
+
+    def test_unknown_route_is_not_handled(self):
+        self.assertIsNone(self.dispatcher._resolve("game"))
+        self.assertIsNone(self.dispatcher._resolve("shop:buy"))
+
+    def test_register_clears_cached_results(self):
+        self.assertEqual(self.dispatcher._resolve("game:play:blackjack:hit")[0].route, "game:play")
+        self.dispatcher.register("game:play:blackjack", play_blackjack)
+        self.assertEqual(self.dispatcher._resolve("game:play:blackjack:hit")[0].route, "game:play:blackjack")
+
+
+if __name__ == "__main__":
+    unittest.main()
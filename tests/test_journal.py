@@ -0,0 +1,70 @@
+# Файл: tests/test_journal.py
+"""Проверки журнала упреждающей записи при ошибках записи на диск."""
+
+import tempfile
+import unittest
+
+from journal import WriteAheadJournal
+
+
+class FailingFile:
+    """Обёртка над файлом сегмента: первые `failures` вызовов write пишут половину строки и падают."""
+    def __init__(self, file, failures):
+        self._file = file
+        self.failures = failures
+
+    def write(self, data):
+        if self.failures:
+            self.failures -= 1
+            self._file.write(data[:len(data) // 2])
+            self._file.flush()
+            raise OSError(28, "No space left on device")
+        return self._file.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+
+class JournalWriteFailureTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.journal = WriteAheadJournal(self.tmp.name)
+        # Останавливаем фоновый поток: сбросы в тесте выполняются явно через flush()
+        with self.journal._cond:
+            self.journal._closed = True
+            self.journal._cond.notify()
+        self.journal._flusher.join()
+
+    def tearDown(self):
+        self.journal.close()
+        self.tmp.cleanup()
+
+    def test_failed_batch_stays_buffered_and_is_written_on_next_flush(self):
+        self.journal._file = FailingFile(self.journal._file, failures=1)
+        self.journal.append(1, {"balance": 10})
+        self.journal.append(2, {"balance": 20})
+        with self.assertRaises(OSError):
+            self.journal.flush()
+
+        self.journal.append(1, {"balance": 15})
+        self.journal.flush()
+
+        # Обрывок первой попытки пропускается, а её целые строки повторяются - это безопасно,
+        # так как записи идемпотентны и идут в исходном порядке
+        state = {}
+        for user_id, fields in self.journal.replay():
+            state.setdefault(user_id, {}).update(fields)
+        self.assertEqual(state, {1: {"balance": 15}, 2: {"balance": 20}})
+
+    def test_rotate_keeps_records_when_flush_fails(self):
+        self.journal._file = FailingFile(self.journal._file, failures=1)
+        self.journal.append(1, {"balance": 10})
+        closed_seq = self.journal.rotate()
+        self.journal.flush()
+
+        self.journal.compact(closed_seq)
+        self.assertEqual(list(self.journal.replay()), [(1, {"balance": 10})])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,127 @@
+# Файл: tests/test_ledger.py
+"""Проверки журнала баланса: восстановление после аварии и рост индекса."""
+
+import os
+import tempfile
+import unittest
+
+from ledger import BalanceLedger, INDEX_FILE, LOG_FILE, RECORD, _OffsetIndex
+
+
+class BalanceLedgerRecoveryTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.log_path = os.path.join(self.tmp.name, LOG_FILE)
+        self.index_path = os.path.join(self.tmp.name, INDEX_FILE)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _write(self, records):
+        ledger = BalanceLedger(self.tmp.name)
+        for user_id, delta, balance in records:
+            ledger.append(user_id, "bet", delta, balance, timestamp=1000)
+        ledger.close()
+
+    @staticmethod
+    def _balances(ledger, user_id):
+        return [entry.balance for entry in ledger.entries(user_id)]
+
+    def test_truncated_tail_is_dropped(self):
+        self._write([(1, 100, 100), (2, 50, 50), (1, -30, 70)])
+        # Авария посреди записи: на диске осталась половина следующей записи
+        with open(self.log_path, 'ab') as f:
+            f.write(b'\x01' * (RECORD.size // 2))
+
+        ledger = BalanceLedger(self.tmp.name)
+        try:
+            self.assertEqual(os.path.getsize(self.log_path), 3 * RECORD.size)
+            self.assertEqual(self._balances(ledger, 1), [70, 100])
+            # Новая запись встаёт на место обрезанной и продолжает цепочку пользователя
+            ledger.append(1, "win", 10, 80)
+            self.assertEqual(self._balances(ledger, 1), [80, 70, 100])
+            self.assertEqual(self._balances(ledger, 2), [50])
+        finally:
+            ledger.close()
+
+    def test_index_ahead_of_log_is_rebuilt(self):
+        self._write([(1, 100, 100), (2, 50, 50), (1, -30, 70)])
+        # Лог потерял целые записи, а индекс успел их учесть
+        with open(self.log_path, 'r+b') as f:
+            f.truncate(RECORD.size)
+
+        ledger = BalanceLedger(self.tmp.name)
+        try:
+            self.assertEqual(self._balances(ledger, 1), [100])
+            self.assertEqual(self._balances(ledger, 2), [])
+        finally:
+            ledger.close()
+
+    def test_index_behind_log_is_replayed(self):
+        self._write([(1, 100, 100)])
+        saved_index = open(self.index_path, 'rb').read()
+        self._write([(2, 50, 50), (1, -30, 70)])
+        # Индекс не успел сохраниться после двух последних записей
+        with open(self.index_path, 'wb') as f:
+            f.write(saved_index)
+
+        ledger = BalanceLedger(self.tmp.name)
+        try:
+            self.assertEqual(self._balances(ledger, 1), [70, 100])
+            self.assertEqual(self._balances(ledger, 2), [50])
+        finally:
+            ledger.close()
+
+    def test_corrupted_index_is_rebuilt(self):
+        self._write([(1, 100, 100), (1, -30, 70)])
+        with open(self.index_path, 'r+b') as f:
+            f.write(b'GARBAGE!')
+
+        ledger = BalanceLedger(self.tmp.name)
+        try:
+            self.assertEqual(self._balances(ledger, 1), [70, 100])
+        finally:
+            ledger.close()
+
+
+class OffsetIndexGrowTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, INDEX_FILE)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_grow_keeps_all_keys(self):
+        index = _OffsetIndex(self.path, capacity=8)
+        # Ключи с общим младшим разрядом и отрицательные ID (групповые чаты) тоже должны пережить перенос
+        user_ids = [i * 1024 for i in range(1, 16)] + [-1001234567890 - i for i in range(15)]
+        for n, user_id in enumerate(user_ids):
+            index.put(user_id, n * RECORD.size, (n + 1) * RECORD.size)
+        try:
+            self.assertEqual(index.capacity, 64)
+            self.assertEqual(index.used, len(user_ids))
+            self.assertLessEqual(index.used, index.capacity * 0.7)
+            for n, user_id in enumerate(user_ids):
+                self.assertEqual(index.get(user_id), n * RECORD.size)
+            self.assertIsNone(index.get(42))
+            # Перезапись существующего ключа не занимает новый слот
+            index.put(user_ids[0], 999, len(user_ids) * RECORD.size)
+            self.assertEqual(index.used, len(user_ids))
+        finally:
+            index.close()
+
+        reopened = _OffsetIndex(self.path)
+        try:
+            self.assertEqual(reopened.capacity, 64)
+            self.assertEqual(reopened.used, len(user_ids))
+            self.assertEqual(reopened.log_size, len(user_ids) * RECORD.size)
+            self.assertEqual(reopened.get(user_ids[0]), 999)
+            self.assertEqual(reopened.get(user_ids[-1]), (len(user_ids) - 1) * RECORD.size)
+        finally:
+            reopened.close()
+        self.assertFalse(os.path.exists(self.path + ".tmp"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,53 @@
+# Файл: tests/test_storage.py
+"""Проверки индекса JSON-снимка: сборка нового документа через splice."""
+
+import json
+import os
+import tempfile
+import unittest
+
+from storage import JsonSnapshotIndex
+
+
+class JsonSnapshotSpliceTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "snapshot.json")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _index(self, document):
+        with open(self.path, 'w', encoding='utf-8') as f:
+            f.write(document)
+        index = JsonSnapshotIndex(self.path)
+        self.addCleanup(index.close)
+        return index
+
+    def test_replaces_and_appends_records(self):
+        index = self._index(
+            '{"version": 2, "users": {"10": {"balance": 1, "name": "Аня"},\n'
+            '  "2": {"balance": 2}, "300": {"balance": 3, "note": "}{"}}, "stats": {"total": 3}}'
+        )
+        self.assertEqual(index.fetch(300), {"balance": 3, "note": "}{"})
+
+        document = index.splice({2: b'{"balance": 20}', 5: b'{"balance": 50}'})
+
+        self.assertEqual(json.loads(document), {
+            "version": 2,
+            "users": {
+                "10": {"balance": 1, "name": "Аня"},
+                "2": {"balance": 20},
+                "300": {"balance": 3, "note": "}{"},
+                "5": {"balance": 50},
+            },
+            "stats": {"total": 3},
+        })
+
+    def test_splice_into_empty_snapshot(self):
+        index = self._index('{"users": {}}')
+        self.assertEqual(json.loads(index.splice({1: b'{"balance": 1}'})), {"users": {"1": {"balance": 1}}})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,42 @@
+# Файл: tests/test_timing_wheel.py
+"""Проверки колеса таймеров: каскад между уровнями и отмена."""
+
+import random
+import unittest
+
+from timing_wheel import SLOTS, TimerHandle, TimingWheel
+
+
+class TimingWheelCascadeTest(unittest.TestCase):
+    def _schedule(self, wheel, expires, fired):
+        # Напрямую, без call_later: колесо проворачивается вручную, без цикла событий
+        handle = TimerHandle(wheel, expires, lambda: fired.append((handle, wheel._current - 1)), ())
+        wheel._insert(handle)
+        wheel._count += 1
+        return handle
+
+    def test_timers_fire_on_their_tick_across_levels(self):
+        rng = random.Random(7)
+        wheel = TimingWheel(tick_seconds=1.0)
+        start = wheel._current = 1000
+        fired = []
+        # Задержки на границах уровней и случайные до третьего уровня включительно
+        delays = [1, SLOTS - 1, SLOTS, SLOTS + 1, SLOTS ** 2 - 1, SLOTS ** 2, SLOTS ** 3 + 5]
+        delays += [rng.randrange(1, SLOTS ** 3 + SLOTS) for _ in range(200)]
+        handles = [self._schedule(wheel, start + delay, fired) for delay in delays]
+        cancelled = handles[-1]
+        cancelled.cancel()
+
+        for tick in range(start, start + max(delays) + 1):
+            wheel._advance(tick)
+
+        self.assertEqual(len(wheel), 0)
+        self.assertEqual(len(fired), len(delays) - 1)
+        # Каждый таймер срабатывает ровно на своём тике, отменённый - не срабатывает
+        for handle, tick in fired:
+            self.assertEqual(handle.expires, tick)
+        self.assertNotIn(cancelled, [handle for handle, _ in fired])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,59 @@
+# Файл: tests/test_webhook.py
+"""Проверка сервера вебхука: секретный токен и обратное давление (200/403/503)."""
+
+import asyncio
+import threading
+import unittest
+
+import httpx
+from telegram.ext import ApplicationBuilder
+
+from update_processor import PerUserUpdateProcessor
+from webhook import SECRET_HEADER, WebhookServer
+
+SECRET = "test-secret"
+
+
+async def build_application():
+    # Приложение не запускается: апдейты остаются в update_queue, и её размер виден серверу
+    return ApplicationBuilder().token("123:TEST").concurrent_updates(PerUserUpdateProcessor(4)).build()
+
+
+class WebhookServerTest(unittest.TestCase):
+    def setUp(self):
+        # Цикл событий бота в отдельном потоке, как в main.py
+        self.loop = asyncio.new_event_loop()
+        self.loop_thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.loop_thread.start()
+        self.application = asyncio.run_coroutine_threadsafe(build_application(), self.loop).result(5)
+        self.server = WebhookServer(self.application, self.loop, SECRET, listen="127.0.0.1", port=0, max_pending=1)
+        self.server.start()
+        self.client = httpx.Client(base_url=f"http://127.0.0.1:{self.server.port}", timeout=10)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.stop()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.loop_thread.join()
+        self.loop.close()
+
+    def _post(self, update_id, secret=None):
+        headers = {SECRET_HEADER: secret} if secret is not None else {}
+        return self.client.post("/webhook", json={"update_id": update_id}, headers=headers)
+
+    def test_secret_and_backpressure(self):
+        self.assertEqual(self._post(1).status_code, 403)
+        self.assertEqual(self._post(1, "wrong").status_code, 403)
+        self.assertEqual(self.application.update_queue.qsize(), 0)
+
+        self.assertEqual(self._post(1, SECRET).status_code, 200)
+        self.assertEqual(self.application.update_queue.qsize(), 1)
+
+        # max_pending=1 уже набран: Telegram должен получить 503 и повторить доставку
+        self.assertEqual(self._post(2, SECRET).status_code, 503)
+        self.assertEqual(self.application.update_queue.qsize(), 1)
+        self.assertEqual(self.client.get("/health").text, "pending=1")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,195 @@
+# Файл: timing_wheel.py
+"""
+Иерархическое колесо таймеров для коротких игровых тайм-аутов.
+
+JobQueue (APScheduler) на каждый таймер заводит задачу планировщика, а поиск по имени
+(get_jobs_by_name) перебирает их все - при тысячах одновременных гонок это заметная
+нагрузка. Колесо устроено иначе:
+
+- время делится на тики по `tick_seconds`; 4 уровня по 64 слота покрывают 64^4 тиков
+  (около 19 дней при тике 0.1 с), более далёкие таймеры ждут на последнем уровне;
+- таймер кладётся в слот за O(1), а отменяется по своему дескриптору тоже за O(1);
+- когда младший уровень проходит полный оборот, слот следующего уровня
+  раскладывается по младшим (каскад), поэтому каждый таймер перекладывается
+  не больше числа уровней раз;
+- всем колесом управляет одна задача asyncio, которая спит, пока таймеров нет.
+
+Точность срабатывания - один тик. Корутинные обратные вызовы запускаются отдельными
+задачами, чтобы медленный обработчик не задерживал остальные таймеры.
+"""
+
+# --- 1. ИМПОРТЫ ---
+
+import asyncio
+import logging
+import math
+
+# Импорты для тайп-хинтинга
+from typing import Any, Callable, List, Optional, Set
+
+
+# --- 2. НАСТРОЙКИ И КОНСТАНТЫ ---
+
+logger = logging.getLogger(__name__)
+
+TICK_SECONDS = 0.1
+SLOT_BITS = 6
+SLOTS = 1 << SLOT_BITS
+SLOT_MASK = SLOTS - 1
+LEVELS = 4
+# Самая большая задержка в тиках, которую колесо различает без перекладывания
+MAX_SPAN = (1 << (SLOT_BITS * LEVELS)) - 1
+
+
+class TimerHandle:
+    """Дескриптор запланированного вызова; `cancel()` отменяет его за O(1)."""
+    __slots__ = ('expires', 'callback', 'args', '_slot', '_wheel')
+
+    def __init__(self, wheel: "TimingWheel", expires: int, callback: Callable, args: tuple):
+        self.expires = expires
+        self.callback = callback
+        self.args = args
+        self._slot: Optional[Set["TimerHandle"]] = None
+        self._wheel = wheel
+
+    @property
+    def active(self) -> bool:
+        return self._slot is not None
+
+    def cancel(self) -> None:
+        if self._slot is not None:
+            self._slot.discard(self)
+            self._slot = None
+            self._wheel._count -= 1
+
+
+# --- 3. КОЛЕСО ТАЙМЕРОВ ---
+
+class TimingWheel:
+    """
+    Таймеры на цикле событий asyncio. Используется только из цикла событий бота.
+    """
+    def __init__(self, tick_seconds: float = TICK_SECONDS):
+        self._tick = tick_seconds
+        self._levels: List[List[Set[TimerHandle]]] = [[set() for _ in range(SLOTS)] for _ in range(LEVELS)]
+        # Номер следующего необработанного тика
+        self._current = 0
+        self._count = 0
+        self._driver: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        # Запущенные корутины обратных вызовов (ссылки, чтобы задачи не собрал сборщик мусора)
+        self._running: Set[asyncio.Task] = set()
+
+    def __len__(self) -> int:
+        return self._count
+
+    def _now_tick(self) -> int:
+        return int(asyncio.get_running_loop().time() / self._tick)
+
+    def call_later(self, delay: float, callback: Callable, *args: Any) -> TimerHandle:
+        """Вызывает `callback(*args)` через `delay` секунд (обычная функция или корутина)."""
+        if self._driver is None or self._driver.done():
+            self._start()
+        if self._count == 0:
+            # Колесо пустое - его можно сразу перевести на текущее время без обхода тиков
+            self._current = self._now_tick()
+        ticks = max(1, math.ceil(delay / self._tick))
+        handle = TimerHandle(self, self._current + ticks, callback, args)
+        self._insert(handle)
+        self._count += 1
+        self._wakeup.set()
+        return handle
+
+    def _insert(self, handle: TimerHandle) -> None:
+        ticks = handle.expires - self._current
+        if ticks < 0:
+            # Уже просрочен (например, при каскаде) - сработает на ближайшем тике
+            slot = self._levels[0][self._current & SLOT_MASK]
+        else:
+            # Слишком далёкий таймер ставится на край диапазона и переложится при каскаде
+            expires = self._current + min(ticks, MAX_SPAN)
+            level = 0
+            while level < LEVELS - 1 and ticks >= 1 << (SLOT_BITS * (level + 1)):
+                level += 1
+            slot = self._levels[level][(expires >> (SLOT_BITS * level)) & SLOT_MASK]
+        slot.add(handle)
+        handle._slot = slot
+
+    def _cascade(self, level: int) -> int:
+        """Раскладывает текущий слот уровня `level` по младшим уровням; возвращает индекс слота."""
+        index = (self._current >> (SLOT_BITS * level)) & SLOT_MASK
+        slot = self._levels[level][index]
+        if slot:
+            handles = list(slot)
+            slot.clear()
+            for handle in handles:
+                self._insert(handle)
+        return index
+
+    def _advance(self, now_tick: int) -> None:
+        """Обрабатывает все тики до `now_tick` включительно."""
+        while self._current <= now_tick and self._count:
+            index = self._current & SLOT_MASK
+            if index == 0:
+                level = 1
+                while level < LEVELS and self._cascade(level) == 0:
+                    level += 1
+            slot = self._levels[0][index]
+            self._current += 1
+            if slot:
+                expired = list(slot)
+                slot.clear()
+                for handle in expired:
+                    handle._slot = None
+                    self._count -= 1
+                    self._fire(handle)
+        if not self._count:
+            self._current = now_tick + 1
+
+    def _fire(self, handle: TimerHandle) -> None:
+        try:
+            result = handle.callback(*handle.args)
+        except Exception as e:
+            logger.error(f"Ошибка в обработчике таймера {handle.callback!r}: {e}")
+            return
+        if asyncio.iscoroutine(result):
+            task = asyncio.create_task(result)
+            self._running.add(task)
+            task.add_done_callback(self._task_done)
+
+    def _task_done(self, task: asyncio.Task) -> None:
+        self._running.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Ошибка в обработчике таймера: {task.exception()}")
+
+    def _start(self) -> None:
+        self._wakeup = asyncio.Event()
+        self._current = self._now_tick()
+        self._driver = asyncio.create_task(self._drive())
+
+    async def _drive(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            if not self._count:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            # Спим до начала следующего необработанного тика
+            await asyncio.sleep(max(0.0, self._current * self._tick - loop.time()))
+            self._advance(self._now_tick())
+
+    async def aclose(self) -> None:
+        """Останавливает колесо; несработавшие таймеры отбрасываются, запущенные обработчики дожидаются."""
+        if self._driver is not None:
+            self._driver.cancel()
+            try:
+                await self._driver
+            except asyncio.CancelledError:
+                pass
+            self._driver = None
+        if self._running:
+            await asyncio.gather(*self._running, return_exceptions=True)
+
+
+# Общее колесо для тайм-аутов игр
+timers = TimingWheel()
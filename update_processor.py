@@ -0,0 +1,168 @@
+# Файл: update_processor.py
+"""
+Параллельная обработка апдейтов с сохранением порядка для каждого пользователя.
+
+Апдейты разных пользователей обрабатываются одновременно, поэтому медленный запрос
+к Telegram для одного пользователя не задерживает остальных. Апдейты одного
+пользователя (по effective_user.id) выполняются строго по очереди: обработчики
+читают и меняют context.user_data (ставка, раздача в блэкджеке) и баланс, и без
+такой гарантии два нажатия подряд могли бы испортить друг другу состояние.
+
+Код вне апдейтов, который меняет состояние пользователя (таймеры игр, очистка
+неактивных), проходит через тот же замок пользователя - см. `user_lock`.
+"""
+
+# --- 1. ИМПОРТЫ ---
+
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+
+from telegram import Update
+from telegram.error import TelegramError
+from telegram.ext import Application, BaseUpdateProcessor
+
+# Импорты для тайп-хинтинга
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional
+
+
+# --- 2. НАСТРОЙКИ И КОНСТАНТЫ ---
+
+logger = logging.getLogger(__name__)
+
+# Сколько апдейтов одного пользователя может ждать своей очереди; остальные отбрасываются
+MAX_PENDING_PER_USER = 8
+
+
+# --- 3. ПРОЦЕССОР АПДЕЙТОВ ---
+
+async def answer_dropped(update: object) -> None:
+    """Отвечает на отброшенный колбэк, чтобы у кнопки не крутился индикатор загрузки."""
+    if isinstance(update, Update) and update.callback_query:
+        try:
+            await update.callback_query.answer()
+        except TelegramError:
+            pass
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """
+    Процессор апдейтов: параллельно по пользователям, последовательно внутри пользователя.
+
+    Семафор базового класса (`max_pending_updates`) выдаёт слоты не строго по очереди,
+    поэтому он не должен быть узким местом: его размер - это предел принятых апдейтов
+    (не меньше лимита вебхука), а не параллельности. Внутри `do_process_update` апдейт
+    сначала встаёт в очередь своего пользователя (asyncio.Lock пропускает ждущих по
+    порядку, FIFO), и только потом занимает общий семафор выполняющихся обработчиков
+    (`max_concurrent_updates`). У одного пользователя может быть не больше
+    `max_pending_per_user` апдейтов в очереди: лишние отбрасываются, а колбэк получает
+    ответ через `on_drop`, иначе флудящий пользователь копил бы ждущие апдейты без предела.
+    """
+    def __init__(self, max_concurrent_updates: int, max_pending_updates: Optional[int] = None,
+                 max_pending_per_user: int = MAX_PENDING_PER_USER,
+                 on_drop: Callable[[object], Awaitable[None]] = answer_dropped):
+        """
+        Args:
+            max_concurrent_updates (int): Максимум одновременно выполняющихся обработчиков.
+            max_pending_updates (Optional[int]): Максимум принятых апдейтов (по умолчанию - 8x от предыдущего).
+            max_pending_per_user (int): Максимум апдейтов одного пользователя в очереди.
+            on_drop (Callable): Корутина, которая отвечает на отброшенный апдейт.
+        """
+        super().__init__(max_pending_updates or max_concurrent_updates * 8)
+        self._max_running = max_concurrent_updates
+        self._max_per_user = max_pending_per_user
+        self._on_drop = on_drop
+        # Создаются в initialize(), уже внутри цикла событий приложения
+        self._running: Optional[asyncio.BoundedSemaphore] = None
+        # ID пользователя -> [замок, число апдейтов и вызовов user_lock, которые его держат или ждут].
+        # Запись удаляется, когда счётчик падает до нуля, так что словарь не растёт бесконечно.
+        self._user_locks: Dict[int, List[Any]] = {}
+        # Апдейты, принятые процессором и ещё не обработанные (включая ждущих замка и семафора)
+        self.in_flight = 0
+        self.dropped = 0
+
+    @staticmethod
+    def _user_key(update: object) -> Optional[int]:
+        if isinstance(update, Update):
+            if update.effective_user:
+                return update.effective_user.id
+            if update.effective_chat:
+                return update.effective_chat.id
+        return None
+
+    def _acquire_entry(self, key: int) -> List[Any]:
+        entry = self._user_locks.get(key)
+        if entry is None:
+            entry = self._user_locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        return entry
+
+    def _release_entry(self, key: int, entry: List[Any]) -> None:
+        entry[1] -= 1
+        if not entry[1]:
+            del self._user_locks[key]
+
+    async def _drop(self, key: int, update: object, coroutine: Awaitable[Any]) -> None:
+        self.dropped += 1
+        if asyncio.iscoroutine(coroutine):
+            coroutine.close()
+        logger.debug(f"Апдейт пользователя {key} отброшен: очередь пользователя заполнена.")
+        try:
+            await self._on_drop(update)
+        except Exception as e:
+            logger.warning(f"Не удалось ответить на отброшенный апдейт пользователя {key}: {e}")
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        self.in_flight += 1
+        try:
+            key = self._user_key(update)
+            if key is None:
+                # Апдейт без пользователя (например, служебный) ни с кем не конфликтует
+                async with self._running:
+                    await coroutine
+                return
+            entry = self._user_locks.get(key)
+            if entry is not None and entry[1] >= self._max_per_user:
+                await self._drop(key, update, coroutine)
+                return
+            # Место в очереди пользователя занимается до общего семафора, поэтому ждущие
+            # апдейты одного пользователя не отнимают слоты выполнения у остальных
+            entry = self._acquire_entry(key)
+            try:
+                async with entry[0]:
+                    async with self._running:
+                        await coroutine
+            finally:
+                self._release_entry(key, entry)
+        finally:
+            self.in_flight -= 1
+
+    @asynccontextmanager
+    async def user_lock(self, user_id: int) -> AsyncIterator[None]:
+        """Выполняет блок под замком пользователя, в очереди с его апдейтами."""
+        entry = self._acquire_entry(user_id)
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            self._release_entry(user_id, entry)
+
+    async def initialize(self) -> None:
+        self._running = asyncio.BoundedSemaphore(self._max_running)
+
+    async def shutdown(self) -> None:
+        pass
+
+
+@asynccontextmanager
+async def user_lock(application: Application, user_id: int) -> AsyncIterator[None]:
+    """
+    Замок пользователя процессора приложения. Если приложение обрабатывает апдейты
+    не через PerUserUpdateProcessor, блок выполняется без замка.
+    """
+    processor = application.update_processor
+    if isinstance(processor, PerUserUpdateProcessor):
+        async with processor.user_lock(user_id):
+            yield
+    else:
+        yield
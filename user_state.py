@@ -0,0 +1,134 @@
+# Файл: user_state.py
+"""
+Ограничение памяти под context.user_data.
+
+python-telegram-bot хранит user_data каждого пользователя, который хоть раз писал боту,
+до остановки процесса - вместе с брошенными ставками, раздачами блэкджека (колода из
+52 карт) и состоянием гонок. Этот модуль держит user_data только для активных пользователей:
+
+- время последнего апдейта пользователя хранится в OrderedDict (от давних к недавним);
+- периодическая задача удаляет user_data тех, кто молчит дольше TTL, а при превышении
+  лимита - самых давно неактивных (LRU);
+- перед удалением каждая игра получает шанс завершить брошенный раунд (Game.abandon):
+  например, открытая раздача блэкджека доигрывается и выигрыш зачисляется;
+- удаление выполняется под замком пользователя (update_processor.user_lock), в очереди
+  с его апдейтами, чтобы не стереть состояние, которое как раз меняет обработчик.
+"""
+
+# --- 1. ИМПОРТЫ ---
+
+import logging
+import sys
+import time
+from collections import OrderedDict
+
+from telegram.ext import Application, ContextTypes
+
+from update_processor import user_lock
+
+# Импорты для тайп-хинтинга
+from typing import Any, Iterable, List, Optional, Tuple
+
+
+# --- 2. НАСТРОЙКИ И КОНСТАНТЫ ---
+
+logger = logging.getLogger(__name__)
+
+# Как часто проверять неактивных пользователей
+SWEEP_INTERVAL_SECONDS = 60
+
+
+def _deep_size(obj: Any) -> int:
+    """Приблизительный размер объекта в байтах вместе с вложенными контейнерами."""
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(_deep_size(k) + _deep_size(v) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set)):
+        size += sum(_deep_size(item) for item in obj)
+    return size
+
+
+# --- 3. ХРАНИЛИЩЕ СОСТОЯНИЯ ПОЛЬЗОВАТЕЛЕЙ ---
+
+class UserStateReaper:
+    """
+    Вытесняет user_data неактивных пользователей с учётом TTL и общего лимита.
+    """
+    def __init__(self, games: Iterable, ttl_seconds: float, max_users: int):
+        """
+        Args:
+            games (Iterable[Game]): Игры, которым нужно завершить брошенные раунды.
+            ttl_seconds (float): Через сколько секунд бездействия состояние пользователя удаляется.
+            max_users (int): Максимум пользователей с состоянием в памяти.
+        """
+        self._application: Optional[Application] = None
+        self._games = list(games)
+        self._ttl = ttl_seconds
+        self._max_users = max_users
+        # ID пользователя -> время последнего апдейта (time.monotonic)
+        self._last_seen: "OrderedDict[int, float]" = OrderedDict()
+        self.evicted = 0
+
+    def touch(self, user_id: int) -> None:
+        """Отмечает апдейт пользователя. Вызывается из предобработчика для каждого апдейта."""
+        self._last_seen[user_id] = time.monotonic()
+        self._last_seen.move_to_end(user_id)
+
+    def start(self, application: Application, interval_seconds: int = SWEEP_INTERVAL_SECONDS) -> None:
+        """Запускает периодическую очистку user_data приложения."""
+        self._application = application
+        application.job_queue.run_repeating(callback=self._sweep_job, interval=interval_seconds, name="user_state_sweep")
+        logger.info(
+            f"Очистка состояния неактивных пользователей: TTL {self._ttl:.0f} c, не больше {self._max_users} пользователей."
+        )
+
+    def _collect_expired(self, now: float) -> List[int]:
+        user_data = self._application.user_data
+        # Состояние, созданное без апдейта пользователя (таймеры игр, восстановление после
+        # перезапуска), начинаем отсчитывать с текущего момента
+        for user_id in user_data:
+            if user_id not in self._last_seen:
+                self._last_seen[user_id] = now
+        expired = []
+        last_seen = self._last_seen
+        while last_seen:
+            user_id, seen_at = next(iter(last_seen.items()))
+            if now - seen_at < self._ttl and len(last_seen) <= self._max_users:
+                break
+            del last_seen[user_id]
+            if user_id in user_data:
+                expired.append(user_id)
+        return expired
+
+    async def _sweep_job(self, context: ContextTypes.DEFAULT_TYPE) -> None:
+        expired = self._collect_expired(time.monotonic())
+        for user_id in expired:
+            if user_id in self._last_seen:
+                # Пользователь вернулся, пока завершались игры предыдущих
+                continue
+            await self.evict(user_id)
+        if expired:
+            logger.info(f"Удалено состояние {len(expired)} неактивных пользователей, в памяти: {len(self._application.user_data)}.")
+
+    async def evict(self, user_id: int) -> None:
+        """Завершает брошенные игры пользователя и удаляет его user_data."""
+        seen_at = self._last_seen.get(user_id)
+        async with user_lock(self._application, user_id):
+            if self._last_seen.get(user_id) != seen_at:
+                # Пока ждали замка, пользователь прислал апдейт - его состояние снова нужно
+                return
+            data = self._application.user_data.get(user_id)
+            if data:
+                for game in self._games:
+                    try:
+                        await game.abandon(user_id, data)
+                    except Exception as e:
+                        logger.error(f"Не удалось завершить брошенную игру {game.id} пользователя {user_id}: {e}")
+            self._last_seen.pop(user_id, None)
+            self._application.drop_user_data(user_id)
+            self.evicted += 1
+
+    def footprint(self) -> Tuple[int, int]:
+        """(Число пользователей с состоянием, приблизительный объём их user_data в байтах)."""
+        user_data = self._application.user_data
+        return len(user_data), sum(_deep_size(data) for data in user_data.values())
@@ -0,0 +1,251 @@
+# Файл: user_stats.py
+"""
+Агрегаты по пользователям для публичной и админской статистики.
+
+UserStats хранит готовые счётчики (всего пользователей, взаимодействий, почасовые
+гистограммы first_seen/last_seen и когорты по дням), а FactionIndex - подписчиков
+каждой фракции. UserDataManager обновляет их при каждом изменении записи, поэтому
+отчёты и выбор получателей рассылки не обходят всех пользователей.
+"""
+
+# --- 1. ИМПОРТЫ ---
+
+from array import array
+
+# Импорты для тайп-хинтинга
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+
+# --- 2. НАСТРОЙКИ И КОНСТАНТЫ ---
+
+# Значение поля faction у пользователя без фракции; в индекс фракций не попадает
+NO_FACTION = 'None'
+SECONDS_PER_HOUR = 3600
+SECONDS_PER_DAY = 86400
+# Начальный размер почасовой гистограммы; дальше она растёт удвоением
+INITIAL_SPAN_HOURS = 24 * 32
+
+
+def _bump(counter: Dict[Any, int], key: Any, delta: int) -> None:
+    """Изменяет счётчик на `delta`, удаляя обнулившиеся ключи."""
+    value = counter.get(key, 0) + delta
+    if value:
+        counter[key] = value
+    else:
+        counter.pop(key, None)
+
+
+# --- 3. ПОЧАСОВАЯ ГИСТОГРАММА ---
+
+class HourlyHistogram:
+    """
+    Число пользователей по часам (epoch-секунды // 3600) с префиксными суммами в дереве
+    Фенвика: изменение и запрос "сколько между T1 и T2" стоят O(log часов).
+    """
+    def __init__(self):
+        self._counts: Dict[int, int] = {}
+        # Дерево Фенвика (с 1) над часами [_origin, _origin + размер)
+        self._origin = 0
+        self._tree = array('q', [0])
+
+    def _build(self, origin: int, size: int) -> None:
+        """Перестраивает дерево под новый диапазон часов за O(размер)."""
+        tree = array('q', bytes(8 * (size + 1)))
+        for hour, count in self._counts.items():
+            tree[hour - origin + 1] += count
+        for i in range(1, size + 1):
+            parent = i + (i & -i)
+            if parent <= size:
+                tree[parent] += tree[i]
+        self._origin, self._tree = origin, tree
+
+    def _grow(self, hour: int) -> None:
+        """Расширяет диапазон удвоением, чтобы он включал `hour` (перестроений - O(log) за всё время)."""
+        size = len(self._tree) - 1
+        origin = self._origin
+        if not size:
+            origin, size = hour - INITIAL_SPAN_HOURS // 2, INITIAL_SPAN_HOURS
+        while hour < origin:
+            origin -= size
+            size *= 2
+        while hour >= origin + size:
+            size *= 2
+        self._build(origin, size)
+
+    def add_hour(self, hour: int, delta: int) -> None:
+        _bump(self._counts, hour, delta)
+        i = hour - self._origin + 1
+        if not 1 <= i < len(self._tree):
+            # Перестроение уже учитывает обновлённый _counts
+            self._grow(hour)
+            return
+        tree = self._tree
+        while i < len(tree):
+            tree[i] += delta
+            i += i & -i
+
+    def add(self, ts: int, delta: int) -> None:
+        self.add_hour(int(ts) // SECONDS_PER_HOUR, delta)
+
+    def _count_before(self, hour: int) -> int:
+        """Сколько пользователей приходится на часы строго раньше `hour`."""
+        i = min(hour - self._origin, len(self._tree) - 1)
+        total = 0
+        while i > 0:
+            total += self._tree[i]
+            i -= i & -i
+        return total
+
+    def count_between(self, start_ts: float, end_ts: Optional[float] = None) -> int:
+        """
+        Число пользователей в часах, пересекающихся с [start_ts, end_ts).
+        Без `end_ts` - до настоящего момента включительно.
+        """
+        start_hour = int(start_ts) // SECONDS_PER_HOUR
+        if end_ts is None:
+            return self.total() - self._count_before(start_hour)
+        end_hour = -(-int(end_ts) // SECONDS_PER_HOUR)
+        if end_hour <= start_hour:
+            return 0
+        return self._count_before(end_hour) - self._count_before(start_hour)
+
+    def total(self) -> int:
+        return self._count_before(self._origin + len(self._tree))
+
+    def merge(self, other: 'HourlyHistogram') -> None:
+        for hour, count in other._counts.items():
+            self.add_hour(hour, count)
+
+
+# --- 4. КЛАСС АГРЕГАТОВ ---
+
+class UserStats:
+    """
+    Набор счётчиков по пользователям. Изменение записи оформляется как
+    "вычесть старые значения" + "добавить новые" (см. add с sign=-1).
+    """
+    def __init__(self):
+        self.total_users = 0
+        self.total_interactions = 0
+        self.first_seen_hours = HourlyHistogram()
+        self.last_seen_hours = HourlyHistogram()
+        # Когорты: день first_seen -> {день last_seen -> число пользователей}.
+        # Разница дней для каждого пользователя точна, поэтому удержание считается без обхода записей.
+        self.cohorts: Dict[int, Dict[int, int]] = {}
+
+    def _bump_cohort(self, first_day: int, last_day: int, delta: int) -> None:
+        cohort = self.cohorts.setdefault(first_day, {})
+        _bump(cohort, last_day, delta)
+        if not cohort:
+            del self.cohorts[first_day]
+
+    def add(self, first_seen: Optional[int], last_seen: Optional[int], interaction_count: int, sign: int = 1) -> None:
+        """
+        Учитывает одного пользователя (sign=1) или убирает его вклад (sign=-1).
+        Время передаётся в epoch-секундах.
+        """
+        self.total_users += sign
+        self.total_interactions += sign * (interaction_count or 0)
+        if first_seen is not None:
+            self.first_seen_hours.add(first_seen, sign)
+        if last_seen is not None:
+            self.last_seen_hours.add(last_seen, sign)
+        if first_seen is not None and last_seen is not None:
+            self._bump_cohort(first_seen // SECONDS_PER_DAY, last_seen // SECONDS_PER_DAY, sign)
+
+    def add_record(self, record: Any, sign: int = 1) -> None:
+        """То же, что add, но для UserRecord."""
+        self.add(record.first_seen, record.last_seen, record.interaction_count, sign)
+
+    def merge(self, other: 'UserStats') -> None:
+        """Добавляет к этим счётчикам счётчики `other` (например, изменения, накопленные во время подсчёта)."""
+        self.total_users += other.total_users
+        self.total_interactions += other.total_interactions
+        self.first_seen_hours.merge(other.first_seen_hours)
+        self.last_seen_hours.merge(other.last_seen_hours)
+        for first_day, cohort in other.cohorts.items():
+            for last_day, count in cohort.items():
+                self._bump_cohort(first_day, last_day, count)
+
+    # --- 5. ЗАПРОСЫ ---
+
+    def count_new_between(self, start_ts: float, end_ts: Optional[float] = None) -> int:
+        """Сколько пользователей впервые появились в [start_ts, end_ts), с точностью до часа. O(log часов)."""
+        return self.first_seen_hours.count_between(start_ts, end_ts)
+
+    def count_active_between(self, start_ts: float, end_ts: Optional[float] = None) -> int:
+        """Сколько пользователей в последний раз были активны в [start_ts, end_ts), с точностью до часа."""
+        return self.last_seen_hours.count_between(start_ts, end_ts)
+
+    def cohort_table(self, start_ts: float, end_ts: float, cohort_days: int = 7,
+                     periods: int = 4) -> List[Tuple[int, int, List[int]]]:
+        """
+        Таблица удержания по когортам пришедших в [start_ts, end_ts).
+
+        Когорта - пользователи, впервые появившиеся в одном окне из `cohort_days` дней.
+        Пользователь считается удержанным на k-м периоде, если его последний визит
+        не раньше чем через k * cohort_days дней после первого.
+
+        Returns:
+            List[Tuple[int, int, List[int]]]: Для каждой когорты - epoch-начало окна,
+            размер когорты и число удержанных на периодах 1..periods.
+        """
+        start_day = int(start_ts) // SECONDS_PER_DAY
+        end_day = -(-int(end_ts) // SECONDS_PER_DAY)
+        rows: Dict[int, List[int]] = {}
+        # Обходим только дни, в которые кто-то пришёл: O(дней * уникальных дней last_seen)
+        for first_day, cohort in self.cohorts.items():
+            if not start_day <= first_day < end_day:
+                continue
+            row_start = start_day + (first_day - start_day) // cohort_days * cohort_days
+            row = rows.setdefault(row_start, [0] * (periods + 1))
+            for last_day, count in cohort.items():
+                row[0] += count
+                kept = min((last_day - first_day) // cohort_days, periods)
+                for k in range(1, kept + 1):
+                    row[k] += count
+        return [(day * SECONDS_PER_DAY, row[0], row[1:]) for day, row in sorted(rows.items())]
+
+
+# --- 6. ИНДЕКС ФРАКЦИЙ ---
+
+class FactionIndex:
+    """
+    Фракция -> множество ID подписчиков. Пользователи без фракции не индексируются.
+    Выбор получателей рассылки по индексу стоит O(получателей), а не O(всех пользователей).
+    """
+    def __init__(self):
+        self._members: Dict[str, Set[int]] = {}
+
+    def move(self, user_id: int, old_faction: Optional[str], new_faction: Optional[str]) -> None:
+        """Переносит пользователя из одной фракции в другую (None/NO_FACTION - без фракции)."""
+        if old_faction not in (None, NO_FACTION):
+            members = self._members.get(old_faction)
+            if members is not None:
+                members.discard(user_id)
+        if new_faction not in (None, NO_FACTION):
+            self._members.setdefault(new_faction, set()).add(user_id)
+
+    def apply(self, changes: Dict[int, str]) -> None:
+        """
+        Применяет итоговые фракции пользователей, когда прежняя фракция неизвестна
+        (изменения, накопленные пока индекс строился в фоне).
+        """
+        for user_id, faction in changes.items():
+            for members in self._members.values():
+                members.discard(user_id)
+            self.move(user_id, None, faction)
+
+    def members(self, faction: str) -> Set[int]:
+        """Подписчики фракции. Возвращается само множество индекса - его нельзя изменять."""
+        return self._members.get(faction, set())
+
+    def audience(self, factions: Iterable[str]) -> Set[int]:
+        """Объединение подписчиков нескольких фракций."""
+        audience: Set[int] = set()
+        for faction in factions:
+            audience |= self.members(faction)
+        return audience
+
+    def counts(self) -> Dict[str, int]:
+        return {faction: len(members) for faction, members in self._members.items() if members}
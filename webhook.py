@@ -0,0 +1,143 @@
+# Файл: webhook.py
+"""
+Приём апдейтов через вебхук - альтернатива application.run_polling().
+
+Telegram сам присылает апдейты POST-запросами, поэтому нет задержки на цикл
+long polling. HTTP-сервер (Flask поверх werkzeug) работает в отдельном потоке
+и обслуживает запросы в нескольких потоках, а Application со всеми
+обработчиками - в основном цикле событий.
+
+- Секретный токен из заголовка X-Telegram-Bot-Api-Secret-Token сверяется
+  с тем, что передан в setWebhook; чужие запросы получают 403.
+- Апдейт декодируется здесь же и кладётся в application.update_queue через
+  run_coroutine_threadsafe.
+- Обратное давление: если принято уже `max_pending` необработанных апдейтов,
+  сервер отвечает 503, и Telegram повторит доставку позже, вместо того чтобы
+  очередь бесконечно росла в памяти. Application забирает апдейты из update_queue
+  сразу и создаёт для каждого задачу, поэтому одного размера очереди мало: к нему
+  прибавляется счётчик апдейтов, принятых PerUserUpdateProcessor и ещё не обработанных.
+
+Все потоки сервера работают в одном процессе с ботом: данные пользователей
+хранятся в памяти процесса, поэтому несколько процессов gunicorn здесь не подходят.
+"""
+
+# --- 1. ИМПОРТЫ ---
+
+import asyncio
+import hmac
+import logging
+import threading
+
+from flask import Flask, Response, request
+from werkzeug.serving import make_server
+
+from telegram import Update
+from telegram.ext import Application
+
+from update_processor import PerUserUpdateProcessor
+
+# Импорты для тайп-хинтинга
+from typing import Optional
+
+
+# --- 2. НАСТРОЙКИ И КОНСТАНТЫ ---
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+# Сколько ждать, пока цикл событий примет апдейт в очередь
+ENQUEUE_TIMEOUT = 5.0
+
+
+# --- 3. СЕРВЕР ВЕБХУКА ---
+
+class WebhookServer:
+    """
+    HTTP-сервер вебхука, передающий апдейты в очередь Application.
+    """
+    def __init__(self, application: Application, loop: asyncio.AbstractEventLoop, secret_token: str,
+                 listen: str = "0.0.0.0", port: int = 8080, url_path: str = "/webhook", max_pending: int = 1000):
+        """
+        Args:
+            application (Application): Уже запущенное приложение бота.
+            loop (asyncio.AbstractEventLoop): Цикл событий, в котором работает приложение.
+            secret_token (str): Секрет, переданный в setWebhook.
+            listen (str): Адрес, на котором слушает сервер.
+            port (int): Порт сервера.
+            url_path (str): Путь эндпоинта вебхука.
+            max_pending (int): Максимум необработанных апдейтов, после которого сервер отвечает 503.
+        """
+        self._application = application
+        self._loop = loop
+        self._secret_token = secret_token
+        self._max_pending = max_pending
+        self.flask_app = Flask(__name__)
+        self.flask_app.add_url_rule(url_path, "webhook", self._handle, methods=["POST"])
+        self.flask_app.add_url_rule("/health", "health", self._health, methods=["GET"])
+        self._server = make_server(listen, port, self.flask_app, threaded=True)
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def port(self) -> int:
+        """Фактический порт (полезно, если сервер запущен на порту 0)."""
+        return self._server.server_port
+
+    def _pending(self) -> int:
+        """Апдейты в очереди плюс принятые процессором, но ещё не обработанные."""
+        pending = self._application.update_queue.qsize()
+        processor = self._application.update_processor
+        if isinstance(processor, PerUserUpdateProcessor):
+            pending += processor.in_flight
+        return pending
+
+    async def _enqueue(self, update: Update) -> bool:
+        """Выполняется в цикле событий бота: кладёт апдейт в очередь, если есть место."""
+        queue = self._application.update_queue
+        if self._pending() >= self._max_pending:
+            return False
+        await queue.put(update)
+        return True
+
+    async def _handle(self) -> Response:
+        token = request.headers.get(SECRET_HEADER, "")
+        if not hmac.compare_digest(token, self._secret_token):
+            logger.warning(f"Вебхук: запрос с неверным секретным токеном от {request.remote_addr}.")
+            return Response(status=403)
+
+        try:
+            update = Update.de_json(request.get_json(force=True), self._application.bot)
+        except Exception as e:
+            logger.warning(f"Вебхук: не удалось разобрать апдейт: {e}")
+            return Response(status=400)
+        if update is None:
+            return Response(status=400)
+
+        # Представление выполняется в собственном цикле событий потока Flask,
+        # а очередь принадлежит циклу бота - передаём апдейт потокобезопасно.
+        future = asyncio.run_coroutine_threadsafe(self._enqueue(update), self._loop)
+        try:
+            accepted = await asyncio.wait_for(asyncio.wrap_future(future), ENQUEUE_TIMEOUT)
+        except asyncio.TimeoutError:
+            future.cancel()
+            accepted = False
+        if not accepted:
+            # Telegram повторит доставку этого апдейта позже
+            logger.warning(f"Вебхук: слишком много необработанных апдейтов, апдейт {update.update_id} отклонён (503).")
+            return Response(status=503)
+        return Response(status=200)
+
+    def _health(self) -> Response:
+        return Response(f"pending={self._pending()}", status=200, mimetype="text/plain")
+
+    def start(self) -> None:
+        """Запускает сервер в фоновом потоке."""
+        self._thread = threading.Thread(target=self._server.serve_forever, name="webhook-server", daemon=True)
+        self._thread.start()
+        logger.info(f"Сервер вебхука слушает порт {self.port}.")
+
+    def stop(self) -> None:
+        """Останавливает сервер и ждёт завершения его потока."""
+        self._server.shutdown()
+        self._server.server_close()
+        if self._thread:
+            self._thread.join()